@@ -0,0 +1,86 @@
+import os
+import sys
+import gzip
+import time
+import argparse
+import tempfile
+import subprocess
+
+import ParallelGzip
+
+def loadSample(path,megabytes):
+    """Return the bytes to compress: the (decompressed) contents of path,
+    or megabytes of synthetic 16 bit image-like data."""
+    if path:
+        if path.endswith('.gz'):
+            sampleFile = gzip.open(path,'rb')
+        else:
+            sampleFile = open(path,'rb')
+        try:
+            return sampleFile.read()
+        finally:
+            sampleFile.close()
+    import numpy
+    count = megabytes*1048576//2
+    # Smooth signal plus noise, compresses about as well as a real scan
+    signal = (numpy.sin(numpy.arange(count)/300.0)*800+1000).astype(numpy.int16)
+    noise = numpy.random.RandomState(0).randint(0,40,count).astype(numpy.int16)
+    return (signal+noise).tostring()
+
+def timeWriter(name,write,data,outPath):
+    startTime = time.time()
+    write(outPath)
+    seconds = max(time.time()-startTime,0.001)
+    size = os.path.getsize(outPath)
+    checkFile = gzip.open(outPath,'rb')
+    try:
+        intact = checkFile.read() == data
+    finally:
+        checkFile.close()
+    print "{0:<28} {1:8.2f}s {2:8.1f} MB/s {3:7.1f}% {4}".format(
+        name,seconds,len(data)/seconds/1048576,100.0*size/len(data),intact and 'ok' or 'CORRUPT')
+    os.remove(outPath)
+
+def writeAll(outFile,data,chunkSize=1048576):
+    try:
+        for offset in range(0,len(data),chunkSize):
+            outFile.write(data[offset:offset+chunkSize])
+    finally:
+        outFile.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the single-threaded gzip path with '
+                                                 'ParallelGzip on a .nii/.nii.gz/.mgz file or '
+                                                 'synthetic data.')
+    parser.add_argument('--input',action="store",dest='input',required=False,
+                        help='A file to compress; .gz files are decompressed first.')
+    parser.add_argument('--megabytes',action="store",dest='megabytes',type=int,default=256,
+                        help='The size of the synthetic data when no input is given.')
+    parser.add_argument('--level',action="store",dest='level',type=int,default=6,
+                        help='The gzip compression level.')
+    parser.add_argument('--threads',action="store",dest='threads',default='2,4,8',
+                        help='Comma separated ParallelGzip thread counts to try.')
+    inputArguments = parser.parse_args()
+
+    data = loadSample(inputArguments.input,inputArguments.megabytes)
+    level = inputArguments.level
+    outPath = os.path.join(tempfile.mkdtemp(),'benchmark.gz')
+    print "{0} bytes at level {1}".format(len(data),level)
+
+    timeWriter('gzip module',lambda path: writeAll(gzip.open(path,'wb',level),data),
+               data,outPath)
+    timeWriter('gzip module, level 9',lambda path: writeAll(gzip.open(path,'wb'),data),
+               data,outPath)
+    def gzipCommand(path):
+        gzipProcess = subprocess.Popen(['gzip','-{0}'.format(level),'-c'],
+                                       stdin=subprocess.PIPE,stdout=open(path,'wb'))
+        gzipProcess.communicate(data)
+    try:
+        timeWriter('gzip command',gzipCommand,data,outPath)
+    except OSError:
+        print "gzip command not found, skipped"
+    for threads in [int(threads) for threads in inputArguments.threads.split(',')]:
+        timeWriter('ParallelGzip, {0} threads'.format(threads),
+                   lambda path: writeAll(ParallelGzip.ParallelGzipFile(path,level,threads),data),
+                   data,outPath)
+    os.rmdir(os.path.dirname(outPath))
@@ -0,0 +1,99 @@
+import sys
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+class ConversionScheduler:
+    """Runs series conversions concurrently on a pool of worker threads.
+
+    Each job runs in a worker thread and the external converters it starts
+    run as separate processes, so up to maxJobs converters are busy at once.
+    toolLimits maps a converter name to the most copies of it allowed to run
+    at the same time, e.g. {'mri_convert': 2}, since some converters need
+    far more memory than others.  Jobs wrap each converter call in
+    toolSlot(name) to honour the limit.
+
+    Completion callbacks run in the thread that calls submit(), poll() or
+    wait(), never in a worker, so they may use the pyxnat Interface.
+    """
+    def __init__(self,maxJobs=1,toolLimits=None):
+        self.logger = logging.getLogger('SyncTasks.ConversionScheduler')
+        self.maxJobs = max(maxJobs,1)
+        self.workers = ThreadPool(self.maxJobs)
+        self.toolSlots = {}
+        for tool,limit in (toolLimits or {}).items():
+            self.toolSlots[tool] = threading.BoundedSemaphore(max(int(limit),1))
+        self.pending = []
+
+    def toolSlot(self,tool):
+        """Return a context manager that holds one of the slots for tool."""
+        return _ToolSlot(self.toolSlots.get(tool))
+
+    def submit(self,job,onComplete=None,description='',onError=None):
+        """Queue job() to run in a worker.  When it finishes, onComplete is
+        called with its return value.  If it raises an exception and onError
+        is given, onError is called with its sys.exc_info() instead of the
+        exception being raised by poll().  Blocks while maxJobs jobs are already
+        running, which keeps the callers' downloads from racing ahead."""
+        while len(self.pending) >= self.maxJobs:
+            if not self.poll():
+                time.sleep(0.1)
+        self.logger.debug('Scheduling conversion {0}'.format(description))
+        result = self.workers.apply_async(_runJob,(job,))
+        self.pending.append((result,onComplete,description,onError))
+
+    def poll(self):
+        """Run the completion callbacks of finished jobs.  Returns the number
+        of jobs that finished.  An exception raised by a job is re-raised
+        here, after the callbacks of the other finished jobs have run."""
+        finished = [entry for entry in self.pending if entry[0].ready()]
+        failure = None
+        for entry in finished:
+            self.pending.remove(entry)
+            result,onComplete,description,onError = entry
+            succeeded,value = result.get()
+            if not succeeded:
+                self.logger.debug('Conversion {0} raised an exception'.format(description))
+                if onError is not None:
+                    onError(value)
+                elif failure is None:
+                    failure = value
+                continue
+            if onComplete is not None:
+                onComplete(value)
+        if failure is not None:
+            raise failure[0],failure[1],failure[2]
+        return len(finished)
+
+    def wait(self):
+        """Block until every submitted job has finished and been completed."""
+        while self.pending:
+            if not self.poll():
+                time.sleep(0.1)
+
+    def close(self):
+        self.workers.close()
+        self.workers.join()
+
+def _runJob(job):
+    # The pool only traps Exception, and a worker that dies on anything else
+    # never reports back, so hand every exception to poll() instead.
+    try:
+        return True,job()
+    except BaseException:
+        return False,sys.exc_info()
+
+class _ToolSlot:
+    def __init__(self,semaphore):
+        self.semaphore = semaphore
+
+    def __enter__(self):
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        if self.semaphore is not None:
+            self.semaphore.release()
+        return False
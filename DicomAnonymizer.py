@@ -0,0 +1,119 @@
+import os
+import re
+import logging
+from multiprocessing.pool import ThreadPool
+
+import dicom
+import dicom.datadict
+from dicom.filereader import InvalidDicomError
+
+class DasSyntaxError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+_TAG = r'\(\s*([0-9A-Fa-fXx]{4})\s*,\s*([0-9A-Fa-fXx]{4})\s*\)'
+_COMMENT = r'\s*(?://.*)?$'
+_ASSIGNMENT = re.compile(r'^'+_TAG+r'\s*:=\s*"((?:[^"\\]|\\.)*)"'+_COMMENT)
+_DELETION = re.compile(r'^-\s*'+_TAG+_COMMENT)
+_VERSION = re.compile(r'^version\s+"[^"]*"'+_COMMENT)
+
+def parseDasLines(lines,source='<script>'):
+    """Parse the statements of a DicomEdit (.das) anonymization script.
+
+    Understands the subset our scripts use: comments, blank lines, the
+    version line, assignments of a quoted string, (gggg,eeee) := "value",
+    and deletions, - (gggg,eeee), where X in a deleted tag matches any hex
+    digit.  Raises DasSyntaxError on anything else, so a rule is never
+    silently skipped.  Returns a list of ('assign', tag, value) and
+    ('delete', mask, tag) rules in script order."""
+    rules = []
+    for lineNumber,line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('//') or _VERSION.match(line):
+            continue
+        match = _ASSIGNMENT.match(line)
+        if match:
+            group,element,value = match.groups()
+            if re.search('[Xx]',group+element):
+                raise DasSyntaxError('{0}:{1}: wildcard in an assignment: {2}'.format(
+                    source,lineNumber+1,line))
+            value = re.sub(r'\\(.)',r'\1',value)
+            rules.append(('assign',int(group+element,16),value))
+            continue
+        match = _DELETION.match(line)
+        if match:
+            pattern = ''.join(match.groups())
+            mask = int(''.join([digit in 'Xx' and '0' or 'F' for digit in pattern]),16)
+            tag = int(re.sub('[Xx]','0',pattern),16)
+            rules.append(('delete',mask,tag))
+            continue
+        raise DasSyntaxError('{0}:{1}: unsupported statement: {2}'.format(
+            source,lineNumber+1,line))
+    return rules
+
+def parseDasFile(path):
+    dasFile = open(path,'r')
+    try:
+        return parseDasLines(dasFile.readlines(),path)
+    finally:
+        dasFile.close()
+
+def applyRules(dataset,rules):
+    """Apply anonymization rules from parseDasLines to a dataset in place."""
+    for rule in rules:
+        if rule[0] == 'assign':
+            tag,value = rule[1],rule[2]
+            if tag in dataset:
+                dataset[tag].value = value
+            else:
+                try:
+                    VR = dicom.datadict.dictionaryVR(tag)
+                except KeyError:
+                    VR = 'LO'
+                dataset.add_new(tag,VR,value)
+        else:
+            mask,tag = rule[1],rule[2]
+            if mask == 0xFFFFFFFF:
+                if tag in dataset:
+                    del dataset[tag]
+                continue
+            for existingTag in dataset.keys():
+                if int(existingTag) & mask == tag:
+                    del dataset[existingTag]
+
+class DicomAnonymizer:
+    """Applies .das anonymization rules to DICOM files in-process, reading
+    and writing each file once, on a pool of worker threads."""
+    def __init__(self,workers=4):
+        self.logger = logging.getLogger('SyncTasks.DicomAnonymizer')
+        self.workers = ThreadPool(max(workers,1))
+
+    def anonymizeDir(self,srcDir,destDir,rules):
+        """Write an anonymized copy of every DICOM file in srcDir to destDir
+        under the same name.  Files that aren't DICOM are skipped.  Returns
+        the number of files written."""
+        names = sorted([name for name in os.listdir(srcDir)
+                        if os.path.isfile(os.path.join(srcDir,name))])
+        written = self.workers.map(lambda name: self.__anonymizeFile(os.path.join(srcDir,name),
+                                                                     os.path.join(destDir,name),
+                                                                     rules),
+                                   names)
+        count = sum(written)
+        self.logger.debug('Anonymized {0} files from {1}'.format(count,srcDir))
+        return count
+
+    def __anonymizeFile(self,srcPath,destPath,rules):
+        try:
+            dataset = dicom.read_file(srcPath)
+        except InvalidDicomError:
+            self.logger.debug('Skipping {0}, not a DICOM file'.format(srcPath))
+            return 0
+        applyRules(dataset,rules)
+        dataset.save_as(destPath)
+        return 1
+
+    def close(self):
+        self.workers.close()
+        self.workers.join()
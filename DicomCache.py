@@ -0,0 +1,204 @@
+import os
+import shutil
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+import DicomHeaders
+
+class DicomCache:
+    """A local, content-addressed store of DICOM files shared by both sync
+    stages, so a session copied from rpacs to predict can be converted for
+    MRx without downloading it again from predict.
+
+    Each file is stored once under objects/, named by the sha1 of its bytes,
+    and indexed by the predict project, subject label, session label and
+    series number it was sent under and its SOPInstanceUID, so an instance
+    sent under two series is kept for both.  When the files take up more
+    than maxBytes, whole series are evicted, least recently used first, so
+    a series is either complete or gone.  Safe to share between threads.
+    """
+    def __init__(self,path,maxBytes):
+        self.logger = logging.getLogger('SyncTasks.DicomCache')
+        self.path = path
+        self.maxBytes = maxBytes
+        self.objectDir = os.path.join(path,'objects')
+        if not os.path.isdir(self.objectDir):
+            os.makedirs(self.objectDir)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(path,'index.db'),check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS instances (
+                    sop_uid TEXT,
+                    sha1 TEXT,
+                    size INTEGER,
+                    name TEXT,
+                    project TEXT,
+                    subject_label TEXT,
+                    session_label TEXT,
+                    series_number TEXT,
+                    PRIMARY KEY (project,subject_label,session_label,series_number,sop_uid));
+                CREATE TABLE IF NOT EXISTS series (
+                    project TEXT,
+                    subject_label TEXT,
+                    session_label TEXT,
+                    series_number TEXT,
+                    size INTEGER,
+                    last_used REAL,
+                    PRIMARY KEY (project,subject_label,session_label,series_number));
+                """)
+            self.connection.commit()
+
+    def ingest(self,dicomDir,project,subjectLabel,sessionLabel,move=False):
+        """Add every DICOM file in dicomDir to the cache, grouped by the
+        SeriesNumber in its header.  Files that aren't DICOM, or have no
+        SOPInstanceUID, are left out, as are repeats of an instance already
+        in the series.  With move, the files are moved into
+        the cache instead of copied.  Returns the number of files added."""
+        added = {}
+        for name in sorted(os.listdir(dicomDir)):
+            filePath = os.path.join(dicomDir,name)
+            if not os.path.isfile(filePath):
+                continue
+            try:
+                dicomFile = open(filePath,'rb')
+                try:
+                    # SeriesNumber (0020,0011) comes after SOPInstanceUID
+                    dataset = DicomHeaders.readHeader(dicomFile,0x00200011)
+                finally:
+                    dicomFile.close()
+                sopUID = str(dataset.SOPInstanceUID)
+                seriesNumber = str(dataset.SeriesNumber)
+            except Exception as e:
+                self.logger.debug('Not caching {0}: {1}'.format(filePath,e))
+                continue
+            instances = added.setdefault(seriesNumber,{})
+            if sopUID in instances:
+                self.logger.debug('Not caching {0}: repeats {1}'.format(filePath,sopUID))
+                continue
+            sha1,size = self.__store(filePath,move)
+            instances[sopUID] = (sopUID,sha1,size,name)
+
+        now = time.time()
+        with self.lock:
+            for seriesNumber,instances in added.items():
+                instances = instances.values()
+                key = (project,subjectLabel,sessionLabel,seriesNumber)
+                replaced = self.__dropSeries(key)
+                self.connection.executemany(
+                    "INSERT INTO instances VALUES (?,?,?,?,?,?,?,?)",
+                    [(sopUID,sha1,size,name)+key for sopUID,sha1,size,name in instances])
+                self.connection.execute(
+                    "INSERT INTO series VALUES (?,?,?,?,?,?)",
+                    key+(sum([instance[2] for instance in instances]),now))
+                self.__removeUnused(replaced)
+            self.connection.commit()
+            self.__evict()
+        count = sum([len(instances) for instances in added.values()])
+        self.logger.info('Cached {0} files of {1},{2},{3}'.format(count,project,subjectLabel,
+                                                                 sessionLabel))
+        return count
+
+    def materialize(self,project,subjectLabel,sessionLabel,seriesNumber,destDir):
+        """Put the cached files of a series into destDir under their
+        original names.  Returns the number of files, 0 if the series isn't
+        cached."""
+        key = (project,subjectLabel,sessionLabel,str(seriesNumber))
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT sha1,name FROM instances WHERE project=? AND subject_label=? AND "
+                "session_label=? AND series_number=?",key).fetchall()
+            if rows:
+                self.connection.execute(
+                    "UPDATE series SET last_used=? WHERE project=? AND subject_label=? AND "
+                    "session_label=? AND series_number=?",(time.time(),)+key)
+                self.connection.commit()
+            # Hold the lock while linking so the series can't be evicted halfway
+            for row in rows:
+                objectPath = self.__objectPath(row['sha1'])
+                destPath = os.path.join(destDir,row['name'])
+                try:
+                    os.link(objectPath,destPath)
+                except OSError:
+                    shutil.copyfile(objectPath,destPath)
+        return len(rows)
+
+    def count(self,project,subjectLabel,sessionLabel,seriesNumber):
+        """Return the number of cached files of a series, 0 if it isn't
+        cached, without counting as a use of it."""
+        key = (project,subjectLabel,sessionLabel,str(seriesNumber))
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM instances WHERE project=? AND subject_label=? AND "
+                "session_label=? AND series_number=?",key).fetchone()
+        return row[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __objectPath(self,sha1):
+        return os.path.join(self.objectDir,sha1[:2],sha1)
+
+    def __store(self,filePath,move):
+        sha1 = hashlib.sha1()
+        dicomFile = open(filePath,'rb')
+        try:
+            for block in iter(lambda: dicomFile.read(1048576),''):
+                sha1.update(block)
+        finally:
+            dicomFile.close()
+        digest = sha1.hexdigest()
+        objectPath = self.__objectPath(digest)
+        if not os.path.exists(objectPath):
+            if not os.path.isdir(os.path.dirname(objectPath)):
+                try:
+                    os.makedirs(os.path.dirname(objectPath))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(objectPath)):
+                        raise
+            # Write under a temporary name so a reader never sees half a file
+            tempPath = objectPath+'.tmp{0}'.format(threading.current_thread().ident)
+            if move:
+                shutil.move(filePath,tempPath)
+            else:
+                shutil.copyfile(filePath,tempPath)
+            os.rename(tempPath,objectPath)
+        return digest,os.path.getsize(objectPath)
+
+    def __dropSeries(self,key):
+        """Forget a series and return the sha1s of its files."""
+        rows = self.connection.execute(
+            "SELECT sha1 FROM instances WHERE project=? AND subject_label=? AND "
+            "session_label=? AND series_number=?",key).fetchall()
+        self.connection.execute(
+            "DELETE FROM instances WHERE project=? AND subject_label=? AND "
+            "session_label=? AND series_number=?",key)
+        self.connection.execute(
+            "DELETE FROM series WHERE project=? AND subject_label=? AND "
+            "session_label=? AND series_number=?",key)
+        return [row['sha1'] for row in rows]
+
+    def __removeUnused(self,sha1s):
+        for sha1 in set(sha1s):
+            stillUsed = self.connection.execute(
+                "SELECT 1 FROM instances WHERE sha1=?",(sha1,)).fetchone()
+            if stillUsed is None and os.path.exists(self.__objectPath(sha1)):
+                os.remove(self.__objectPath(sha1))
+
+    def __evict(self):
+        total = self.connection.execute("SELECT SUM(size) FROM series").fetchone()[0] or 0
+        while total > self.maxBytes:
+            row = self.connection.execute(
+                "SELECT * FROM series ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                break
+            key = (row['project'],row['subject_label'],row['session_label'],row['series_number'])
+            self.logger.debug('Evicting {0} from the DICOM cache'.format(",".join(key)))
+            self.__removeUnused(self.__dropSeries(key))
+            total -= row['size']
+        self.connection.commit()
@@ -0,0 +1,110 @@
+import logging
+from cStringIO import StringIO
+
+import dicom
+import dicom.filereader
+from dicom.multival import MultiValue
+
+from XnatConnectionPool import XnatHttpError
+
+logger = logging.getLogger('SyncTasks.DicomHeaders')
+
+def readHeader(fileobj,lastTag=None):
+    """Parse the header of a DICOM file without its pixel data.  If lastTag
+    is given, parsing stops at the first element after it, so a file cut
+    off anywhere past lastTag still parses."""
+    if lastTag is None:
+        return dicom.read_file(fileobj,stop_before_pixels=True)
+    return dicom.filereader.read_partial(fileobj,
+                                         stop_when=lambda tag,VR,length: tag > lastTag)
+
+def readEchoNumber(path):
+    """Return the EchoNumbers of a DICOM file as an int, the first one if
+    it holds several, or None if the file has no StudyInstanceUID or the
+    EchoNumbers can't be read.  Parsing stops after (0020,000D), well
+    before the pixel data."""
+    dicomFile = open(path,'rb')
+    try:
+        dataset = readHeader(dicomFile,0x0020000D)
+    finally:
+        dicomFile.close()
+    if 'StudyInstanceUID' not in dataset:
+        return None
+    try:
+        echoNumbers = getattr(dataset,'EchoNumbers',None)
+        if isinstance(echoNumbers,MultiValue):
+            echoNumbers = echoNumbers and echoNumbers[0] or None
+        return int(echoNumbers)
+    except (TypeError,ValueError) as e:
+        logger.warning("Can't read the EchoNumbers of {0}: {1}".format(path,e))
+        return None
+
+def readAcquisitionParameters(path):
+    """Return the EchoTime, RepetitionTime, InversionTime and FlipAngle of
+    a DICOM file as a dict of floats, 0.0 for any the file doesn't have.
+    Parsing stops after (0018,1314)."""
+    dicomFile = open(path,'rb')
+    try:
+        dataset = readHeader(dicomFile,0x00181314)
+    finally:
+        dicomFile.close()
+    parameters = {}
+    for keyword,name in [('EchoTime','echoTime'),('RepetitionTime','repetitionTime'),
+                         ('InversionTime','inversionTime'),('FlipAngle','flipAngle')]:
+        parameters[name] = float(getattr(dataset,keyword,0) or 0)
+    return parameters
+
+def probeRemoteHeader(connectionPool,serverUrl,uri,keywords,lastTag,
+                      initialBytes=16384,maxBytes=67108864):
+    """Read the header of a DICOM file on xnat by fetching only its leading
+    bytes.  Starts with an HTTP Range request for initialBytes and asks for
+    four times as much each time the elements named in keywords are not
+    there yet.  If the server ignores the Range header the response is read
+    in growing steps instead and dropped as soon as the header parses.
+    Returns the parsed dataset."""
+    data = ''
+    window = initialBytes
+    response = None
+    try:
+        while True:
+            complete = False
+            if response is None:
+                response = connectionPool.open(serverUrl,'GET',uri,
+                                               {'Range': 'bytes={0}-{1}'.format(len(data),window-1)})
+                if response.status == 206:
+                    data += response.read()
+                    response.close()
+                    response = None
+                    complete = len(data) < window
+                elif response.status == 200:
+                    data = response.read(window)
+                    complete = len(data) < window
+                elif response.status == 416:
+                    response.close()
+                    response = None
+                    complete = True
+                else:
+                    response.close()
+                    raise XnatHttpError('GET {0} returned {1} {2}'.format(uri,response.status,
+                                                                          response.reason))
+            else:
+                chunk = response.read(window-len(data))
+                data += chunk
+                complete = len(data) < window
+
+            try:
+                dataset = readHeader(StringIO(data),lastTag)
+                if all([keyword in dataset for keyword in keywords]):
+                    logger.debug('Parsed header of {0} from {1} bytes'.format(uri,len(data)))
+                    return dataset
+            except Exception as e:
+                dataset = None
+                logger.debug('Header of {0} not complete in {1} bytes: {2}'.format(uri,len(data),e))
+            if complete or window >= maxBytes:
+                if dataset is None:
+                    raise XnatHttpError('Could not parse a DICOM header from {0}'.format(uri))
+                return dataset
+            window *= 4
+    finally:
+        if response is not None:
+            response.close()
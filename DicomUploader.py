@@ -0,0 +1,139 @@
+import os
+import re
+import sys
+import time
+import shutil
+import urllib
+import logging
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+sys.path.append('/paulsen/PREDICT_ORIG_DATA/bin')
+import phdUtils
+from XnatConnectionPool import XnatConnectionPool
+
+class UploadError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+class DicomUploader:
+    """Sends the series of a session to predict concurrently, one series per
+    worker, and retries a series that fails without resending the others.
+
+    The target decides how a series is sent:
+      dicom://host:port/AE - a DicomRemap C-STORE association per series,
+                             applying anonScript when one is given.
+      http(s)://...        - the xnat gradual-DICOM import service, one
+                             POST per file over the shared connection pool.
+      file:///path         - a local directory standing in for the
+                             receiver; each series is copied to
+                             /path/<project>/<subject>/<session>/.
+    Any other target raises UploadError, so a mistyped one can't pass for
+    a successful upload.
+    Only the dicom:// target can apply an anonScript; the others send the
+    files as they are.
+    """
+    def __init__(self,dicomRemap,target,concurrency=4,retries=1,connectionPool=None,
+                 user=None,password=None):
+        self.logger = logging.getLogger('SyncTasks.DicomUploader')
+        self.dicomRemap = dicomRemap
+        self.target = target
+        self.retries = retries
+        self.workers = ThreadPool(max(concurrency,1))
+        if target.startswith('dicom://'):
+            self.transport = 'scp'
+        elif target.startswith('http://') or target.startswith('https://'):
+            self.transport = 'rest'
+            if connectionPool is None:
+                connectionPool = XnatConnectionPool()
+            self.serverUrl = connectionPool.addServer(target,user,password)
+        elif target.startswith('file://'):
+            self.transport = 'directory'
+            self.directory = target[len('file://'):]
+        else:
+            raise UploadError("Don't know how to upload to {0}, expected a dicom://, http(s):// "
+                              "or file:// url".format(target))
+        self.connectionPool = connectionPool
+
+    def uploadSession(self,seriesDirs,projectLabel,subjectLabel,sessionLabel,anonScript=None):
+        """Send every directory in seriesDirs.  Returns the directories that
+        still failed after the retries; an empty list means all were sent."""
+        if anonScript is not None and self.transport != 'scp':
+            raise UploadError("Can't apply {0} when uploading to {1}".format(anonScript,self.target))
+        pending = list(seriesDirs)
+        for attempt in range(self.retries+1):
+            if attempt:
+                self.logger.info("Retrying {0} failed series of {1}".format(len(pending),sessionLabel))
+            results = self.workers.map(lambda seriesDir: self.__uploadSeries(seriesDir,projectLabel,
+                                                                             subjectLabel,sessionLabel,
+                                                                             anonScript),
+                                       pending)
+            pending = [seriesDir for seriesDir,sent in zip(pending,results) if not sent]
+            if not pending:
+                break
+        return pending
+
+    def __uploadSeries(self,seriesDir,projectLabel,subjectLabel,sessionLabel,anonScript):
+        startTime = time.time()
+        try:
+            names = sorted([name for name in os.listdir(seriesDir)
+                            if os.path.isfile(os.path.join(seriesDir,name))])
+            totalBytes = sum([os.path.getsize(os.path.join(seriesDir,name)) for name in names])
+            if self.transport == 'scp':
+                self.__sendWithDicomRemap(seriesDir,anonScript)
+            elif self.transport == 'rest':
+                for name in names:
+                    self.__postFile(os.path.join(seriesDir,name),projectLabel,subjectLabel,
+                                    sessionLabel)
+            else:
+                self.__copyToDirectory(seriesDir,names,projectLabel,subjectLabel,sessionLabel)
+        except Exception as e:
+            self.logger.error("Upload of {0} to {1} failed: {2}".format(seriesDir,self.target,e))
+            return False
+        seconds = max(time.time()-startTime,0.001)
+        self.logger.info("Uploaded {0}: {1} files, {2} bytes in {3:.1f}s ({4:.0f} bytes/sec).".format(
+            seriesDir,len(names),totalBytes,seconds,totalBytes/seconds))
+        return True
+
+    def __sendWithDicomRemap(self,seriesDir,anonScript):
+        command_list = [self.dicomRemap]
+        if anonScript is not None:
+            command_list.append('-d '+anonScript)
+        command_list += ['-o '+self.target, seriesDir]
+        self.logger.debug(" ".join(command_list))
+        tmpOutput = phdUtils.check_output(command_list,stderr=subprocess.STDOUT)
+        self.logger.debug(tmpOutput)
+        if re.search('Exception',tmpOutput):
+            raise UploadError("DicomRemap reported an exception. Output follows.\n"+tmpOutput)
+
+    def __postFile(self,path,projectLabel,subjectLabel,sessionLabel):
+        query = urllib.urlencode([('import-handler','gradual-DICOM'),
+                                  ('PROJECT_ID',projectLabel),
+                                  ('SUBJECT_ID',subjectLabel),
+                                  ('EXPT_LABEL',sessionLabel),
+                                  ('inbody','true')])
+        dicomFile = open(path,'rb')
+        try:
+            body = dicomFile.read()
+        finally:
+            dicomFile.close()
+        self.connectionPool.request(self.serverUrl,'POST','/data/services/import?'+query,
+                                    {'Content-Type': 'application/dicom'},body)
+
+    def __copyToDirectory(self,seriesDir,names,projectLabel,subjectLabel,sessionLabel):
+        destDir = os.path.join(self.directory,projectLabel,subjectLabel,sessionLabel)
+        if not os.path.isdir(destDir):
+            try:
+                os.makedirs(destDir)
+            except OSError:
+                if not os.path.isdir(destDir):
+                    raise
+        for name in names:
+            shutil.copyfile(os.path.join(seriesDir,name),
+                            os.path.join(destDir,os.path.basename(seriesDir)+'_'+name))
+
+    def close(self):
+        self.workers.close()
+        self.workers.join()
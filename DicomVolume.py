@@ -0,0 +1,611 @@
+import os
+import gzip
+import math
+import struct
+import logging
+
+import numpy
+import dicom
+from dicom.filereader import InvalidDicomError
+
+import ParallelGzip
+
+logger = logging.getLogger('SyncTasks.DicomVolume')
+
+class UnsupportedSeriesError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+# NIfTI-1 datatype codes and MGH type codes by numpy dtype
+NIFTI_TYPES = {'int16': (4,16), 'uint16': (512,16), 'int32': (8,32), 'float32': (16,32)}
+MGH_TYPES = {'uint8': 0, 'int32': 1, 'float32': 3, 'int16': 4}
+
+NIFTI_HEADER = struct.Struct('<i10s18sihcc8h3f4h8f3fh2c4f2i80s24s2h6f4f4f4f16s4s')
+MGH_HEADER_SIZE = 284
+
+class DicomVolume:
+    """A 3D volume read from a single DICOM series.
+
+    data is indexed [x,y,z] along the image columns, rows and slices, and
+    affine maps those indices to RAS millimetres.  Stored values are turned
+    into real values as data*slope+intercept.  repetitionTime, echoTime and
+    inversionTime are in milliseconds, flipAngle in degrees.
+    """
+    def __init__(self,data,affine,slope=1.0,intercept=0.0,repetitionTime=0.0,
+                 echoTime=0.0,inversionTime=0.0,flipAngle=0.0):
+        self.data = data
+        self.affine = affine
+        self.slope = slope
+        self.intercept = intercept
+        self.repetitionTime = repetitionTime
+        self.echoTime = echoTime
+        self.inversionTime = inversionTime
+        self.flipAngle = flipAngle
+
+    def voxelSizes(self):
+        return numpy.sqrt((self.affine[:3,:3]**2).sum(axis=0))
+
+    def realData(self):
+        """Return the data as float32 real values, or as stored if the
+        scaling is the identity."""
+        if self.slope == 1.0 and self.intercept == 0.0:
+            return self.data
+        return self.data.astype(numpy.float32)*numpy.float32(self.slope)+numpy.float32(self.intercept)
+
+def readSeries(dicomDir):
+    """Read every DICOM image in dicomDir once and return a DicomVolume with
+    the slices sorted along the slice normal.  Raises UnsupportedSeriesError
+    for anything but a single volume of parallel, evenly spaced slices of
+    the same size, which the external converters still handle."""
+    datasets = []
+    for name in sorted(os.listdir(dicomDir)):
+        path = os.path.join(dicomDir,name)
+        if name.endswith('.xml') or not os.path.isfile(path):
+            continue
+        try:
+            datasets.append(dicom.read_file(path))
+        except InvalidDicomError:
+            logger.debug('Skipping {0}, not a DICOM file'.format(path))
+    if not datasets:
+        raise UnsupportedSeriesError('No DICOM images in {0}'.format(dicomDir))
+
+    try:
+        orientation = numpy.array([float(value) for value in datasets[0].ImageOrientationPatient])
+        rowSpacing,columnSpacing = [float(value) for value in datasets[0].PixelSpacing]
+        shape = (datasets[0].Rows,datasets[0].Columns)
+        positions = numpy.array([[float(value) for value in dataset.ImagePositionPatient]
+                                 for dataset in datasets])
+        for dataset in datasets:
+            if (dataset.Rows,dataset.Columns) != shape or not numpy.allclose(
+                    [float(value) for value in dataset.ImageOrientationPatient],orientation,atol=1e-4):
+                raise UnsupportedSeriesError('Slices of {0} differ in size or orientation'.format(dicomDir))
+    except AttributeError as e:
+        raise UnsupportedSeriesError('{0} lacks geometry: {1}'.format(dicomDir,e))
+
+    rowCosines = orientation[:3]
+    columnCosines = orientation[3:]
+    normal = numpy.cross(rowCosines,columnCosines)
+    distances = positions.dot(normal)
+    order = numpy.argsort(distances)
+    distances = distances[order]
+    if len(datasets) > 1:
+        gaps = numpy.diff(distances)
+        if gaps.min() <= 1e-3:
+            raise UnsupportedSeriesError('{0} holds more than one volume'.format(dicomDir))
+        if gaps.max()-gaps.min() > 0.01*gaps.mean():
+            raise UnsupportedSeriesError('Slices of {0} are unevenly spaced'.format(dicomDir))
+        sliceStep = (positions[order[-1]]-positions[order[0]])/(len(datasets)-1)
+    else:
+        sliceStep = normal*float(getattr(datasets[0],'SliceThickness',1.0) or 1.0)
+
+    # Stack the slices and apply the rescale in one pass over the volume
+    first = datasets[order[0]]
+    try:
+        pixels = numpy.array([datasets[index].pixel_array for index in order])
+    except Exception as e:
+        raise UnsupportedSeriesError('Pixel data of {0} could not be read: {1}'.format(dicomDir,e))
+    slopes = numpy.array([float(getattr(datasets[index],'RescaleSlope',1.0)) for index in order])
+    intercepts = numpy.array([float(getattr(datasets[index],'RescaleIntercept',0.0)) for index in order])
+    slope,intercept = 1.0,0.0
+    if numpy.all(slopes == slopes[0]) and numpy.all(intercepts == intercepts[0]):
+        slope,intercept = slopes[0],intercepts[0]
+    else:
+        pixels = (pixels.astype(numpy.float32)*slopes[:,None,None].astype(numpy.float32)+
+                  intercepts[:,None,None].astype(numpy.float32))
+
+    # Columns of the LPS affine step along the image columns, rows and slices
+    lpsAffine = numpy.eye(4)
+    lpsAffine[:3,0] = rowCosines*columnSpacing
+    lpsAffine[:3,1] = columnCosines*rowSpacing
+    lpsAffine[:3,2] = sliceStep
+    lpsAffine[:3,3] = positions[order[0]]
+    affine = numpy.diag([-1.0,-1.0,1.0,1.0]).dot(lpsAffine)
+
+    return DicomVolume(pixels.transpose(2,1,0),affine,slope,intercept,
+                       float(getattr(first,'RepetitionTime',0) or 0),
+                       float(getattr(first,'EchoTime',0) or 0),
+                       float(getattr(first,'InversionTime',0) or 0),
+                       float(getattr(first,'FlipAngle',0) or 0))
+
+def affineToQuaternion(affine):
+    """Return (b, c, d, qfac) of the NIfTI quaternion for an affine."""
+    rotation = affine[:3,:3]/numpy.sqrt((affine[:3,:3]**2).sum(axis=0))
+    qfac = 1.0
+    if numpy.linalg.det(rotation) < 0:
+        rotation[:,2] = -rotation[:,2]
+        qfac = -1.0
+    r = rotation
+    a = r[0,0]+r[1,1]+r[2,2]+1.0
+    if a > 0.5:
+        a = 0.5*math.sqrt(a)
+        b = 0.25*(r[2,1]-r[1,2])/a
+        c = 0.25*(r[0,2]-r[2,0])/a
+        d = 0.25*(r[1,0]-r[0,1])/a
+    else:
+        xd = 1.0+r[0,0]-(r[1,1]+r[2,2])
+        yd = 1.0+r[1,1]-(r[0,0]+r[2,2])
+        zd = 1.0+r[2,2]-(r[0,0]+r[1,1])
+        if xd > 1.0:
+            b = 0.5*math.sqrt(xd)
+            c = 0.25*(r[0,1]+r[1,0])/b
+            d = 0.25*(r[0,2]+r[2,0])/b
+            a = 0.25*(r[2,1]-r[1,2])/b
+        elif yd > 1.0:
+            c = 0.5*math.sqrt(yd)
+            b = 0.25*(r[0,1]+r[1,0])/c
+            d = 0.25*(r[1,2]+r[2,1])/c
+            a = 0.25*(r[0,2]-r[2,0])/c
+        else:
+            d = 0.5*math.sqrt(zd)
+            b = 0.25*(r[0,2]+r[2,0])/d
+            c = 0.25*(r[1,2]+r[2,1])/d
+            a = 0.25*(r[1,0]-r[0,1])/d
+        if a < 0.0:
+            b,c,d = -b,-c,-d
+    return b,c,d,qfac
+
+def niftiHeader(volume,dtype):
+    """Return the 352 byte header, with its empty extension block, of a
+    single file NIfTI-1 image of volume stored as dtype."""
+    datatype,bitpix = NIFTI_TYPES[dtype.name]
+    nx,ny,nz = volume.data.shape
+    sizes = volume.voxelSizes()
+    b,c,d,qfac = affineToQuaternion(volume.affine)
+    affine = volume.affine
+    header = NIFTI_HEADER.pack(348,'','',0,0,'r','\0',
+                               3,nx,ny,nz,1,1,1,1,
+                               0.0,0.0,0.0,
+                               0,datatype,bitpix,0,
+                               qfac,sizes[0],sizes[1],sizes[2],volume.repetitionTime/1000.0,0.0,0.0,0.0,
+                               352.0,volume.slope,volume.intercept,
+                               0,'\0',chr(2|8),
+                               0.0,0.0,0.0,0.0,
+                               0,0,
+                               'TE={0:g};Time={1:g}'.format(volume.echoTime,volume.repetitionTime),'',
+                               1,1,
+                               b,c,d,affine[0,3],affine[1,3],affine[2,3],
+                               affine[0,0],affine[0,1],affine[0,2],affine[0,3],
+                               affine[1,0],affine[1,1],affine[1,2],affine[1,3],
+                               affine[2,0],affine[2,1],affine[2,2],affine[2,3],
+                               '','n+1\0')
+    return header+'\0\0\0\0'
+
+def mghHeader(shape,affine,mghType,frames=1):
+    """Return the 284 byte header of an MGH image of the given [x,y,z]
+    shape and RAS affine."""
+    nx,ny,nz = shape
+    sizes = numpy.sqrt((affine[:3,:3]**2).sum(axis=0))
+    directions = affine[:3,:3]/sizes
+    center = affine.dot([nx/2.0,ny/2.0,nz/2.0,1.0])[:3]
+    header = struct.pack('>7ih3f9f3f',1,nx,ny,nz,frames,mghType,0,1,
+                         sizes[0],sizes[1],sizes[2],
+                         *(list(directions.T.flatten())+list(center)))
+    return header+'\0'*(MGH_HEADER_SIZE-len(header))
+
+def mghTail(repetitionTime,flipAngle,echoTime,inversionTime):
+    """TR, flip angle (radians), TE and TI, as mri_convert writes them.
+    flipAngle is in degrees."""
+    return struct.pack('>4f',repetitionTime,math.radians(flipAngle),echoTime,inversionTime)
+
+def writeSlices(outFile,data,dtype):
+    """Write data [x,y,z] in x-fastest order, one slice at a time."""
+    for z in range(data.shape[2]):
+        outFile.write(numpy.ascontiguousarray(data[:,:,z].T).astype(dtype).tostring())
+
+def gzipWriter(fileobj,level=6,threads=1):
+    """Return a file object that gzips what is written to it into fileobj,
+    a path or an open binary file.  With more than one thread the blocks
+    are compressed in parallel by ParallelGzip."""
+    if threads > 1:
+        return ParallelGzip.ParallelGzipFile(fileobj,level,threads)
+    if isinstance(fileobj,basestring):
+        return gzip.open(fileobj,'wb',level)
+    return gzip.GzipFile(fileobj=fileobj,mode='wb',compresslevel=level)
+
+def writeNifti(volume,path,level=6,threads=1):
+    """Write volume to path as gzipped NIfTI-1.  The stored values and the
+    rescale are kept as they are in the DICOM files."""
+    dtype = numpy.dtype(volume.data.dtype.name)
+    if dtype.name not in NIFTI_TYPES:
+        dtype = numpy.dtype('float32')
+    outFile = gzipWriter(path+'.part',level,threads)
+    try:
+        outFile.write(niftiHeader(volume,dtype))
+        writeSlices(outFile,volume.data,dtype.newbyteorder('<'))
+    finally:
+        outFile.close()
+    os.rename(path+'.part',path)
+
+def writeMgz(volume,path,level=6,threads=1):
+    """Write volume to path as a gzipped MGH image with TR, TE, TI and flip
+    angle.  MGH has no rescale, so scaled data is written as float."""
+    data = volume.realData()
+    dtype = numpy.dtype(data.dtype.name)
+    if dtype.name == 'uint16' and data.max() <= 32767:
+        dtype = numpy.dtype('int16')
+    if dtype.name not in MGH_TYPES:
+        dtype = numpy.dtype('float32')
+    outFile = gzipWriter(path+'.part',level,threads)
+    try:
+        outFile.write(mghHeader(data.shape,volume.affine,MGH_TYPES[dtype.name]))
+        writeSlices(outFile,data,dtype.newbyteorder('>'))
+        outFile.write(mghTail(volume.repetitionTime,volume.flipAngle,
+                              volume.echoTime,volume.inversionTime))
+    finally:
+        outFile.close()
+    os.rename(path+'.part',path)
+
+# numpy dtypes of the NIfTI-1 datatype codes
+NIFTI_DTYPES = {2: 'uint8', 4: 'int16', 8: 'int32', 16: 'float32', 64: 'float64',
+                256: 'int8', 512: 'uint16', 768: 'uint32'}
+
+def niftiAffine(header):
+    """Return the RAS affine of an unpacked NIfTI-1 header, from the sform
+    when it is set and the qform otherwise."""
+    qformCode,sformCode = header[44],header[45]
+    if sformCode > 0:
+        return numpy.array([header[52:56],header[56:60],header[60:64],[0.0,0.0,0.0,1.0]])
+    pixdim = header[22:30]
+    b,c,d = header[46:49]
+    a = math.sqrt(max(1.0-(b*b+c*c+d*d),0.0))
+    rotation = numpy.array([[a*a+b*b-c*c-d*d, 2*(b*c-a*d), 2*(b*d+a*c)],
+                            [2*(b*c+a*d), a*a+c*c-b*b-d*d, 2*(c*d-a*b)],
+                            [2*(b*d-a*c), 2*(c*d+a*b), a*a+d*d-c*c-b*b]])
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    affine = numpy.eye(4)
+    affine[:3,:3] = rotation*[pixdim[1],pixdim[2],qfac*pixdim[3]]
+    affine[:3,3] = header[49:52]
+    if qformCode <= 0:
+        affine[:3,:3] = numpy.diag(pixdim[1:4])
+        affine[:3,3] = 0.0
+    return affine
+
+def niftiToMgz(niftiPath,mgzPath,repetitionTime=0.0,echoTime=0.0,inversionTime=0.0,
+               flipAngle=0.0,level=6,threads=1):
+    """Convert a (gzipped) single file NIfTI-1 image to a gzipped MGH image
+    one slice at a time, so neither image is ever held in memory or written
+    uncompressed.  niftiPath is only read.  flipAngle is in degrees."""
+    if niftiPath.endswith('.gz'):
+        inFile = gzip.open(niftiPath,'rb')
+    else:
+        inFile = open(niftiPath,'rb')
+    try:
+        raw = inFile.read(348)
+        endian = '<'
+        if struct.unpack('<i',raw[:4])[0] != 348:
+            endian = '>'
+        header = struct.unpack(endian+NIFTI_HEADER.format[1:],raw)
+        if header[65][:3] != 'n+1':
+            raise UnsupportedSeriesError('{0} is not a single file NIfTI-1 image'.format(niftiPath))
+        dims = header[7:15]
+        if header[19] not in NIFTI_DTYPES:
+            raise UnsupportedSeriesError('{0} has NIfTI datatype {1}'.format(niftiPath,header[19]))
+        inType = numpy.dtype(NIFTI_DTYPES[header[19]]).newbyteorder(endian)
+        shape = (dims[1],max(dims[2],1),max(dims[3],1))
+        frames = 1
+        for dim in dims[4:dims[0]+1]:
+            frames *= max(dim,1)
+        slope,intercept = header[31],header[32]
+        scaled = slope not in (0.0,1.0) or intercept != 0.0
+        if scaled:
+            outType = 'float32'
+        elif inType.name in ('uint16','int8'):
+            outType = 'int32'
+        elif inType.name not in MGH_TYPES:
+            outType = 'float32'
+        else:
+            outType = inType.name
+        outType = numpy.dtype(outType).newbyteorder('>')
+        inFile.read(int(header[30])-348)
+
+        outFile = gzipWriter(mgzPath+'.part',level,threads)
+        try:
+            outFile.write(mghHeader(shape,niftiAffine(header),MGH_TYPES[outType.name],frames))
+            sliceBytes = shape[0]*shape[1]*inType.itemsize
+            for index in range(shape[2]*frames):
+                chunk = inFile.read(sliceBytes)
+                if len(chunk) != sliceBytes:
+                    raise UnsupportedSeriesError('{0} ends early'.format(niftiPath))
+                values = numpy.frombuffer(chunk,inType)
+                if scaled:
+                    values = values.astype(numpy.float32)*numpy.float32(slope)+numpy.float32(intercept)
+                outFile.write(values.astype(outType).tostring())
+            outFile.write(mghTail(repetitionTime,flipAngle,echoTime,inversionTime))
+        finally:
+            outFile.close()
+    finally:
+        inFile.close()
+    os.rename(mgzPath+'.part',mgzPath)
+
+class DwiVolume:
+    """A diffusion weighted series as a 4D volume.
+
+    data is indexed [x,y,z,volume] and affine maps [x,y,z] to LPS
+    millimetres.  bValues holds the b-value of each volume and gradients
+    the unit gradient direction of each volume in LPS, zero for b=0.
+    """
+    def __init__(self,data,affine,bValues,gradients):
+        self.data = data
+        self.affine = affine
+        self.bValues = bValues
+        self.gradients = gradients
+
+    def numberOfVolumes(self):
+        return self.data.shape[3]
+
+def readCsaHeader(value):
+    """Return the elements of a Siemens CSA header (SV10 format) as a dict
+    mapping each name to its list of string values."""
+    if not value.startswith('SV10'):
+        raise UnsupportedSeriesError('Only SV10 CSA headers are supported')
+    numberOfTags = struct.unpack_from('<I',value,8)[0]
+    offset = 16
+    elements = {}
+    for tag in range(numberOfTags):
+        name = value[offset:offset+64].split('\0')[0]
+        numberOfItems = struct.unpack_from('<i',value,offset+76)[0]
+        offset += 84
+        items = []
+        for item in range(numberOfItems):
+            itemLength = struct.unpack_from('<i',value,offset+4)[0]
+            offset += 16
+            items.append(value[offset:offset+itemLength].split('\0')[0].strip())
+            offset += (itemLength+3)//4*4
+        elements[name] = [item for item in items if item]
+    return elements
+
+def _csaNumbers(elements,name):
+    return [float(item) for item in elements.get(name,[])]
+
+def _privateNumbers(dataset,tag,count):
+    """Read count doubles from a private element that may have been read
+    with an implicit VR as raw bytes."""
+    if tag not in dataset:
+        return []
+    value = dataset[tag].value
+    if isinstance(value,str) and len(value) == 8*count:
+        return list(struct.unpack('<{0}d'.format(count),value))
+    if isinstance(value,str):
+        return [float(item) for item in value.strip('\0 ').split('\\') if item]
+    if isinstance(value,(list,tuple)) or hasattr(value,'__iter__'):
+        return [float(item) for item in value]
+    return [float(value)]
+
+def _diffusionOf(dataset,csa):
+    """Return the b-value and gradient direction (LPS) of one image, from
+    the standard tags, the Siemens CSA header or the Siemens private tags.
+    Siemens gradients come from the B-matrix when it is there."""
+    if 'DiffusionBValue' in dataset or 'MRDiffusionSequence' in dataset:
+        diffusion = dataset
+        if 'MRDiffusionSequence' in dataset:
+            diffusion = dataset.MRDiffusionSequence[0]
+        bValue = float(diffusion.DiffusionBValue)
+        direction = [0.0,0.0,0.0]
+        if 'DiffusionGradientDirectionSequence' in diffusion:
+            direction = [float(item) for item in
+                         diffusion.DiffusionGradientDirectionSequence[0].DiffusionGradientOrientation]
+        elif 'DiffusionGradientOrientation' in diffusion:
+            direction = [float(item) for item in diffusion.DiffusionGradientOrientation]
+        return bValue,direction,None
+    if csa is not None and 'B_value' in csa:
+        bValue = _csaNumbers(csa,'B_value')[0]
+        direction = _csaNumbers(csa,'DiffusionGradientDirection') or [0.0,0.0,0.0]
+        return bValue,direction,_csaNumbers(csa,'B_matrix') or None
+    if (0x0019,0x100C) in dataset:
+        bValue = _privateNumbers(dataset,(0x0019,0x100C),1)[0]
+        direction = _privateNumbers(dataset,(0x0019,0x100E),3) or [0.0,0.0,0.0]
+        return bValue,direction,_privateNumbers(dataset,(0x0019,0x1027),6) or None
+    raise UnsupportedSeriesError('No b-value found in a {0} image'.format(
+        getattr(dataset,'Manufacturer','unknown')))
+
+def _gradientsFromBMatrices(bMatrices,directions):
+    """Return the principal eigenvector of each B-matrix (bxx, bxy, bxz,
+    byy, byz, bzz), signed like the matching direction, all at once."""
+    b = numpy.asarray(bMatrices,dtype=numpy.float64)
+    matrices = numpy.empty((len(b),3,3))
+    matrices[:,0,0],matrices[:,0,1],matrices[:,0,2] = b[:,0],b[:,1],b[:,2]
+    matrices[:,1,0],matrices[:,1,1],matrices[:,1,2] = b[:,1],b[:,3],b[:,4]
+    matrices[:,2,0],matrices[:,2,1],matrices[:,2,2] = b[:,2],b[:,4],b[:,5]
+    values,vectors = numpy.linalg.eigh(matrices)
+    principal = vectors[:,:,2]
+    signs = numpy.where((principal*directions).sum(axis=1) < 0,-1.0,1.0)
+    return principal*signs[:,None]
+
+def readDwiSeries(dicomDir):
+    """Read a diffusion weighted series once and return a DwiVolume.
+    Handles one file per slice per volume, and Siemens mosaics with one
+    file per volume.  Raises UnsupportedSeriesError for anything else."""
+    datasets = []
+    for name in sorted(os.listdir(dicomDir)):
+        path = os.path.join(dicomDir,name)
+        if name.endswith('.xml') or not os.path.isfile(path):
+            continue
+        try:
+            datasets.append(dicom.read_file(path))
+        except InvalidDicomError:
+            logger.debug('Skipping {0}, not a DICOM file'.format(path))
+        except Exception as e:
+            raise UnsupportedSeriesError('{0} could not be read: {1}'.format(path,e))
+    if not datasets:
+        raise UnsupportedSeriesError('No DICOM images in {0}'.format(dicomDir))
+    try:
+        orientation = numpy.array([float(value) for value in datasets[0].ImageOrientationPatient])
+        rowSpacing,columnSpacing = [float(value) for value in datasets[0].PixelSpacing]
+    except AttributeError as e:
+        raise UnsupportedSeriesError('{0} lacks geometry: {1}'.format(dicomDir,e))
+    rowCosines = orientation[:3]
+    columnCosines = orientation[3:]
+
+    csaHeaders = []
+    for dataset in datasets:
+        csa = None
+        if (0x0029,0x1010) in dataset:
+            try:
+                csa = readCsaHeader(dataset[0x0029,0x1010].value)
+            except UnsupportedSeriesError:
+                raise
+            except Exception as e:
+                raise UnsupportedSeriesError('CSA header in {0} could not be read: {1}'.format(dicomDir,e))
+        csaHeaders.append(csa)
+
+    try:
+        if 'MOSAIC' in [str(item).upper() for item in getattr(datasets[0],'ImageType',[])]:
+            pixels,affine,volumeImages = _readMosaics(datasets,csaHeaders,rowCosines,columnCosines,
+                                                      rowSpacing,columnSpacing)
+        else:
+            pixels,affine,volumeImages = _readSlices(datasets,rowCosines,columnCosines,
+                                                     rowSpacing,columnSpacing)
+        diffusion = [_diffusionOf(datasets[index],csaHeaders[index]) for index in volumeImages]
+    except (AttributeError,ValueError,TypeError,IndexError,KeyError,struct.error) as e:
+        raise UnsupportedSeriesError('Could not assemble {0}: {1}'.format(dicomDir,e))
+
+    bValues = numpy.array([entry[0] for entry in diffusion])
+    directions = numpy.array([entry[1] for entry in diffusion],dtype=numpy.float64)
+    bMatrices = [entry[2] for entry in diffusion]
+    weighted = bValues > 0
+    if all([bMatrix is not None and len(bMatrix) == 6
+            for bMatrix,isWeighted in zip(bMatrices,weighted) if isWeighted]) and weighted.any():
+        directions[weighted] = _gradientsFromBMatrices([bMatrix for bMatrix,isWeighted in
+                                                        zip(bMatrices,weighted) if isWeighted],
+                                                       directions[weighted])
+    norms = numpy.sqrt((directions**2).sum(axis=1))
+    directions[norms > 0] /= norms[norms > 0][:,None]
+    directions[~weighted] = 0.0
+    return DwiVolume(pixels,affine,bValues,directions)
+
+def _readSlices(datasets,rowCosines,columnCosines,rowSpacing,columnSpacing):
+    """Assemble one file per slice per volume.  Returns the [x,y,z,volume]
+    pixels, the LPS affine and the index of one image of each volume."""
+    normal = numpy.cross(rowCosines,columnCosines)
+    positions = numpy.array([[float(value) for value in dataset.ImagePositionPatient]
+                             for dataset in datasets])
+    distances = numpy.round(positions.dot(normal),3)
+    sliceDistances = numpy.unique(distances)
+    numberOfVolumes,remainder = divmod(len(datasets),len(sliceDistances))
+    if remainder:
+        raise UnsupportedSeriesError('Slice positions hold different numbers of images')
+    # Within a slice position, acquisition order gives the volume
+    instances = numpy.array([int(getattr(dataset,'InstanceNumber',0) or 0) for dataset in datasets])
+    order = numpy.lexsort((instances,distances))
+    grid = order.reshape(len(sliceDistances),numberOfVolumes)
+    pixels = _pixelArrays(datasets,order)
+    pixels = pixels.reshape((len(sliceDistances),numberOfVolumes)+pixels.shape[1:])
+    pixels = pixels.transpose(3,2,0,1)
+    if len(sliceDistances) > 1:
+        sliceStep = (positions[grid[-1,0]]-positions[grid[0,0]])/(len(sliceDistances)-1)
+    else:
+        sliceStep = normal*float(getattr(datasets[0],'SliceThickness',1.0) or 1.0)
+    affine = numpy.eye(4)
+    affine[:3,0] = rowCosines*columnSpacing
+    affine[:3,1] = columnCosines*rowSpacing
+    affine[:3,2] = sliceStep
+    affine[:3,3] = positions[grid[0,0]]
+    return pixels,affine,list(grid[0])
+
+def _readMosaics(datasets,csaHeaders,rowCosines,columnCosines,rowSpacing,columnSpacing):
+    """Assemble Siemens mosaics, one file per volume, into [x,y,z,volume]
+    pixels.  Returns them with the LPS affine and the volume order."""
+    csa = csaHeaders[0] or {}
+    if 'NumberOfImagesInMosaic' in csa:
+        numberOfSlices = int(_csaNumbers(csa,'NumberOfImagesInMosaic')[0])
+    else:
+        numberOfSlices = int(_privateNumbers(datasets[0],(0x0019,0x100A),1)[0])
+    normal = numpy.array(_csaNumbers(csa,'SliceNormalVector') or
+                         numpy.cross(rowCosines,columnCosines))
+    tiles = int(math.ceil(math.sqrt(numberOfSlices)))
+    mosaicRows,mosaicColumns = datasets[0].Rows,datasets[0].Columns
+    tileRows,tileColumns = mosaicRows//tiles,mosaicColumns//tiles
+
+    instances = [int(getattr(dataset,'InstanceNumber',0) or 0) for dataset in datasets]
+    order = list(numpy.argsort(instances,kind='mergesort'))
+    mosaics = _pixelArrays(datasets,order)
+    # Cut every mosaic into its tiles at once
+    slices = mosaics.reshape(len(order),tiles,tileRows,tiles,tileColumns)
+    slices = slices.transpose(0,1,3,2,4).reshape(len(order),tiles*tiles,tileRows,tileColumns)
+    pixels = slices[:,:numberOfSlices].transpose(3,2,1,0)
+
+    # The position in the header is that of the whole mosaic
+    position = numpy.array([float(value) for value in datasets[order[0]].ImagePositionPatient])
+    position = (position+rowCosines*columnSpacing*(mosaicColumns-tileColumns)/2.0+
+                columnCosines*rowSpacing*(mosaicRows-tileRows)/2.0)
+    spacing = float(getattr(datasets[0],'SpacingBetweenSlices',0) or
+                    getattr(datasets[0],'SliceThickness',1.0) or 1.0)
+    affine = numpy.eye(4)
+    affine[:3,0] = rowCosines*columnSpacing
+    affine[:3,1] = columnCosines*rowSpacing
+    affine[:3,2] = normal*spacing
+    affine[:3,3] = position
+    return pixels,affine,order
+
+def _pixelArrays(datasets,order):
+    """The pixels of datasets in order, as one array.  Compressed transfer
+    syntaxes pydicom can't decode are left to the external converters."""
+    try:
+        return numpy.array([datasets[index].pixel_array for index in order])
+    except Exception as e:
+        raise UnsupportedSeriesError('Pixel data could not be read: {0}'.format(e))
+
+def writeNrrd(dwi,path,level=6,threads=1):
+    """Write a DwiVolume as a gzip encoded NRRD in LPS space with the
+    DWMRI b-value and gradient keys.  Gradients are scaled so their squared
+    length is the volume's b-value over the largest b-value."""
+    data = dwi.data
+    dtype = numpy.dtype(data.dtype.name)
+    nrrdTypes = {'int16': 'short', 'uint16': 'ushort', 'int32': 'int', 'float32': 'float'}
+    if dtype.name not in nrrdTypes:
+        dtype = numpy.dtype('float32')
+    maxB = max(dwi.bValues.max(),1.0)
+    affine = dwi.affine
+    lines = ['NRRD0005',
+             '# Written by DicomVolume',
+             'type: {0}'.format(nrrdTypes[dtype.name]),
+             'dimension: 4',
+             'space: left-posterior-superior',
+             'sizes: {0} {1} {2} {3}'.format(*data.shape),
+             'space directions: ({0:.10g},{1:.10g},{2:.10g}) ({3:.10g},{4:.10g},{5:.10g}) '
+             '({6:.10g},{7:.10g},{8:.10g}) none'.format(*list(affine[:3,:3].T.flatten())),
+             'kinds: space space space list',
+             'endian: little',
+             'encoding: gzip',
+             'space units: "mm" "mm" "mm"',
+             'space origin: ({0:.10g},{1:.10g},{2:.10g})'.format(*affine[:3,3]),
+             'measurement frame: (1,0,0) (0,1,0) (0,0,1)',
+             'modality:=DWMRI',
+             'DWMRI_b-value:={0:g}'.format(maxB)]
+    for index,(bValue,gradient) in enumerate(zip(dwi.bValues,dwi.gradients)):
+        scaled = gradient*math.sqrt(bValue/maxB)
+        lines.append('DWMRI_gradient_{0:04d}:={1:.10g} {2:.10g} {3:.10g}'.format(index,*scaled))
+    outFile = open(path+'.part','wb')
+    try:
+        outFile.write('\n'.join(lines)+'\n\n')
+        compressed = gzipWriter(outFile,level,threads)
+        try:
+            for volume in range(data.shape[3]):
+                writeSlices(compressed,data[:,:,:,volume],dtype.newbyteorder('<'))
+        finally:
+            compressed.close()
+    finally:
+        outFile.close()
+    os.rename(path+'.part',path)
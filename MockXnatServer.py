@@ -0,0 +1,199 @@
+import re
+import json
+import urllib
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+import xml.etree.ElementTree as ElementTree
+
+XDAT = '{http://nrg.wustl.edu/security}'
+
+class MockXnatServer:
+    """A local stand-in for an xnat server, answering the REST calls
+    XnatRestClient makes from sessions and subjects added with
+    addSession() and addSubject().
+
+    It serves POST /data/search for the xnat:mrSessionData and
+    xnat:mrScanData root elements, the scan listing and scan file listings
+    of a session and the subject listing of a project.  Search results come
+    back the way xnat sends them, with upper case column names and columns
+    that weren't asked for.  Every request is kept in requests as a
+    (method, path) pair.
+    """
+    def __init__(self):
+        self.sessions = {}
+        self.subjects = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    def addSession(self,sessionID,project,subjectID,label,scans,searchable=True,**fields):
+        """Add a session.  scans is a list of dicts with 'ID', 'type' and
+        'quality' keys, optionally 'fieldStrength', 'frames' and 'files',
+        the number of files in their DICOM resource, and 'lastModified'.
+        Scans of a session that isn't searchable are left out of searches,
+        as xnat does for some sessions.  fields sets other search fields of
+        the session, such as LAST_MODIFIED."""
+        session = {'SESSION_ID': sessionID,
+                   'PROJECT': project,
+                   'SUBJECT_ID': subjectID,
+                   'LABEL': label,
+                   'DATE': '',
+                   'FIELDSTRENGTH': '',
+                   'INSERT_DATE': '',
+                   'LAST_MODIFIED': ''}
+        session.update(fields)
+        with self.lock:
+            self.sessions[sessionID] = {'fields': session,'scans': scans,'searchable': searchable}
+
+    def addSubject(self,project,subjectID,label):
+        with self.lock:
+            self.subjects.setdefault(project,{})[subjectID] = label
+
+    def start(self):
+        """Serve on a free local port from a background thread and return
+        the server url."""
+        self.server = _ThreadingServer(('127.0.0.1',0),_Handler)
+        self.server.mock = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def requestCount(self,method,pathPrefix):
+        with self.lock:
+            return len([path for requestMethod,path in self.requests
+                        if requestMethod == method and path.startswith(pathPrefix)])
+
+    def _respond(self,method,path,body):
+        """Return (status, result list) for a request."""
+        with self.lock:
+            self.requests.append((method,path))
+        parsed = urlparse.urlparse(path)
+        parts = [urllib.unquote(part) for part in parsed.path.strip('/').split('/')]
+        if method == 'POST' and parts == ['data','search']:
+            return 200,self.__search(body)
+        if method != 'GET':
+            return 405,None
+        with self.lock:
+            if parts[:2] == ['data','projects'] and len(parts) == 4 and parts[3] == 'subjects':
+                if parts[2] not in self.subjects:
+                    return 404,None
+                return 200,[{'ID': subjectID,'label': label,'project': parts[2]}
+                            for subjectID,label in self.subjects[parts[2]].items()]
+            if parts[:2] != ['data','experiments'] or len(parts) < 4 or parts[3] != 'scans':
+                return 404,None
+            session = self.sessions.get(parts[2])
+            if session is None:
+                return 404,None
+            if len(parts) == 4:
+                return 200,[{'ID': scan['ID'],'type': scan['type'],'quality': scan['quality'],
+                             'xsiType': 'xnat:mrScanData'} for scan in session['scans']]
+            if len(parts) == 8 and parts[5] == 'resources' and parts[7] == 'files':
+                scans = [scan for scan in session['scans'] if parts[4] in ('ALL',scan['ID'])]
+                if parts[4] != 'ALL' and not scans:
+                    return 404,None
+                return 200,[{'Name': '{0}.dcm'.format(number),
+                             'Size': '1024',
+                             'URI': '/data/experiments/{0}/scans/{1}/resources/{2}/files/{3}.dcm'.format(
+                                 parts[2],urllib.quote(scan['ID']),parts[6],number)}
+                            for scan in scans if parts[6] == 'DICOM'
+                            for number in range(scan.get('files',0))]
+        return 404,None
+
+    def __search(self,body):
+        document = ElementTree.fromstring(body)
+        rootElement = document.find(XDAT+'root_element_name').text
+        fields = ['{0}/{1}'.format(field.find(XDAT+'element_name').text,
+                                   field.find(XDAT+'field_ID').text)
+                  for field in document.findall(XDAT+'search_field')]
+        where = document.find(XDAT+'search_where')
+        results = []
+        for row in self.__rows(rootElement):
+            if self.__matches(where,row):
+                result = dict([(field.split('/')[1].upper(),row.get(field,'')) for field in fields])
+                # xnat adds columns of its own
+                result['quarantine_status'] = 'active'
+                results.append(result)
+        return results
+
+    def __rows(self,rootElement):
+        rows = []
+        with self.lock:
+            for session in self.sessions.values():
+                sessionRow = dict([('xnat:mrSessionData/'+key,value)
+                                   for key,value in session['fields'].items()])
+                if rootElement == 'xnat:mrSessionData':
+                    rows.append(sessionRow)
+                elif rootElement == 'xnat:mrScanData' and session['searchable']:
+                    for scan in session['scans']:
+                        row = dict(sessionRow)
+                        row.update({'xnat:mrScanData/IMAGE_SESSION_ID': session['fields']['SESSION_ID'],
+                                    'xnat:mrScanData/ID': scan['ID'],
+                                    'xnat:mrScanData/TYPE': scan['type'],
+                                    'xnat:mrScanData/QUALITY': scan['quality'],
+                                    'xnat:mrScanData/FIELDSTRENGTH': scan.get('fieldStrength',''),
+                                    'xnat:mrScanData/FRAMES': scan.get('frames',''),
+                                    'xnat:mrScanData/LAST_MODIFIED': scan.get('lastModified','')})
+                        rows.append(row)
+        return rows
+
+    def __matches(self,clause,row):
+        matches = []
+        for child in clause:
+            if child.tag == XDAT+'child_set':
+                matches.append(self.__matches(child,row))
+            else:
+                value = row.get(child.find(XDAT+'schema_field').text,'')
+                comparison = child.find(XDAT+'comparison_type').text.upper()
+                wanted = child.find(XDAT+'value').text or ''
+                if comparison == '=':
+                    matches.append(value == wanted)
+                elif comparison == '>=':
+                    matches.append(value >= wanted)
+                elif comparison == 'LIKE':
+                    pattern = '.*'.join([re.escape(piece) for piece in wanted.split('%')])
+                    matches.append(re.match(pattern+'$',value) is not None)
+                else:
+                    raise ValueError('Unsupported comparison '+comparison)
+        if clause.get('method','AND').upper() == 'OR':
+            return any(matches)
+        return all(matches)
+
+class _ThreadingServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    # The connection pool keeps several connections open at once
+    daemon_threads = True
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def __handle(self,method):
+        body = self.rfile.read(int(self.headers.get('Content-Length',0)))
+        try:
+            status,results = self.server.mock._respond(method,self.path,body)
+        except Exception as e:
+            status,results = 500,None
+            self.log_error('%s',e)
+        if results is None:
+            data = ''
+        else:
+            data = json.dumps({'ResultSet': {'Result': results,'totalRecords': str(len(results))}})
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self,format,*args):
+        pass
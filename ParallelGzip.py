@@ -0,0 +1,97 @@
+import time
+import zlib
+import struct
+import logging
+from multiprocessing.pool import ThreadPool
+
+class ParallelGzipFile:
+    """A write-only file object that gzips what is written to it on several
+    threads, the way pigz does.  The data is cut into blocks of blockSize
+    bytes and each block is deflated independently and ended with a sync
+    flush, so the compressed blocks can simply be concatenated.  The result
+    is a single standard gzip member that gzip, zlib and every NIfTI/MGH
+    reader decompress as usual; it is a little larger than what gzip writes
+    at the same level because no block can refer back into the previous one.
+
+    fileobj is either a path or an open binary file, which is left open on
+    close() so a plain text header can come before the compressed data.
+    zlib releases the GIL while it deflates, so the threads run in parallel.
+    """
+    def __init__(self,fileobj,level=6,threads=4,blockSize=131072):
+        self.logger = logging.getLogger('SyncTasks.ParallelGzip')
+        if isinstance(fileobj,basestring):
+            self.fileobj = open(fileobj,'wb')
+            self.ownsFile = True
+        else:
+            self.fileobj = fileobj
+            self.ownsFile = False
+        self.level = level
+        self.blockSize = blockSize
+        self.threads = max(threads,1)
+        self.workers = ThreadPool(self.threads)
+        # Compressed blocks not yet written, in order
+        self.pending = []
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32('')
+        self.size = 0
+        self.closed = False
+        self.fileobj.write('\037\213\010\000'+struct.pack('<I',int(time.time()))+'\002\377')
+
+    def write(self,data):
+        if self.closed:
+            raise ValueError('write() on a closed ParallelGzipFile')
+        if not data:
+            return
+        data = str(data)
+        self.crc = zlib.crc32(data,self.crc)
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.blockSize:
+            data = ''.join(self.buffer)
+            blocks = len(data)//self.blockSize
+            for index in range(blocks):
+                self.__submit(data[index*self.blockSize:(index+1)*self.blockSize])
+            rest = data[blocks*self.blockSize:]
+            self.buffer = rest and [rest] or []
+            self.buffered = len(rest)
+
+    def flush(self):
+        """Compressed data is only written when a block is complete, so this
+        just passes the finished blocks on."""
+        self.__writePending(0)
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffered:
+                self.__submit(''.join(self.buffer))
+                self.buffer = []
+                self.buffered = 0
+            self.__writePending(0)
+            # An empty final block ends the deflate stream
+            self.fileobj.write(zlib.compressobj(self.level,zlib.DEFLATED,-zlib.MAX_WBITS).flush())
+            self.fileobj.write(struct.pack('<II',self.crc & 0xffffffff,self.size & 0xffffffff))
+        finally:
+            self.closed = True
+            self.workers.close()
+            self.workers.join()
+            if self.ownsFile:
+                self.fileobj.close()
+
+    def __submit(self,block):
+        self.pending.append(self.workers.apply_async(_deflateBlock,(block,self.level)))
+        # Keep a couple of blocks per thread in flight, so memory stays bounded
+        self.__writePending(2*self.threads)
+
+    def __writePending(self,keep):
+        while len(self.pending) > keep:
+            self.fileobj.write(self.pending.pop(0).get())
+
+def _deflateBlock(block,level):
+    compressor = zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS)
+    return compressor.compress(block)+compressor.flush(zlib.Z_SYNC_FLUSH)
+
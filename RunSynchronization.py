@@ -1,3 +1,4 @@
+import os
 import sys
 import logging
 import logging.handlers
@@ -14,6 +15,20 @@ from pyxnat import Interface
 
 import SyncNewPredictDataToMRx
 import SyncRPACSToPredict
+from XnatConnectionPool import XnatConnectionPool
+from XnatDownloader import XnatDownloader
+from ConversionScheduler import ConversionScheduler
+from SyncCache import SyncCache
+from SyncState import SyncState
+from DicomCache import DicomCache
+from StagingManager import StagingManager
+from XnatRestClient import XnatRestClient
+from SyncOrchestrator import SyncOrchestrator
+from WorkQueue import WorkQueue
+from TimeBudget import TimeBudget
+from SyncPlan import SyncPlan
+from DicomAnonymizer import DicomAnonymizer
+from DicomUploader import DicomUploader
 
 def setup_email_logging_handler(smtp_host, sync_from_address, to_email_list, email_subject, formatter,
                                 email_log_level):
@@ -28,6 +43,13 @@ def setup_email_logging_handler(smtp_host, sync_from_address, to_email_list, ema
 
     return email_handler
 
+def get_config_option(config, section, option, default):
+    """ Return the option from config, or default if it isn't set.  Used for
+        options added after existing config files were written. """
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
 
 if __name__ == "__main__":
     # Create and parse input arguments
@@ -42,6 +64,23 @@ if __name__ == "__main__":
                         default=False,
                         help='Include this flag to be prompted to update the'+
                         'password.')
+    parser.add_argument('--releaseQuarantine', action="store_true", dest='release_quarantine',
+                        required=False, default=False,
+                        help='Try the quarantined sessions and series again.')
+    parser.add_argument('--deadline', action="store", dest='deadline', required=False,
+                        help='When the run has to be done by, as HH:MM or YYYY-MM-DD HH:MM.  Newer '+
+                        'sessions and cheaper series go first, and nothing is started that '+
+                        'previous runs say would not be done in time.')
+    parser.add_argument('--timeBudget', '--time-budget', action="store", dest='time_budget',
+                        type=float, required=False,
+                        help='How many minutes the run may take, like --deadline.')
+    plan_group = parser.add_mutually_exclusive_group()
+    plan_group.add_argument('--plan', action="store", dest='plan_file', required=False,
+                            help='Only work out what the run would copy, download and convert, with '+
+                            'estimates from previous runs, and write it to this JSON file.')
+    plan_group.add_argument('--executePlan', action="store", dest='execute_plan_file', required=False,
+                            help='Do what a plan written with --plan lists, without searching for '+
+                            'new sessions.')
     input_arguments = parser.parse_args()
 
     # Need to parse config file
@@ -79,6 +118,18 @@ if __name__ == "__main__":
     summary_text = 'Synchronization successfull!'
 
     sshTunnel = None
+    study_params_cache = None
+    echo_cache = None
+    acquisition_cache = None
+    sync_state = None
+    dicom_cache = None
+    staging = None
+    rpacs_rest = None
+    predict_rest = None
+    work_queue = None
+    time_budget = None
+    anonymizer = None
+    uploader = None
     xnat_predict = None
     xnat_rpacs = None
     try:
@@ -131,16 +182,70 @@ if __name__ == "__main__":
         # RpacsToPredict config parameters
         rpacs_projects = config.get('RpacsToPredict','RpacsProjects')
         predict_projects = config.get('RpacsToPredict','PredictProjects')
+        concurrent_projects = int(get_config_option(config, 'RpacsToPredict', 'ConcurrentProjects', 2))
+        archive_poll_seconds = int(get_config_option(config, 'RpacsToPredict', 'ArchivePollSeconds', 60))
+        archive_wait_minutes = int(get_config_option(config, 'RpacsToPredict', 'ArchiveWaitMinutes', 60))
 
         # DicomRemap config parameters
         dicom_remap_command = config.get('DicomRemap','REMAPCOMMAND')
         base_anon = config.get('DicomRemap','BASEANON')
+        anon_engine = get_config_option(config, 'DicomRemap', 'Engine', 'dicomremap')
+        anon_workers = int(get_config_option(config, 'DicomRemap', 'AnonymizerWorkers', 4))
 
         # Misc config parameters
         destination_base = config.get('Misc','DestinationBase')
         white_list_file_w_path = config.get('Misc','WhiteListPath')
         new_scan_interval = config.get('Misc', 'NewScanInterval')
         ssh_username = config.get('Misc', 'SSHUsername')
+        state_dir = get_config_option(config, 'Misc', 'StateDir', None)
+        change_detection = get_config_option(config, 'Misc', 'ChangeDetection', 'window')
+        full_reconcile_days = int(get_config_option(config, 'Misc', 'FullReconcileDays', 7))
+        max_attempts = int(get_config_option(config, 'Misc', 'MaxAttempts', 3))
+        resume_hours = float(get_config_option(config, 'Misc', 'ResumeHours', 24))
+
+        # DicomCache config parameters
+        dicom_cache_dir = get_config_option(config, 'DicomCache', 'Path', None)
+        dicom_cache_gigabytes = float(get_config_option(config, 'DicomCache', 'MaxGigabytes', 20))
+
+        # Staging config parameters
+        staging_dir = get_config_option(config, 'Staging', 'Path', None)
+        staging_gigabytes = float(get_config_option(config, 'Staging', 'MaxGigabytes', 0))
+        staging_memory_dir = get_config_option(config, 'Staging', 'MemoryPath', None)
+        staging_memory_gigabytes = float(get_config_option(config, 'Staging', 'MemoryMaxGigabytes', 2))
+        staging_memory_series_megabytes = float(get_config_option(config, 'Staging',
+                                                                  'MemorySeriesMegabytes', 300))
+
+        # WorkQueue config parameters
+        work_queue_path = get_config_option(config, 'WorkQueue', 'Path', None)
+        work_queue_lease_minutes = float(get_config_option(config, 'WorkQueue', 'LeaseMinutes', 10))
+        work_queue_hold_hours = float(get_config_option(config, 'WorkQueue', 'HoldHours', 12))
+
+        # Upload config parameters
+        upload_target = get_config_option(config, 'Upload', 'Target', predict_dicom_scp)
+        upload_concurrency = int(get_config_option(config, 'Upload', 'Concurrency', 4))
+        upload_retries = int(get_config_option(config, 'Upload', 'Retries', 1))
+
+        # Download config parameters
+        download_concurrency = int(get_config_option(config, 'Download', 'Concurrency', 8))
+        per_host_connections = int(get_config_option(config, 'Download', 'PerHostConnections', 4))
+        download_mode = get_config_option(config, 'Download', 'Mode', 'files')
+        prefetch_depth = int(get_config_option(config, 'Download', 'PrefetchDepth', 2))
+        lookup_workers = int(get_config_option(config, 'Download', 'LookupWorkers', 8))
+
+        # Conversion config parameters
+        max_conversion_jobs = int(get_config_option(config, 'Conversion', 'MaxJobs', 1))
+        conversion_engine = get_config_option(config, 'Conversion', 'Engine', 'tools')
+        compression_level = int(get_config_option(config, 'Conversion', 'CompressionLevel', 6))
+        compression_threads = int(get_config_option(config, 'Conversion', 'CompressionThreads', 1))
+        converter_limits = {
+            'ConvertBetweenFileFormats': get_config_option(config, 'Conversion',
+                                                           'ConvertBetweenFileFormatsJobs',
+                                                           max_conversion_jobs),
+            'DicomToNrrdConverter': get_config_option(config, 'Conversion',
+                                                      'DicomToNrrdConverterJobs',
+                                                      max_conversion_jobs),
+            'mri_convert': get_config_option(config, 'Conversion', 'MriConvertJobs',
+                                             max_conversion_jobs)}
 
         # Update the password in the keyring
         if (input_arguments.set_password):
@@ -164,9 +269,54 @@ if __name__ == "__main__":
                                password=rpacs_password,
                                cachedir=rpacs_cache)
 
-        # setup ssh tunnel.  Requires ssh keys for this user
-        sshTunnel = subprocess.Popen(["ssh","-N", "-L",
-                                      "25901:localhost:5432",ssh_username+"@xnat.predict-hd.net"])
+        # setup ssh tunnel.  Requires ssh keys for this user.  Planning only
+        # searches, so it needs neither the tunnel nor the work queue.
+        planning = bool(input_arguments.plan_file)
+        if not planning:
+            sshTunnel = subprocess.Popen(["ssh","-N", "-L",
+                                          "25901:localhost:5432",ssh_username+"@xnat.predict-hd.net"])
+
+        # Both sync classes share one downloader so the limits hold for the whole run
+        connection_pool = XnatConnectionPool(per_host_connections)
+        downloader = XnatDownloader(connection_pool, download_concurrency, download_mode)
+        rpacs_rest = XnatRestClient.forInterface(xnat_rpacs, connection_pool, lookup_workers)
+        predict_rest = XnatRestClient.forInterface(xnat_predict, connection_pool, lookup_workers)
+
+        # Lookups kept between runs.  Without a StateDir they last one run.
+        if state_dir:
+            if not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+            study_params_cache = SyncCache(os.path.join(state_dir, 'rpacsStudyParams'))
+            echo_cache = SyncCache(os.path.join(state_dir, 'echoNumbers'))
+            acquisition_cache = SyncCache(os.path.join(state_dir, 'acquisitionParameters'))
+            sync_state = SyncState(os.path.join(state_dir, 'syncState.db'), max_attempts)
+            if input_arguments.release_quarantine:
+                logger.info("Released {0} quarantined items.".format(sync_state.releaseQuarantine()))
+        elif change_detection == 'delta':
+            logger.warning("ChangeDetection=delta without a StateDir reconciles every session on every run")
+
+        time_budget = TimeBudget.fromArguments(input_arguments.deadline, input_arguments.time_budget,
+                                               sync_state)
+        if time_budget.isLimited():
+            logger.info("Running for at most {0:.0f} minutes.".format(time_budget.remaining() / 60))
+
+        # Several hosts may run the sync at once and share out the work
+        if work_queue_path and not planning:
+            work_queue = WorkQueue(work_queue_path,
+                                   leaseSeconds=work_queue_lease_minutes*60,
+                                   holdSeconds=work_queue_hold_hours*3600)
+        if dicom_cache_dir:
+            dicom_cache = DicomCache(dicom_cache_dir, int(dicom_cache_gigabytes * 1024 ** 3))
+        # Both sync classes stage their downloads within the same budget
+        staging = StagingManager(staging_dir, staging_gigabytes and int(staging_gigabytes * 1024 ** 3) or None,
+                                 staging_memory_dir, int(staging_memory_gigabytes * 1024 ** 3),
+                                 int(staging_memory_series_megabytes * 1024 ** 2))
+
+        if anon_engine == 'python':
+            anonymizer = DicomAnonymizer(anon_workers)
+        uploader = DicomUploader(dicom_remap_command, upload_target, upload_concurrency,
+                                 upload_retries, connection_pool, predict_username,
+                                 predict_password)
 
         todays_date = datetime.datetime.now()
         target_date = todays_date - datetime.timedelta(int(new_scan_interval))
@@ -176,14 +326,21 @@ if __name__ == "__main__":
                                                      dicom_remap_command,
                                                      base_anon,
                                                      predict_dicom_scp,
-                                                     inserted_after)
-
-        for rpacs_project_name,predict_project_name in zip(rpacs_projects.split(','), 
-                                                           predict_projects.split(',')):
-            sync.syncOneRpacsProjectToPredict(rpacs_project_name,
-                                              predict_project_name)
-            #pass
-
+                                                     inserted_after,
+                                                     downloader,
+                                                     study_params_cache,
+                                                     syncState=sync_state,
+                                                     changeDetection=change_detection,
+                                                     fullReconcileDays=full_reconcile_days,
+                                                     dicomCache=dicom_cache,
+                                                     anonymizer=anonymizer,
+                                                     uploader=uploader,
+                                                     staging=staging,
+                                                     rpacsRestClient=rpacs_rest,
+                                                     predictRestClient=predict_rest,
+                                                     workQueue=work_queue,
+                                                     resumeHours=resume_hours,
+                                                     timeBudget=time_budget)
 
         syncData = SyncNewPredictDataToMRx.SyncNewPredictDataToMRx(xnat_predict,predict_cache,
                                                                    white_list_file_w_path,
@@ -191,15 +348,82 @@ if __name__ == "__main__":
                                                                    inserted_after,
                                                                    mri_convert_w_path,
                                                                    convert_between_file_formats_w_path,
-                                                                   dicom_to_nrrd_converter_w_path)
-
-        syncData.syncAllSessions()
+                                                                   dicom_to_nrrd_converter_w_path,
+                                                                   downloader,
+                                                                   prefetch_depth,
+                                                                   ConversionScheduler(max_conversion_jobs,
+                                                                                       converter_limits),
+                                                                   echo_cache,
+                                                                   syncState=sync_state,
+                                                                   changeDetection=change_detection,
+                                                                   fullReconcileDays=full_reconcile_days,
+                                                                   dicomCache=sync.dicomCache,
+                                                                   conversionEngine=conversion_engine,
+                                                                   acquisitionCache=acquisition_cache,
+                                                                   compressionLevel=compression_level,
+                                                                   compressionThreads=compression_threads,
+                                                                   staging=staging,
+                                                                   restClient=predict_rest,
+                                                                   workQueue=work_queue,
+                                                                   resumeHours=resume_hours,
+                                                                   timeBudget=time_budget)
+
+        orchestrator = SyncOrchestrator(sync,syncData,
+                                        maxConcurrentProjects=concurrent_projects,
+                                        pollSeconds=archive_poll_seconds,
+                                        archiveWaitMinutes=archive_wait_minutes,
+                                        timeBudget=time_budget)
+        project_pairs = zip(rpacs_projects.split(','),predict_projects.split(','))
+        plan = None
+        if input_arguments.execute_plan_file:
+            plan = SyncPlan.read(input_arguments.execute_plan_file)
+            logger.info(plan.report())
+        # A stage that fails is reported, but the next one still runs
+        failed_stages = []
+        if planning:
+            plan = SyncPlan(sync.planProjectPairs(project_pairs), syncData.planAllSessions())
+            plan.write(input_arguments.plan_file)
+            summary_text = 'Synchronization planned, nothing was synced.\n\n' + plan.report()
+        else:
+            try:
+                if plan is not None:
+                    orchestrator.run(plan.projectPairs(), plan.plannedSessions())
+                else:
+                    orchestrator.run(project_pairs)
+            except Exception:
+                logger.critical("Syncing rpacs to predict failed.",exc_info=True)
+                failed_stages.append('rpacs to predict')
+
+            try:
+                if plan is not None:
+                    syncData.executePlan(plan.mrxSessions)
+                else:
+                    syncData.syncAllSessions()
+            except Exception:
+                logger.critical("Syncing predict to MRx failed.",exc_info=True)
+                failed_stages.append('predict to MRx')
+
+        if failed_stages:
+            summary_text = 'Synchronization FAILED! ({0} failed)'.format(', '.join(failed_stages))
+            summary_email_subject = "FAILED - %s" % (summary_email_subject)
 
     except Exception, excep:
         logger.critical("something raised an exception: " + str(excep),exc_info=True)
         summary_text = 'Synchronization FAILED!'
         summary_email_subject = "FAILED - %s" % (summary_email_subject)
 
+    if time_budget and time_budget.deferredCount():
+        logger.info(time_budget.report())
+        summary_text += '\n\n' + time_budget.report()
+
+    if sync_state:
+        quarantined = sync_state.quarantined()
+        if quarantined:
+            summary_text += ('\n\n{0} sessions or series failed {1} times and are quarantined. '
+                             'Run with --releaseQuarantine to try them again:\n'.format(len(quarantined),
+                                                                                     max_attempts))
+            summary_text += '\n'.join(['{item} ({updated}): {error}'.format(**entry) for entry in quarantined])
+
     # Generate summary email message
     if summary_email_list:
         summary_message = MIMEText(summary_text, 'plain')  
@@ -216,3 +440,25 @@ if __name__ == "__main__":
         xnat_predict.cache.clear()
     if xnat_rpacs:
         xnat_rpacs.cache.clear()
+    if study_params_cache:
+        study_params_cache.close()
+    if echo_cache:
+        echo_cache.close()
+    if acquisition_cache:
+        acquisition_cache.close()
+    if sync_state:
+        sync_state.close()
+    if dicom_cache:
+        dicom_cache.close()
+    if work_queue:
+        work_queue.close()
+    if staging:
+        staging.close()
+    if rpacs_rest:
+        rpacs_rest.close()
+    if predict_rest:
+        predict_rest.close()
+    if anonymizer:
+        anonymizer.close()
+    if uploader:
+        uploader.close()
@@ -0,0 +1,214 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+class StagingManager:
+    """Hands out the temporary directories series are downloaded into and
+    keeps count of the bytes in each, so the staging area stays within
+    maxBytes without ever scanning it.
+
+    A directory is active from allocate() until it is released or
+    completed.  release() deletes it.  complete() keeps it under a key, so
+    reuse() can hand it out again, until the space is needed, least
+    recently completed first, and at most maxCompleted of them are kept,
+    so they can't pile up when there is no byte budget.  When the active
+    and completed directories hold maxBytes or more, allocate() first
+    evicts completed ones and then blocks until another thread releases or
+    completes a directory.  It never waits when nothing else is active, so
+    a single series larger than the budget still goes through.  maxBytes
+    of None means no limit.
+
+    With a memoryRoot, normally a directory on tmpfs such as /dev/shm,
+    directories are handed out there while fewer than memoryMaxBytes are
+    in use and there is room for one more series of memorySeriesBytes.
+    Once filled, settle() moves a directory to root if it holds more than
+    memorySeriesBytes, or if the memory area is over memoryMaxBytes.  So
+    small series are never written to disk and large ones only take up
+    memory while they download.  Directories in memory don't count towards
+    maxBytes, and are moved to root when completed.  Safe to share
+    between threads.
+    """
+    def __init__(self,root=None,maxBytes=None,memoryRoot=None,memoryMaxBytes=0,
+                 memorySeriesBytes=0,maxCompleted=8):
+        self.logger = logging.getLogger('SyncTasks.StagingManager')
+        self.root = root
+        if root is not None and not os.path.isdir(root):
+            os.makedirs(root)
+        self.maxBytes = maxBytes
+        self.maxCompleted = maxCompleted
+        self.memoryRoot = memoryRoot
+        if memoryRoot is not None and not os.path.isdir(memoryRoot):
+            os.makedirs(memoryRoot)
+        self.memoryMaxBytes = memoryMaxBytes
+        self.memorySeriesBytes = memorySeriesBytes
+        # Active directories under memoryRoot
+        self.inMemory = set()
+        self.condition = threading.Condition()
+        # path -> bytes, for directories in use
+        self.active = {}
+        # key -> (path, bytes, completed time), for finished directories kept for reuse
+        self.completed = {}
+        self.waits = 0
+
+    def allocate(self,label=''):
+        """Create and return a new, empty staging directory.  Blocks while
+        the staging area is full and other directories are in use."""
+        with self.condition:
+            self.__evict(self.maxBytes)
+            waiting = False
+            while not self.__memoryRoom() and self.__full() and self.active:
+                if not waiting:
+                    waiting = True
+                    self.waits += 1
+                    self.logger.info('Staging area full ({0} of {1} bytes), waiting to stage {2}'.format(
+                        self.__usedBytes(),self.maxBytes,label))
+                self.condition.wait(5)
+                self.__evict(self.maxBytes)
+            if self.__memoryRoom():
+                path = tempfile.mkdtemp(prefix='staging-',dir=self.memoryRoot)
+                self.inMemory.add(path)
+            else:
+                path = tempfile.mkdtemp(prefix='staging-',dir=self.root)
+            self.active[path] = 0
+        return path
+
+    def settle(self,path):
+        """Call once the staging directory path has been filled and
+        charged or measured.  Moves it from memory to root when it is too
+        big to stay there, and returns where it is now."""
+        with self.condition:
+            if path not in self.inMemory:
+                return path
+            if (self.active[path] <= self.memorySeriesBytes and
+                self.__memoryBytes() <= self.memoryMaxBytes):
+                return path
+        return self.__spill(path)
+
+    def isInMemory(self,path):
+        with self.condition:
+            return path in self.inMemory
+
+    def charge(self,path,byteCount):
+        """Count byteCount more bytes as written to the staging directory path."""
+        with self.condition:
+            self.active[path] = self.active.get(path,0)+byteCount
+
+    def measure(self,path):
+        """Recount the bytes in the staging directory path from its files
+        and return them.  Only path itself is walked."""
+        total = 0
+        for dirPath,dirNames,fileNames in os.walk(path):
+            for name in fileNames:
+                filePath = os.path.join(dirPath,name)
+                if not os.path.islink(filePath):
+                    total += os.path.getsize(filePath)
+        with self.condition:
+            if path in self.active:
+                self.active[path] = total
+        return total
+
+    def release(self,path):
+        """Delete the staging directory path."""
+        with self.condition:
+            self.active.pop(path,None)
+            self.inMemory.discard(path)
+            self.condition.notify_all()
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def complete(self,path,key):
+        """Keep the staging directory path, no longer in use, for reuse(key)
+        until the space is needed."""
+        if self.isInMemory(path):
+            path = self.__spill(path)
+        with self.condition:
+            byteCount = self.active.pop(path,0)
+            if key in self.completed:
+                self.__remove(key)
+            self.completed[key] = (path,byteCount,time.time())
+            self.__evict(self.maxBytes)
+            self.condition.notify_all()
+
+    def reuse(self,key):
+        """Return the completed staging directory kept under key, in use
+        again, or None if there isn't one."""
+        with self.condition:
+            if key not in self.completed:
+                return None
+            path,byteCount,completedAt = self.completed.pop(key)
+            self.active[path] = byteCount
+        self.logger.debug('Reusing staged {0}'.format(key))
+        return path
+
+    def usage(self):
+        """Return the current state of the staging area as a dict."""
+        with self.condition:
+            usage = {'activeDirs': len(self.active),
+                     'activeBytes': sum(self.active.values()),
+                     'completedDirs': len(self.completed),
+                     'completedBytes': sum([entry[1] for entry in self.completed.values()]),
+                     'memoryDirs': len(self.inMemory),
+                     'memoryBytes': self.__memoryBytes(),
+                     'maxBytes': self.maxBytes,
+                     'waits': self.waits}
+        diskObj = os.statvfs(self.root or tempfile.gettempdir())
+        usage['freeBytes'] = diskObj.f_bsize*diskObj.f_bavail
+        return usage
+
+    def close(self):
+        """Delete the completed directories.  Active ones belong to their users."""
+        with self.condition:
+            self.__evict(0)
+
+    def __usedBytes(self):
+        """Bytes staged under root."""
+        diskBytes = sum([byteCount for path,byteCount in self.active.items()
+                         if path not in self.inMemory])
+        return diskBytes+sum([entry[1] for entry in self.completed.values()])
+
+    def __memoryBytes(self):
+        return sum([self.active[path] for path in self.inMemory])
+
+    def __memoryRoom(self):
+        """Whether another series fits in memory.  Every directory there
+        counts as at least memorySeriesBytes, since it may still be
+        filling."""
+        if self.memoryRoot is None:
+            return False
+        reserved = sum([max(self.active[path],self.memorySeriesBytes) for path in self.inMemory])
+        return reserved+self.memorySeriesBytes <= self.memoryMaxBytes
+
+    def __spill(self,path):
+        """Move the active directory path from memory to root and return
+        its new path."""
+        newPath = tempfile.mkdtemp(prefix='staging-',dir=self.root)
+        self.logger.debug('Moving {0} out of memory to {1}'.format(path,newPath))
+        for name in os.listdir(path):
+            shutil.move(os.path.join(path,name),os.path.join(newPath,name))
+        os.rmdir(path)
+        with self.condition:
+            self.active[newPath] = self.active.pop(path)
+            self.inMemory.discard(path)
+            self.condition.notify_all()
+        return newPath
+
+    def __full(self):
+        return self.maxBytes is not None and self.__usedBytes() >= self.maxBytes
+
+    def __evict(self,maxBytes):
+        """Delete completed directories, oldest first, until at most
+        maxBytes are staged and maxCompleted are kept.  Called with the
+        condition held."""
+        while self.completed and (len(self.completed) > self.maxCompleted or
+                                  (maxBytes is not None and self.__usedBytes() >= maxBytes)):
+            key = min(self.completed.keys(),key=lambda key: self.completed[key][2])
+            self.logger.debug('Evicting staged {0}'.format(key))
+            self.__remove(key)
+
+    def __remove(self,key):
+        path = self.completed.pop(key)[0]
+        if os.path.exists(path):
+            shutil.rmtree(path)
@@ -0,0 +1,41 @@
+import shelve
+import logging
+import threading
+
+class SyncCache:
+    """A small persistent key/value store for values that are expensive to
+    look up and never change once known, such as the study parameters of a
+    session.  Backed by a shelve file at path, or kept in memory only when
+    path is None.  Safe to share between threads.
+    """
+    def __init__(self,path=None):
+        self.logger = logging.getLogger('SyncTasks.SyncCache')
+        self.path = path
+        self.lock = threading.Lock()
+        if path is None:
+            self.store = {}
+        else:
+            self.logger.debug('Opening cache {0}'.format(path))
+            self.store = shelve.open(path)
+
+    def get(self,key,default=None):
+        with self.lock:
+            return self.store.get(str(key),default)
+
+    def set(self,key,value):
+        with self.lock:
+            self.store[str(key)] = value
+
+    def __contains__(self,key):
+        with self.lock:
+            return str(key) in self.store
+
+    def sync(self):
+        with self.lock:
+            if self.path is not None:
+                self.store.sync()
+
+    def close(self):
+        with self.lock:
+            if self.path is not None:
+                self.store.close()
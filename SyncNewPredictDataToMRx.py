@@ -6,22 +6,75 @@ import subprocess
 import tempfile
 import shutil
 import re
+import errno
 import dicom
-import glob,datetime,stat,logging
+import glob,datetime,time,stat,logging,hashlib,gzip
 import httplib2
-from time import localtime
+import SyncPipeline
+from ConversionScheduler import ConversionScheduler
+from SyncCache import SyncCache
+from SyncState import SyncState
+from StagingManager import StagingManager
+from TimeBudget import TimeBudget
+import DicomHeaders
+from multiprocessing.pool import ThreadPool
 from pyxnat import Interface
+from XnatDownloader import XnatDownloader
+from XnatRestClient import XnatRestClient
 try:
-  sys.path.append('/paulsen/PREDICT_ORIG_DATA/bin')
-  import phdUtils
-except:
-  print "Error: Module 'phdUtils' not found."
-  sys.exit(1)
+  # The native converter needs numpy
+  import DicomVolume
+except ImportError:
+  DicomVolume = None
+sys.path.append('/paulsen/PREDICT_ORIG_DATA/bin')
+import phdUtils
+
+# The fields of the session searches, as the sync loop reads them
+SESSION_FIELDS = ['xnat:mrSessionData/SESSION_ID',
+                  'xnat:mrSessionData/SUBJECT_ID',
+                  'xnat:mrSessionData/PROJECT',
+                  'xnat:mrSessionData/LABEL',
+                  'xnat:mrSessionData/DATE',
+                  'xnat:mrSessionData/FIELDSTRENGTH']
+
+class ConversionError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+def seriesSortKey(seriesNumber):
+    """ Sort numeric series numbers numerically, ahead of any others. """
+    if seriesNumber.isdigit():
+        return (0,int(seriesNumber),seriesNumber)
+    return (1,0,seriesNumber)
+
+def describeOutputs(newDir,seriesNumber):
+    """ Return the path, size and md5 of every converted file of a series. """
+    outputs = []
+    for extension in ['nii.gz','nrrd','mgz']:
+        for path in sorted(glob.glob(newDir+'/*_'+seriesNumber+'.'+extension)):
+            md5 = hashlib.md5()
+            outputFile = open(path,'rb')
+            try:
+                for block in iter(lambda: outputFile.read(1048576),''):
+                    md5.update(block)
+            finally:
+                outputFile.close()
+            outputs.append({'path': path,
+                            'size': os.path.getsize(path),
+                            'md5': md5.hexdigest()})
+    return outputs
 
 class SyncNewPredictDataToMRx():
     def __init__(self,xnat,xnatCacheDir,whiteListFileName,
                  destinationBase,insertedAfter,mriConvertPath,
-                 convertBetweenFormatsPath,dicomToNrrdPath):
+                 convertBetweenFormatsPath,dicomToNrrdPath,downloader=None,
+                 prefetchDepth=2,scheduler=None,echoCache=None,headerWorkers=4,
+                 syncState=None,changeDetection='window',fullReconcileDays=7,
+                 dicomCache=None,conversionEngine='tools',acquisitionCache=None,
+                 compressionLevel=6,compressionThreads=1,staging=None,restClient=None,
+                 workQueue=None,resumeHours=24,timeBudget=None):
         self.logger = logging.getLogger('SyncTasks.SyncNewPredictDataToMRx')
         self.logger.info('Creating an instance of syncRPACStoPredict')
         self.xnat = xnat
@@ -31,24 +84,83 @@ class SyncNewPredictDataToMRx():
         self.mriConvertPath = mriConvertPath
         self.convertBetweenFormatsPath = convertBetweenFormatsPath
         self.dicomToNrrdPath = dicomToNrrdPath
+        if downloader is None:
+            downloader = XnatDownloader()
+        self.downloader = downloader
+        # Number of downloaded series allowed to wait for conversion
+        self.prefetchDepth = prefetchDepth
+        if scheduler is None:
+            scheduler = ConversionScheduler()
+        self.scheduler = scheduler
+        # EchoNumbers of PD/T2 slices keyed by session and series number
+        if echoCache is None:
+            echoCache = SyncCache()
+        self.echoCache = echoCache
+        # TE, TR, TI and flip angle keyed by session and series number
+        if acquisitionCache is None:
+            acquisitionCache = SyncCache()
+        self.acquisitionCache = acquisitionCache
+        self.headerWorkers = ThreadPool(headerWorkers)
+        # What earlier runs already converted
+        if syncState is None:
+            syncState = SyncState()
+        self.syncState = syncState
+        # 'window' looks at sessions inserted after insertedAfter, 'delta' at
+        # sessions inserted or modified since the last successful run.
+        self.changeDetection = changeDetection
+        self.fullReconcileDays = fullReconcileDays
+        # Series left behind by the rpacs sync, used instead of downloading
+        self.dicomCache = dicomCache
+        # 'native' converts structural series in-process, 'tools' always
+        # uses the external converters.
+        if conversionEngine == 'native' and DicomVolume is None:
+            self.logger.warn("The native converter needs numpy, using the external converters.")
+            conversionEngine = 'tools'
+        self.conversionEngine = conversionEngine
+        # gzip level and threads per file for the natively written outputs
+        self.compressionLevel = compressionLevel
+        self.compressionThreads = compressionThreads
+        # Where series are downloaded to, within a byte budget
+        if staging is None:
+            staging = StagingManager()
+        self.staging = staging
+        # Session, scan and subject lookups and attribute writes go over
+        # REST, so many sessions can be looked up at once
+        if restClient is None:
+            restClient = XnatRestClient.forInterface(xnat,self.downloader.connectionPool)
+        self.restClient = restClient
+        # Shared with other hosts running the sync, so each series is only
+        # converted by one of them.  None when this host works alone.
+        self.workQueue = workQueue
+        # How old the checkpoints of an interrupted run may be to resume it
+        self.resumeHours = resumeHours
+        # With a deadline, newer sessions and cheaper series go first and
+        # no series is started that wouldn't be done in time
+        if timeBudget is None:
+            timeBudget = TimeBudget()
+        self.timeBudget = timeBudget
         # Read in the scan type white list
         whiteListFile = open(whiteListFileName, 'r')
         self.whiteList = {}
         for line in whiteListFile:
             self.whiteList[line.rstrip('\r\n')] = 1;
 
-    def __getScanTypeFromXnat(self,projectLabel,scanID,seriesNumber,subjID):
-        scanType = ''
-        scanObj=self.xnat.select.project(projectLabel).subject(subjID).experiment(scanID).scan(seriesNumber)
-        scanType = scanObj.attrs.get('type')
-        return scanType
-
     def __convertDicomToNrrd(self,dicomDir,convertedFileNameWithPath,seriesNumber):
         nrrdList = glob.glob(os.path.dirname(convertedFileNameWithPath)+'/*_'+seriesNumber+'.nrrd')
         if os.path.exists(convertedFileNameWithPath) or len(nrrdList) > 0:
             self.logger.info(convertedFileNameWithPath+" already exists, no conversion needed.")
             numVols = re.search("DWI-(\d+)",convertedFileNameWithPath).group(1)
             return numVols
+        if self.conversionEngine == 'native':
+            try:
+                dwi = DicomVolume.readDwiSeries(dicomDir)
+            except DicomVolume.UnsupportedSeriesError as e:
+                self.logger.info("Using DicomToNrrdConverter for {0}: {1}".format(dicomDir,e))
+            else:
+                self.logger.info("Writing "+convertedFileNameWithPath+" with the native converter")
+                DicomVolume.writeNrrd(dwi,convertedFileNameWithPath,self.compressionLevel,
+                                      self.compressionThreads)
+                return str(dwi.numberOfVolumes())
         #commandList = ["/scratch/msscully/development/DicomToNrrd/StandAloneDicomToNrrdConverter-build/bin/DicomToNrrdConverter"]
         commandList = [self.dicomToNrrdPath]
         commandList.append("--inputDicomDirectory")
@@ -62,7 +174,8 @@ class SyncNewPredictDataToMRx():
         my_env = os.environ
         my_env['FREESURFER_HOME']='/opt/freesurfer'
         #output = phdUtils.check_output(commandList,stderr=sys.stdout,env=my_env)
-        output = phdUtils.check_output(commandList,env=my_env)
+        with self.scheduler.toolSlot('DicomToNrrdConverter'):
+            output = phdUtils.check_output(commandList,env=my_env)
         self.logger.info(output)
 
         searchMatch = re.search("Number of usable volumes\: (\d+)",output)
@@ -70,18 +183,34 @@ class SyncNewPredictDataToMRx():
             numberVolumes = searchMatch.group(1)
             return numberVolumes
         else:
-            #TODO Decide if this is really an error and handle it more gracefully
-            self.logger.warn("Couldn't find number of volumes. Error?")
-            exit(1)
+            raise ConversionError("DicomToNrrdConverter didn't report the number of volumes of "+
+                                  convertedFileNameWithPath)
 
-    def __updateDWIScanTypeInXnat(self,projectLabel,scanID,seriesNumber,newScanType):
-        self.xnat.select.project(projectLabel).subjects().experiment(scanID).scans(seriesNumber).get(1)[0].attrs.set('type',newScanType)
-        self.xnat.select.project(projectLabel).subjects().experiment(scanID).scans(seriesNumber).get(1)[0].attrs.set('corrected_type',newScanType)
+    def __updateDWIScanTypeInXnat(self,sessionID,seriesNumber,newScanType):
+        self.restClient.setAttributes('/data/experiments/{0}/scans/{1}'.format(sessionID,seriesNumber),
+                                      'xnat:mrScanData',
+                                      [('type',newScanType),('corrected_type',newScanType)])
 
-    def __convertDicomToMGZ(self,dicomDir,convertedFileNameWithPath):
+    def __readNativeVolume(self,dicomDir):
+        """ Return the series in dicomDir as a DicomVolume, or None if the
+            native converter is off or can't handle the series. """
+        if self.conversionEngine != 'native':
+            return None
+        try:
+            return DicomVolume.readSeries(dicomDir)
+        except DicomVolume.UnsupportedSeriesError as e:
+            self.logger.info("Using the external converters for {0}: {1}".format(dicomDir,e))
+            return None
+
+    def __convertDicomToMGZ(self,dicomDir,convertedFileNameWithPath,volume=None):
         if os.path.exists(convertedFileNameWithPath):
             self.logger.info(convertedFileNameWithPath+" already exists, no conversion needed.")
             return
+        if volume is not None:
+            self.logger.info("Writing "+convertedFileNameWithPath+" with the native converter")
+            DicomVolume.writeMgz(volume,convertedFileNameWithPath,self.compressionLevel,
+                                 self.compressionThreads)
+            return
         #commandList = ["/opt/freesurfer/bin/mri_convert"]
         commandList = [self.mriConvertPath]
         commandList.append("-it")
@@ -93,14 +222,22 @@ class SyncNewPredictDataToMRx():
         my_env = os.environ
         my_env['FREESURFER_HOME']='/opt/freesurfer'
         try:
-            self.logger.info(phdUtils.check_output(commandList,stderr=sys.stdout,env=my_env))
+            with self.scheduler.toolSlot('mri_convert'):
+                self.logger.info(phdUtils.check_output(commandList,stderr=sys.stdout,env=my_env))
         except subprocess.CalledProcessError as e:
             self.logger.warn("mri_convert threw an exception." + str(e),exc_info=True)
 
-    def __convertDicomToNifti(self,dicomDir,convertedFileNameWithPath):
+    def __convertDicomToNifti(self,dicomDir,convertedFileNameWithPath,volume=None):
         if os.path.exists(convertedFileNameWithPath):
             self.logger.info(convertedFileNameWithPath+" already exists, no conversion needed.")
             return
+        if volume is None:
+            volume = self.__readNativeVolume(dicomDir)
+        if volume is not None:
+            self.logger.info("Writing "+convertedFileNameWithPath+" with the native converter")
+            DicomVolume.writeNifti(volume,convertedFileNameWithPath,self.compressionLevel,
+                                   self.compressionThreads)
+            return
         #commandList = ["/opt/brains2/bin/ConvertBetweenFileFormats"]
         commandList = [self.convertBetweenFormatsPath]
         commandList.append(dicomDir)
@@ -108,99 +245,245 @@ class SyncNewPredictDataToMRx():
         self.logger.info(" ".join(commandList))
         self.logger.info("Converting "+dicomDir+" to "+convertedFileNameWithPath)
         try:
-            self.logger.info(phdUtils.check_output(commandList,stderr=sys.stdout))
+            with self.scheduler.toolSlot('ConvertBetweenFileFormats'):
+                self.logger.info(phdUtils.check_output(commandList,stderr=sys.stdout))
         except subprocess.CalledProcessError as e:
             self.logger.error("ConvertBetweenFileFormats threw an exception.")
             self.logger.error(e)
 
     def __downloadScan(self,session,seriesNumber):
-        tempDir = tempfile.mkdtemp()
-        project = self.xnat.select.project(session['project'])
-        subject = project.subject(session['subject_id'])
-        session = subject.experiment(session['session_id'])
-        resource = session.scan(seriesNumber).resource('DICOM')
-        files = resource.files()
-        for file in files:
-            path = os.path.join(tempDir,file.id())
-            file.get_copy(path)
+        tempDir = self.staging.allocate("{0}/{1}".format(session['session_id'],seriesNumber))
+        try:
+            byteCount = self.downloader.downloadScan(self.xnat,session['session_id'],seriesNumber,tempDir)
+        except:
+            self.staging.release(tempDir)
+            raise
+        self.staging.charge(tempDir,byteCount)
+        tempDir = self.staging.settle(tempDir)
 
         return tempDir
 
-    def __convertNiftiToMGZ(self,niftiGZFileNameWithPath,newMGZFileNameWithPath,tempDir):
+    def __acquisitionParameters(self,job,tempDir):
+        """Return the TE, TR, TI and flip angle of a series, read from the
+        first DICOM file in tempDir the first time and cached after that."""
+        cacheKey = "{0}/{1}".format(job['session']['session_id'],job['seriesNumber'])
+        parameters = self.acquisitionCache.get(cacheKey)
+        if parameters is not None:
+            return parameters
+        for dicomFile in sorted(os.listdir(tempDir)):
+            if re.search('xml',dicomFile):
+                continue
+            try:
+                parameters = DicomHeaders.readAcquisitionParameters(os.path.join(tempDir,dicomFile))
+            except Exception:
+                continue
+            self.acquisitionCache.set(cacheKey,parameters)
+            return parameters
+        raise ConversionError("No DICOM file in {0} to read TE/TR/flip angle from".format(tempDir))
+
+    def __convertNiftiToMGZ(self,niftiGZFileNameWithPath,newMGZFileNameWithPath,tempDir,job):
+        """ Convert the published .nii.gz to .mgz without modifying it.  The
+            nifti is decompressed as a stream, straight into the .mgz with
+            the native converter and into a temporary .nii for mri_convert
+            otherwise. """
         if os.path.exists(newMGZFileNameWithPath):
             self.logger.info(newMGZFileNameWithPath+" already exists, no conversion needed.")
             return
-        # Need to unzip the .nii.gz version
-        commandList = ['gunzip','-f',niftiGZFileNameWithPath]
-        self.logger.info(phdUtils.check_output(commandList,stderr=sys.stdout))
+        parameters = self.__acquisitionParameters(job,tempDir)
+        self.logger.info("Converting "+niftiGZFileNameWithPath+" to "+newMGZFileNameWithPath)
 
-        niftiFileName = niftiGZFileNameWithPath.rstrip('.gz')
+        if self.conversionEngine == 'native':
+            try:
+                DicomVolume.niftiToMgz(niftiGZFileNameWithPath,newMGZFileNameWithPath,
+                                       parameters['repetitionTime'],parameters['echoTime'],
+                                       parameters['inversionTime'],parameters['flipAngle'],
+                                       self.compressionLevel,self.compressionThreads)
+                return
+            except DicomVolume.UnsupportedSeriesError as e:
+                self.logger.info("Using mri_convert for {0}: {1}".format(niftiGZFileNameWithPath,e))
 
-        dicomFiles = os.listdir(tempDir)
-        data = dicom.read_file(os.path.join(tempDir,dicomFiles[0]))
-        te = data.EchoTime
-        tr = data.RepetitionTime
-        flip = data.FlipAngle
+        niftiFileName = os.path.join(tempDir,os.path.basename(niftiGZFileNameWithPath)[:-len('.gz')])
+        niftiGZ = gzip.open(niftiGZFileNameWithPath,'rb')
+        try:
+            niftiFile = open(niftiFileName,'wb')
+            try:
+                shutil.copyfileobj(niftiGZ,niftiFile,1048576)
+            finally:
+                niftiFile.close()
+        finally:
+            niftiGZ.close()
 
         # Pass all the above to mri_convert
-        commandList = ["/opt/freesurfer/bin/mri_convert"]
+        commandList = [self.mriConvertPath]
         commandList.append('-te')
-        commandList.append(str(te))
+        commandList.append(str(parameters['echoTime']))
         commandList.append('-tr')
-        commandList.append(str(tr))
-        if 'InversionTime' in data:
+        commandList.append(str(parameters['repetitionTime']))
+        if parameters['inversionTime']:
             commandList.append('-TI')
-            commandList.append(str(data.InversionTime))
+            commandList.append(str(parameters['inversionTime']))
         commandList.append('-flip_angle')
-        commandList.append(str(flip))
+        commandList.append(str(parameters['flipAngle']))
         commandList.append("-it")
         commandList.append("nii")
         commandList.append(niftiFileName)
         commandList.append(newMGZFileNameWithPath)
-        self.logger.info("Converting "+niftiGZFileNameWithPath+" to "+newMGZFileNameWithPath)
-        #print " ".join(commandList)
-        self.logger.info(phdUtils.check_output(commandList,stderr=sys.stdout))
-
-        # Re-zip the .nii file
-        commandList = ['gzip',niftiFileName]
-        self.logger.info(phdUtils.check_output(commandList,stderr=sys.stdout))
+        try:
+            with self.scheduler.toolSlot('mri_convert'):
+                self.logger.info(phdUtils.check_output(commandList,stderr=sys.stdout))
+        finally:
+            os.remove(niftiFileName)
 
-    def __getRecentSessions(self,projectLike):
+    def __getRecentSessions(self,projectLike,changedSince=None):
+        """ In window mode, returns the sessions inserted after insertedAfter.
+            In delta mode, returns the sessions inserted or modified, or
+            with a scan modified, since changedSince, or every session when
+            changedSince is None. """
         self.logger.info('Fetching new sessions in projects like '+projectLike)
-        newScanConditions=[('xnat:mrSessionData/PROJECT','LIKE',projectLike),'and',('xnat:mrSessionData/INSERT_DATE','>=',self.insertedAfter)]
-        self.logger.debug('scanConditions=[(\'xnat:mrSessionData/PROJECT\',\'LIKE\','+projectLike+'),\'and\',(\'xnat:mrSessionData/INSERT_DATE\',\'>=\','+self.insertedAfter+')]')
-        phdSessions = self.xnat.select('xnat:mrSessionData').where(newScanConditions)
+        if self.changeDetection != 'delta':
+            newScanConditions=[('xnat:mrSessionData/PROJECT','LIKE',projectLike),'and',('xnat:mrSessionData/INSERT_DATE','>=',self.insertedAfter)]
+        elif changedSince is None:
+            self.logger.info('Reconciling every session in projects like '+projectLike)
+            newScanConditions=[('xnat:mrSessionData/PROJECT','LIKE',projectLike),'and']
+        else:
+            newScanConditions=[('xnat:mrSessionData/PROJECT','LIKE',projectLike),
+                               [('xnat:mrSessionData/INSERT_DATE','>=',changedSince),
+                                ('xnat:mrSessionData/LAST_MODIFIED','>=',changedSince),'OR'],'AND']
+        self.logger.debug('scanConditions='+str(newScanConditions))
+        phdSessions = self.restClient.search('xnat:mrSessionData',SESSION_FIELDS,newScanConditions)
+        if self.changeDetection == 'delta' and changedSince is not None:
+            # Scan quality edits drive the unusable_ renames
+            listed = set([session['session_id'] for session in phdSessions])
+            phdSessions.extend([session for session in self.restClient.sessionsWithChangedScans(
+                                    SESSION_FIELDS,('xnat:mrSessionData/PROJECT','LIKE',projectLike),changedSince)
+                                if session['session_id'] not in listed])
         return phdSessions
 
-    def __getRecentPredictSessions(self):
-        return self.__getRecentSessions('%PHD%')
-
-    def __getRecentFMRISessions(self):
-        return self.__getRecentSessions('%FMRI_%')
-
-    def __checkAndFreeDiskSpace(self):
-        diskObj = os.statvfs(self.xnatCacheDir)
-        capacity = diskObj.f_bsize * diskObj.f_blocks
-        available = diskObj.f_bsize * diskObj.f_bavail
-        percentFree = available / capacity
-        # If not enough disk space, delete image files in cache older than 10 minutes.
-        if percentFree <= 0.15:
-            tempNiftis = glob.glob(self.xnatCacheDir+"/*.nii.gz")
-            timeThresh = datetime.datetime.now() - datetime.timedelta(minutes=30)
-            timeThresh = timeThresh.timetuple()
-            for image in tempNiftis:
-                imageWithPath = os.path.join(self.xnatCacheDir,image)
-                fileTimeSecs = os.path.getmtime(imageWithPath)
-                fileTime = localtime(fileTimeSecs)
-                if fileTime <= timeThresh:
-                    # File is old, delete it
-                    os.remove(imageWithPath)
-    
-    def __isScanUsableInXnat(self,projectLabel,scanID,
-                             seriesNumber,subjectLabel):
+    def findArchivedSessions(self,projectLabel,sessionLabels):
+        """ Return the sessions among sessionLabels that predict has
+            archived in projectLabel, ready for syncSessions(). """
+        labelConditions = [('xnat:mrSessionData/LABEL','=',label) for label in sessionLabels]
+        labelConditions.append('OR')
+        return self.restClient.search('xnat:mrSessionData',SESSION_FIELDS,
+                                      [('xnat:mrSessionData/PROJECT','=',projectLabel),
+                                       labelConditions,'AND'])
+
+    def syncSessions(self,sessions):
+        """ Sync just the given sessions, as returned by
+            findArchivedSessions().  Like syncAllSessions(), must run in
+            one thread at a time.  Returns how many sessions and series
+            failed. """
+        return self.__syncSessions(sessions)
+
+    def planAllSessions(self):
+        """ Work out what syncAllSessions() would download and convert,
+            with bulk searches and without changing anything.  Returns a
+            list with an entry per session that has series to convert,
+            holding its search record and the series with their estimated
+            bytes and seconds, or None where there is no history yet. """
+        plan = []
+        for projectLike in ['%PHD%','%FMRI_%']:
+            markName = 'mrx:'+projectLike
+            changedSince = None
+            if self.changeDetection == 'delta':
+                changedSince = self.syncState.changedSince(markName,self.fullReconcileDays)
+            sessions = self.__getRecentSessions(projectLike,changedSince)
+            finished = self.syncState.resumeListing(markName,self.resumeHours)
+            sessions = [session for session in sessions if session['session_id'] not in finished]
+            self.logger.info("Planning {0} sessions in projects like {1}".format(len(sessions),projectLike))
+            scanTables = self.restClient.scanTables([session['session_id'] for session in sessions],
+                                                    fileCounts=self.dicomCache is not None)
+            for session in sessions:
+                series = self.__planSession(session,scanTables[session['session_id']])
+                if series:
+                    plan.append({'session': session,'series': series})
+        return plan
+
+    def executePlan(self,plan):
+        """ Sync just the series in a plan from planAllSessions(), without
+            searching for sessions.  Series that were converted since the
+            plan was made are still skipped.  Returns how many sessions and
+            series failed. """
+        seriesFilter = {}
+        for entry in plan:
+            seriesFilter[entry['session']['session_id']] = set([series['seriesNumber']
+                                                                for series in entry['series']])
+        return self.__syncSessions([entry['session'] for entry in plan],None,seriesFilter)
+
+    def __planSession(self,session,scanTable):
+        """ The series __syncSession() would convert, by the same checks. """
+        if self.syncState.isQuarantined('mrx:'+session['session_id']):
+            return []
+        projectLabel = session['project']
+        sessionState = self.syncState.getSession(session['session_id'])
+        if sessionState is not None:
+            subjectLabel = sessionState['subjectLabel']
+            scanID = sessionState['sessionLabel']
+        else:
+            subjectLabel = self.restClient.subjectLabel(projectLabel,session['subject_id'])
+            scanID = session['label']
+        newDir = os.path.join(self.destinationBase,projectLabel+'/'+subjectLabel+'/'+scanID,'ANONRAW')
+        planned = []
+        for seriesNumber in sorted(scanTable.keys(),key=seriesSortKey):
+            scanRecord = scanTable[seriesNumber]
+            scanType = scanRecord['type']
+            if re.search('localizer',scanType) or re.search('nonImageDicom',scanType):
+                continue
+            if not scanType in self.whiteList:
+                continue
+            seriesState = self.syncState.getSeries(projectLabel,subjectLabel,scanID,seriesNumber)
+            if (seriesState is not None and seriesState['status'] == 'converted' and
+                seriesState['scanType'] == scanType and
+                seriesState['quality'] == scanRecord['quality']):
+                continue
+            if self.syncState.isQuarantined("mrx:{0}/{1}".format(session['session_id'],seriesNumber)):
+                continue
+            if re.search('DWI',scanType):
+                convertedFilesList = glob.glob(newDir+'/*_'+seriesNumber+'.nrrd')
+            else:
+                convertedFilesList = glob.glob(newDir+'/*_'+seriesNumber+'.nii.gz')
+            if convertedFilesList:
+                continue
+            source = 'xnat'
+            if self.dicomCache is not None:
+                count = self.dicomCache.count(projectLabel,subjectLabel,scanID,seriesNumber)
+                if count and count == scanRecord['files']:
+                    source = 'dicomCache'
+            planned.append({'projectLabel': projectLabel,
+                            'subjectLabel': subjectLabel,
+                            'scanID': scanID,
+                            'seriesNumber': seriesNumber,
+                            'scanType': scanType,
+                            'frames': scanRecord['frames'],
+                            'files': scanRecord.get('files'),
+                            'source': source,
+                            'bytes': self.syncState.estimateSize('mrx:'+scanType),
+                            'seconds': self.syncState.estimateDuration('mrx:'+scanType)})
+        return planned
+
+    def __syncRecentSessions(self,projectLike):
+        """ Sync the recent sessions in projects like projectLike.  In delta
+            mode the high-water mark only moves once they all synced. """
+        markName = 'mrx:'+projectLike
+        startedOn = datetime.date.today().strftime('%Y%m%d')
+        changedSince = None
+        if self.changeDetection == 'delta':
+            changedSince = self.syncState.changedSince(markName,self.fullReconcileDays)
+        sessions = self.__getRecentSessions(projectLike,changedSince)
+        deferredBefore = self.timeBudget.deferredCount()
+        failures = self.__syncSessions(sessions,markName)
+        deferred = self.timeBudget.deferredCount()-deferredBefore
+        if failures:
+            self.logger.warn("{0} sessions or series of {1} failed, they are retried next run.".format(
+                failures,projectLike))
+        elif deferred:
+            self.logger.info("{0} series of {1} were left for the next run.".format(deferred,projectLike))
+        elif self.changeDetection == 'delta':
+            self.syncState.markSynced(markName,startedOn,changedSince is None)
+        self.syncState.finishListing(markName)
+
+    def __isQualityUsable(self,usableText):
         usable = False;
-        tmpExperiment = self.xnat.select.project(projectLabel).subject(subjectLabel).experiment(scanID)
-        usableText = tmpExperiment.scan(seriesNumber).attrs.get('xnat:mrScanData/quality')
         if (usableText == 'usable') or (usableText == 'VIExcellent'):
             usable = True
         elif usableText == 'VIUnusable':
@@ -217,262 +500,601 @@ class SyncNewPredictDataToMRx():
         """ This syncs all sessions archived after insertedDate.  PHD and FMRI are
             done seperately to make it easier to fetch recent scans in projects
             we care about."""
-        self.logger.info('Fetching all recent PHD_* sessions.')
-        phdSessions = self.__getRecentPredictSessions()
         self.logger.info('Syncing all recent PHD_* sessions.')
-        self.__syncSessions(phdSessions)
-        self.logger.info('Fetching all recent FMRI_* sessions.')
-        fmriSessions = self.__getRecentFMRISessions()
+        self.__syncRecentSessions('%PHD%')
         self.logger.info('Syncing all recent FMRI_* sessions.')
-        self.__syncSessions(fmriSessions)
+        self.__syncRecentSessions('%FMRI_%')
 
-    def __syncSessions(self,sessions):
+    def __syncSessions(self,sessions,listing=None,seriesFilter=None):
         """Convert relevant scans in passed sessions and write to destinationBase.
+        A session or series that fails is logged and counted against its
+        retries while the rest carry on.  With a listing, every session whose
+        series all synced is checkpointed, and a listing resumed after an
+        interrupted run skips those sessions.  Returns how many sessions and
+        series failed and will be retried.  seriesFilter, if given, maps
+        session IDs to the only series numbers to sync.
         """
-        for session in sessions:
-            # Check if there is enough disk space available
-            self.__checkAndFreeDiskSpace()
-
-            # Get scanID, sebjectLabel, and projectLabel
-            projectLabel = session['project']
-            tempProject = self.xnat.select.project(projectLabel)
-            tempSubject = tempProject.subject(session['subject_id'])
-            subjectLabel = tempSubject.attrs.get('xnat:subjectData/label')
-            tempExperiment = tempSubject.experiment(session['session_id'])
-            scanID = tempExperiment.attrs.get('xnat:mrSessionData/label')
-
-            self.logger.debug('Syncing session: '+ projectLabel+', '+subjectLabel+', '+scanID)
-            scanDir = os.path.join(self.destinationBase,projectLabel+
-                                   '/'+subjectLabel+'/'+scanID)
-
-            newDir = os.path.join(scanDir,'ANONRAW')
-
-            if os.path.exists(newDir):
-                # When commented out it's so that even if some images are there everything
-                # will be checked.  In the convert functions it checks for the
-                # existence of images before converting, so this shouldn't be too
-                # big of a problem.
-                if os.listdir(newDir):
-                        self.logger.info(projectLabel+","+subjectLabel+","+scanID+" already converted")
-                        #continue
+        if listing is not None:
+            finished = self.syncState.resumeListing(listing,self.resumeHours)
+            if finished:
+                self.logger.info("Resuming {0}, skipping the {1} sessions the interrupted run finished.".format(
+                    listing,len(finished)))
+                sessions = [session for session in sessions if session['session_id'] not in finished]
+        if self.timeBudget.isLimited():
+            sessions = sorted(sessions,key=lambda session: session['date'],reverse=True)
+        self.retryableFailures = 0
+        # Look up the scans of the coming sessions on the REST client's
+        # worker threads while earlier sessions are synced
+        scanTables = self.restClient.imap(self.__lookupScanTable,
+                                          [session['session_id'] for session in sessions])
+        for session,scanTable in zip(sessions,scanTables):
+            # Finish off any conversions from earlier sessions
+            self.scheduler.poll()
+
+            usage = self.staging.usage()
+            self.logger.debug("Staging {activeDirs} series, {activeBytes} bytes; keeping {completedDirs}, "
+                              "{completedBytes} bytes; {freeBytes} bytes free".format(**usage))
+
+            sessionKey = 'mrx:'+session['session_id']
+            if self.syncState.isQuarantined(sessionKey):
+                self.logger.warn("Session {0} is quarantined, skipping.".format(session['session_id']))
+                continue
+            # Series of the session still converting, and whether everything
+            # so far synced, so the session can be checkpointed once done
+            progress = {'listing': listing,
+                        'sessionID': session['session_id'],
+                        'pending': 0,
+                        'queueing': True,
+                        'complete': True}
+            try:
+                self.__syncSession(session,scanTable,progress,seriesFilter)
+            except Exception as e:
+                self.logger.error("Syncing session {0} failed.".format(session['session_id']),exc_info=True)
+                progress['complete'] = False
+                self.__itemFailed(sessionKey,e)
             else:
-                self.logger.info("Creating new directory: %s" % (newDir))
+                self.syncState.recordSuccess(sessionKey)
+            progress['queueing'] = False
+            self.__checkpointSession(progress)
+
+        self.scheduler.wait()
+        return self.retryableFailures
+
+    def __lookupScanTable(self,sessionID):
+        """ Runs on a REST client worker.  Returns None if the lookup failed,
+            so the main thread tries again and reports the error. """
+        try:
+            return self.restClient.scanTable(sessionID,fileCounts=self.dicomCache is not None)
+        except Exception:
+            return None
+
+    def __syncSession(self,session,scanTable,progress,seriesFilter=None):
+        """ Queue the conversions of the relevant series of one session. """
+        if scanTable is None:
+            scanTable = self.restClient.scanTable(session['session_id'],
+                                                  fileCounts=self.dicomCache is not None)
+        # Get scanID, sebjectLabel, and projectLabel
+        projectLabel = session['project']
+        sessionState = self.syncState.getSession(session['session_id'])
+        if sessionState is not None:
+            subjectLabel = sessionState['subjectLabel']
+            scanID = sessionState['sessionLabel']
+        else:
+            subjectLabel = self.restClient.subjectLabel(projectLabel,session['subject_id'])
+            scanID = session['label']
+
+        self.logger.debug('Syncing session: '+ projectLabel+', '+subjectLabel+', '+scanID)
+        scanDir = os.path.join(self.destinationBase,projectLabel+
+                               '/'+subjectLabel+'/'+scanID)
+
+        newDir = os.path.join(scanDir,'ANONRAW')
+
+        if os.path.exists(newDir):
+            # When commented out it's so that even if some images are there everything
+            # will be checked.  In the convert functions it checks for the
+            # existence of images before converting, so this shouldn't be too
+            # big of a problem.
+            if os.listdir(newDir):
+                    self.logger.info(projectLabel+","+subjectLabel+","+scanID+" already converted")
+                    #continue
+        else:
+            self.logger.info("Creating new directory: %s" % (newDir))
+            try:
                 os.makedirs(newDir)
+            except OSError as e:
+                # Another host may be syncing other series of the session
+                if e.errno != errno.EEXIST:
+                    raise
 
-            seriesNumbers = tempExperiment.scans().get()
-            field_strength = 0
+        seriesNumbers = sorted(scanTable.keys(),key=seriesSortKey)
+        field_strength = 0
+        seriesJobs = []
 
-            for seriesNumber in seriesNumbers:
-                scanType = self.__getScanTypeFromXnat(projectLabel,
-                                               scanID,seriesNumber,subjectLabel)
+        for seriesNumber in seriesNumbers:
+            if seriesFilter is not None and seriesNumber not in seriesFilter.get(session['session_id'],()):
+                continue
+            scanRecord = scanTable[seriesNumber]
+            scanType = scanRecord['type']
 
-                # We don't need to download localizers or non image data.
-                if re.search('localizer',scanType) or re.search('nonImageDicom',scanType):
-                    self.logger.debug("Skipping {0},{1} because it is a localizer/nonImageDicom".format(scanID,seriesNumber))
-                    continue
+            # We don't need to download localizers or non image data.
+            if re.search('localizer',scanType) or re.search('nonImageDicom',scanType):
+                self.logger.debug("Skipping {0},{1} because it is a localizer/nonImageDicom".format(scanID,seriesNumber))
+                continue
 
-                # Check scanType against whitelist
-                if not scanType in self.whiteList:
-                    self.logger.info("scanType, " + scanType + ", not in the whitelist, skipping scanID="+scanID+", seriesNumber="+seriesNumber+".")
-                    continue
+            # Check scanType against whitelist
+            if not scanType in self.whiteList:
+                self.logger.info("scanType, " + scanType + ", not in the whitelist, skipping scanID="+scanID+", seriesNumber="+seriesNumber+".")
+                continue
 
-                scan = tempExperiment.scans(seriesNumber).get()
-                try:
-                    field_strength = tempExperiment.scan(scan).attrs.get('xnat:mrScanData/fieldStrength')
-                except IndexError:
-                    pass
-
-                # Check if this scan is usable.
-                usable = self.__isScanUsableInXnat(projectLabel,scanID,
-                                                   seriesNumber,subjectLabel)
-
-                # Check if this series number has already been converted
-                convertedFilesList = []
-                if re.search('DWI',scanType):
-                  convertedFilesList = glob.glob(newDir+'/*_'+seriesNumber+'.nrrd')
-                else:
-                  self.logger.debug(newDir+'/*_'+seriesNumber+'.nii.gz')
-                  convertedFilesList = glob.glob(newDir+'/*_'+seriesNumber+'.nii.gz')
-
-                self.logger.debug("List of coverted files with this series number: ".format(convertedFilesList))
-                if len(convertedFilesList) > 0:
-                  self.logger.info("{0},{1} has already been converted.".format(scanID,seriesNumber))
-                  if not usable:
-                      self.logger.info("{0},{1} is not usable, deleting from filesystem.".format(scanID,seriesNumber))
-                      for imageFile in convertedFilesList:
-                          self.logger.info("Prepending 'unusable' to {0}".format(imageFile))
+            field_strength = scanRecord['fieldStrength']
+
+            # Check if this scan is usable.
+            usable = self.__isQualityUsable(scanRecord['quality'])
+
+            # Skip series an earlier run converted with the same type and quality
+            seriesState = self.syncState.getSeries(projectLabel,subjectLabel,scanID,seriesNumber)
+            if (seriesState is not None and seriesState['status'] == 'converted' and
+                seriesState['scanType'] == scanType and
+                seriesState['quality'] == scanRecord['quality']):
+                self.logger.debug("{0},{1} is already converted and unchanged.".format(scanID,seriesNumber))
+                continue
+
+            # Only the host holding the series' lease touches its files
+            workKey = "mrx:{0}/{1}".format(session['session_id'],seriesNumber)
+            if self.syncState.isQuarantined(workKey):
+                self.logger.warn("{0},{1} is quarantined, skipping.".format(scanID,seriesNumber))
+                continue
+            if not self.__claimWork(workKey):
+                self.logger.info("{0},{1} is being synced by another host, skipping.".format(scanID,seriesNumber))
+                progress['complete'] = False
+                continue
+
+            # Check if this series number has already been converted
+            convertedFilesList = []
+            if re.search('DWI',scanType):
+              convertedFilesList = glob.glob(newDir+'/*_'+seriesNumber+'.nrrd')
+            else:
+              self.logger.debug(newDir+'/*_'+seriesNumber+'.nii.gz')
+              convertedFilesList = glob.glob(newDir+'/*_'+seriesNumber+'.nii.gz')
+
+            self.logger.debug("List of coverted files with this series number: ".format(convertedFilesList))
+            if len(convertedFilesList) > 0:
+              self.logger.info("{0},{1} has already been converted.".format(scanID,seriesNumber))
+              if not usable:
+                  self.logger.info("{0},{1} is not usable, deleting from filesystem.".format(scanID,seriesNumber))
+                  for imageFile in convertedFilesList:
+                      self.logger.info("Prepending 'unusable' to {0}".format(imageFile))
+                      extension = re.match('[-\w]+\.(.+)$',os.path.basename(imageFile)).group(1)
+                      unusableImageFile = os.path.join(newDir,
+                                                       'unusable_{0}_{1}_{2}_{3}.{4}'.format(subjectLabel,
+                                                                                             scanID,
+                                                                                             scanType,
+                                                                                             seriesNumber,
+                                                                                             extension))
+                      os.rename(imageFile,unusableImageFile)
+              else:
+                  for imageFile in convertedFilesList:
+                      if re.match('unusable_*',imageFile):
+                          self.logger.info("Scan {0} is now usable, removing 'unusable_'.".format(imageFile))
                           extension = re.match('[-\w]+\.(.+)$',os.path.basename(imageFile)).group(1)
-                          unusableImageFile = os.path.join(newDir,
-                                                           'unusable_{0}_{1}_{2}_{3}.{4}'.format(subjectLabel,
-                                                                                                 scanID,
-                                                                                                 scanType,
-                                                                                                 seriesNumber,
-                                                                                                 extension))
-                          os.rename(imageFile,unusableImageFile)
-                  else:
-                      for imageFile in convertedFilesList:
-                          if re.match('unusable_*',imageFile):
-                              self.logger.info("Scan {0} is now usable, removing 'unusable_'.".format(imageFile))
-                              extension = re.match('[-\w]+\.(.+)$',os.path.basename(imageFile)).group(1)
-                              usableImageFile = os.path.join(newDir,
-                                                             '{0]_{1}_{2}_{3}.{4}'.format(subjectLabel,
-                                                                                          scanID,
-                                                                                          scanType,
-                                                                                          seriesNumber,
-                                                                                          extension))
-                  continue
-
-                unusablePrepend = ''
-                if not usable:
-                    self.logger.info("{0},{1} has been labeled unusable in xnat.".format(scanID,seriesNumber))
-                    unusablePrepend = 'unusable_'
-
-                # download scan from xnat
-                self.logger.debug("Downloading {0},{1} from xnat.".format(scanID,
-                                                                          seriesNumber))
-                try:
-                    tempDir = self.__downloadScan(session,seriesNumber)
-                except httplib2.HttpLib2Error:
-                    self.logger.error("404 error when Downloading {0},{1} from xnat.".format(scanID,seriesNumber))
-                    continue
-
-                # Check if scan is PD/T2, T1, or DWI
-                if re.search('PD',scanType):
-                    self.logger.debug("scanType, {0}, is a 'PD'".format(scanType))
-                    #Create two temp directories
-                    tmpPDDir = tempfile.mkdtemp()
-                    tmpT2Dir = tempfile.mkdtemp()
-
-                    # Put T2 files in one tmp dir and PD files in the other
-                    # Shortest TR time is the PD
-                    dicomDir = tempDir
-                    dicomFiles = os.listdir(dicomDir)
-                    scanTypeSuffix = re.search("(\-\d\d)",scanType).group()
-
-                    try:
-                      for slice in dicomFiles:
-                          if re.search(".xml$",slice):
-                              continue
-                          try:
-                              ds = dicom.read_file(os.path.join(dicomDir,slice))
-                          except:
-                              self.logger.critical("EXCEPTION CAUGHT WHEN TRYING TO READ FILE {0}".format(
-                                  os.path.join(dicomDir,slice)))
-                              raise
-                          if 'StudyInstanceUID' not in ds:
-                              self.logger.warn("{0} does not appear to be a valid dicom file!".format(slice))
-                              continue
-                          if ds.EchoNumbers == 1:
-                              os.symlink(os.path.join(dicomDir,slice),
-                                         os.path.join(tmpPDDir,slice))
-                          else:
-                              os.symlink(os.path.join(dicomDir,slice),
-                                         os.path.join(tmpT2Dir,slice))
-                    except:
-                        self.logger.warn("EXCEPTION CAUGHT READING DICOM FILES in %s" % (dicomDir))
-                        self.logger.warn("Skipping {0},{1}".format(scanID,
-                                                                   seriesNumber))
-                        continue
-
-                    scanTypePD = "PD" + scanTypeSuffix
-                    scanTypeT2 = "T2" + scanTypeSuffix
-                    newPDFileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanTypePD+"_"+seriesNumber+".nii.gz"
-                    newT2FileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanTypeT2+"_"+seriesNumber+".nii.gz"
-
-                    # Convert PD dicom to nifti
-                    try:
-                        self.__convertDicomToNifti(tmpPDDir,os.path.join(newDir,newPDFileName))
-                    except subprocess.CalledProcessError:
-                        self.logger.error("Error converting "+scanID+","+scanTypePD+" to "+os.path.join(newDir,newPDFileName))
-                        continue
-                    if not os.path.exists(os.path.join(newDir,newPDFileName)):
-                        self.logger.error(os.path.join(newDir,newPDFileName)+" doesn't exist! Conversion failed.")
-                        continue
-
-                    # Convert T2 dicom to nifti
-                    try:
-                        self.__convertDicomToNifti(tmpT2Dir,os.path.join(newDir,newT2FileName))
-                    except subprocess.CalledProcessError:
-                        self.logger.error("Error converting "+scanID+","+scanTypeT2+" to "+os.path.join(newDir,newT2FileName))
-                        continue
-                    if not os.path.exists(os.path.join(newDir,newT2FileName)):
-                        self.logger.error(os.path.join(newDir,newT2FileName)+" doesn't exist! Conversion failed.")
-                        continue
-
-                    # Delete the temporary directories
-                    shutil.rmtree(tmpPDDir)
-                    shutil.rmtree(tmpT2Dir)
-                elif re.search('DWI',scanType):
-                    newFileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanType+"_"+seriesNumber+".nrrd"
-                    newFileNameWithPath=os.path.join(newDir,newFileName)
-
-                    # Use DicomToNrrdConverter to convert the DWI to nifti
-                    try:
-                        numberVolumes = self.__convertDicomToNrrd(tempDir,
-                                                newFileNameWithPath,seriesNumber)
-                    except subprocess.CalledProcessError:
-                        self.logger.error("Error converting "+scanID+","+scanType+","+seriesNumber+" to "+newFileNameWithPath)
-                        continue
-                    if not os.path.exists(newFileNameWithPath):
-                        self.logger.error(newFileNameWithPath+" doesn't exist! Conversion failed.")
-                        continue
-                    newScanType="DWI-"+numberVolumes
-                    correctedFileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+newScanType
-                    correctedFileName+="_"+seriesNumber+".nrrd"
-                    correctedFileNameWithPath=os.path.join(newDir,correctedFileName)
-                    os.rename(newFileNameWithPath,correctedFileNameWithPath)
-                    if newScanType != scanType:
-                        self.__updateDWIScanTypeInXnat(projectLabel,scanID,seriesNumber,newScanType)
-                else:
-                    newFileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanType+"_"+seriesNumber+".nii.gz"
-                    newFileNameWithDir = os.path.join(newDir,newFileName)
-
-                    # Use ConvertBetweenFileFormats to convert the Dicom to nifti
-                    try:
-                        self.__convertDicomToNifti(tempDir,newFileNameWithDir)
-                    except subprocess.CalledProcessError:
-                        self.logger.error("Error converting "+scanID+","+scanType+","+seriesNumber+" to "+newFileNameWithDir)
-                        continue
-                    if not newFileNameWithDir:
-                        self.logger.error(newFileNameWithDir+" doesn't exist! Conversion failed.")
-                        continue
-
-                if re.match("T1",scanType):
-                    newMGZFileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanType+"_"+seriesNumber+".mgz"
-                    newMGZDir=newDir
-                    tmpFiles=[i for i in tempDir if not re.search('xml',i) and
-                            not re.search('info',i)]
-                    newMGZFileNameWithPath = os.path.join(newMGZDir,newMGZFileName)
-                    try:
-                        self.__convertDicomToMGZ(tempDir,newMGZFileNameWithPath)
-                    except subprocess.CalledProcessError:
-                        errorMsg="Problem converting dicom "+scanID+","+scanType+","
-                        errorMsg+=seriesNumber+" to "+newMGZFileNameWithPath+". "
-                        errorMsg+="Trying to convert the .nii.gz file to .mgz"
-                        self.logger.warn(errorMsg)
-                    if not os.path.exists(newMGZFileNameWithPath):
-                        self.__convertNiftiToMGZ(os.path.join(newMGZDir,newFileName),
-                                                 newMGZFileNameWithPath,tempDir)
-                    if not newMGZFileNameWithPath:
-                        self.logger.error(newMGZFileNameWithPath+" doesn't exist! Conversion failed.")
-                        continue
-
-                # Delete the temp download directory
-                self.logger.info("Deleting the temporary download directory: {0}".format(tempDir))
-                shutil.rmtree(tempDir)
+                          usableImageFile = os.path.join(newDir,
+                                                         '{0]_{1}_{2}_{3}.{4}'.format(subjectLabel,
+                                                                                      scanID,
+                                                                                      scanType,
+                                                                                      seriesNumber,
+                                                                                      extension))
+              self.syncState.recordSeries(projectLabel,subjectLabel,scanID,seriesNumber,
+                                          scanType,scanRecord['quality'],usable,'converted',
+                                          describeOutputs(newDir,seriesNumber))
+              self.__finishWork(workKey,True)
+              continue
+
+            # Leave what can't be done before the deadline for the next run
+            estimate = self.timeBudget.estimate('mrx:'+scanType)
+            if not self.timeBudget.allows(estimate):
+                self.timeBudget.defer("{0},{1} {2}".format(scanID,seriesNumber,scanType),estimate)
+                self.__releaseWork(workKey)
+                progress['complete'] = False
+                continue
+
+            unusablePrepend = ''
+            if not usable:
+                self.logger.info("{0},{1} has been labeled unusable in xnat.".format(scanID,seriesNumber))
+                unusablePrepend = 'unusable_'
+
+            seriesJobs.append({'session': session,
+                               'projectLabel': projectLabel,
+                               'subjectLabel': subjectLabel,
+                               'scanID': scanID,
+                               'seriesNumber': seriesNumber,
+                               'scanType': scanType,
+                               'unusablePrepend': unusablePrepend,
+                               'quality': scanRecord['quality'],
+                               'files': scanRecord.get('files'),
+                               'usable': usable,
+                               'newDir': newDir,
+                               'workKey': workKey,
+                               'progress': progress,
+                               'estimate': estimate})
+
+        if self.timeBudget.isLimited():
+            # Cheapest first, so as many series as possible fit
+            seriesJobs.sort(key=lambda job: (job['estimate'],seriesSortKey(job['seriesNumber'])))
+
+        # Download the next series while the current one is converting.
+        for job,tempDir,excInfo in SyncPipeline.prefetch(seriesJobs,self.__downloadSeries,
+                                                         self.prefetchDepth,self.staging.release):
+            if excInfo:
+                self.logger.error("Downloading {0},{1} from xnat failed.".format(
+                    job['scanID'],job['seriesNumber']),exc_info=excInfo)
+                self.__seriesFailed(job,excInfo[1])
+                continue
+            # The download may have waited; only convert if it still fits
+            if not self.timeBudget.allows(max(job['estimate']-job['downloadSeconds'],0)):
+                self.timeBudget.defer("{0},{1} {2}".format(job['scanID'],job['seriesNumber'],job['scanType']),
+                                      job['estimate'])
+                self.staging.release(tempDir)
+                self.__releaseWork(job['workKey'])
+                progress['complete'] = False
+                continue
+            progress['pending'] += 1
+            self.scheduler.submit(lambda job=job,tempDir=tempDir: self.__runSeriesJob(job,tempDir),
+                                  lambda result,job=job: self.__completeSeries(job,result),
+                                  "{0},{1}".format(job['scanID'],job['seriesNumber']),
+                                  lambda excInfo,job=job: self.__completeSeries(job,excInfo=excInfo))
 
-            # Set permissions
-            permissions = int("750",8)
-            if stat.S_IMODE(os.stat(newDir).st_mode) != permissions:
-                self.logger.info("Updating permissions on {0}".format(newDir))
-                os.chmod(newDir,permissions)
+        # Set permissions
+        permissions = int("750",8)
+        if stat.S_IMODE(os.stat(newDir).st_mode) != permissions:
+            self.logger.info("Updating permissions on {0}".format(newDir))
+            os.chmod(newDir,permissions)
 
-            # Update session level field strength in xnat if it's missing
-            current_field_strength = tempExperiment.attrs.get('xnat:mrSessionData/fieldStrength')
+        # Update session level field strength in xnat if it's missing
+        if sessionState is None or not sessionState['fieldStrengthSet']:
+            current_field_strength = session['fieldstrength']
             if current_field_strength == '':
-                tempExperiment.attrs.set('xnat:mrSessionData/fieldStrength',field_strength)
+                self.restClient.setAttributes('/data/experiments/{0}'.format(session['session_id']),
+                                              'xnat:mrSessionData',
+                                              [('xnat:mrSessionData/fieldStrength',field_strength)])
+            self.syncState.recordSession(session['session_id'],projectLabel,subjectLabel,scanID,True)
+
+
+    def __downloadSeries(self,job):
+        startTime = time.time()
+        try:
+            tempDir = self.__fetchSeries(job)
+        finally:
+            job['downloadSeconds'] = time.time()-startTime
+        job['downloadBytes'] = self.staging.measure(tempDir)
+        return tempDir
+
+    def __fetchSeries(self,job):
+        # A series whose conversion failed earlier is still staged
+        tempDir = self.staging.reuse(self.__stagingKey(job))
+        if tempDir is not None:
+            self.logger.debug("Using the staged files of {0},{1}.".format(job['scanID'],
+                                                                        job['seriesNumber']))
+            return tempDir
+        if self.dicomCache is not None:
+            tempDir = self.__materializeSeries(job)
+            if tempDir is not None:
+                return tempDir
+        self.logger.debug("Downloading {0},{1} from xnat.".format(job['scanID'],
+                                                                  job['seriesNumber']))
+        return self.__downloadScan(job['session'],job['seriesNumber'])
+
+    def __materializeSeries(self,job):
+        """ Return a temporary directory holding the series from the DICOM
+            cache, or None if the cache doesn't have all the files of the
+            scan's DICOM resource in xnat, or their number, which comes
+            with the session's scanTable, is unknown. """
+        cached = self.dicomCache.count(job['projectLabel'],job['subjectLabel'],
+                                       job['scanID'],job['seriesNumber'])
+        if not cached:
+            return None
+        expected = job['files']
+        if cached != expected:
+            self.logger.info("Cache has {0} of {1} files for {2},{3}, downloading instead.".format(
+                cached,expected,job['scanID'],job['seriesNumber']))
+            return None
+        tempDir = self.staging.allocate(self.__stagingKey(job))
+        try:
+            count = self.dicomCache.materialize(job['projectLabel'],job['subjectLabel'],
+                                                job['scanID'],job['seriesNumber'],tempDir)
+        except:
+            self.staging.release(tempDir)
+            raise
+        if count == expected:
+            self.logger.debug("Using {0} cached files for {1},{2}.".format(count,job['scanID'],
+                                                                         job['seriesNumber']))
+            self.staging.measure(tempDir)
+            return self.staging.settle(tempDir)
+        self.logger.info("Cache has {0} of {1} files for {2},{3}, downloading instead.".format(
+            count,expected,job['scanID'],job['seriesNumber']))
+        self.staging.release(tempDir)
+        return None
+
+    def __stagingKey(self,job):
+        return "{0}/{1}".format(job['session']['session_id'],job['seriesNumber'])
+
+    def __classifyEchoes(self,job,dicomDir,dicomFiles):
+        """Return a dict mapping each file in dicomFiles to its EchoNumbers,
+        or None if it isn't a valid DICOM image.  Only headers are parsed, on
+        the header worker threads, and the answers are cached per series so
+        a reconversion doesn't parse the files again."""
+        cacheKey = "{0}/{1}".format(job['session']['session_id'],job['seriesNumber'])
+        cachedEchoes = self.echoCache.get(cacheKey,{})
+        echoNumbers = {}
+        uncached = []
+        for slice in dicomFiles:
+            fileKey = "{0}:{1}".format(slice,os.path.getsize(os.path.join(dicomDir,slice)))
+            if fileKey in cachedEchoes:
+                echoNumbers[slice] = cachedEchoes[fileKey]
+            else:
+                uncached.append((slice,fileKey))
+        if not uncached:
+            self.logger.debug("Using cached echo numbers for {0}".format(cacheKey))
+            return echoNumbers
+
+        def readEchoNumber(slice):
+            try:
+                return DicomHeaders.readEchoNumber(os.path.join(dicomDir,slice))
+            except:
+                self.logger.critical("EXCEPTION CAUGHT WHEN TRYING TO READ FILE {0}".format(
+                    os.path.join(dicomDir,slice)))
+                raise
+        parsedEchoes = self.headerWorkers.map(readEchoNumber,[slice for slice,fileKey in uncached])
+        for (slice,fileKey),echoNumber in zip(uncached,parsedEchoes):
+            echoNumbers[slice] = echoNumber
+            cachedEchoes[fileKey] = echoNumber
+        self.echoCache.set(cacheKey,cachedEchoes)
+        return echoNumbers
+
+    def __runSeriesJob(self,job,tempDir):
+        """Runs in a scheduler worker.  Converts the series and releases its
+        staging directory, or keeps it staged for another attempt if the
+        conversion produced nothing."""
+        converted = False
+        startTime = time.time()
+        try:
+            result = self.__convertSeries(job,tempDir) or {}
+            result['seconds'] = time.time()-startTime
+            result['outputs'] = describeOutputs(job['newDir'],job['seriesNumber'])
+            converted = bool(result['outputs'])
+            return result
+        finally:
+            if converted:
+                self.logger.info("Deleting the temporary download directory: {0}".format(tempDir))
+                self.staging.release(tempDir)
+            else:
+                self.staging.complete(tempDir,self.__stagingKey(job))
+
+    def __finishSeries(self,job,result):
+        """Runs in the main thread once a series conversion is done.  DWI
+        conversions report their volume count, which becomes the scan type
+        in the file name and in xnat.  The outcome goes into the sync state."""
+        projectLabel = job['projectLabel']
+        scanID = job['scanID']
+        seriesNumber = job['seriesNumber']
+        scanType = job['scanType']
+        outputs = result['outputs']
+        if 'numberVolumes' in result:
+            newScanType="DWI-"+result['numberVolumes']
+            correctedFileName=job['unusablePrepend']+job['subjectLabel']+"_"+scanID+"_"+newScanType
+            correctedFileName+="_"+seriesNumber+".nrrd"
+            correctedFileNameWithPath=os.path.join(job['newDir'],correctedFileName)
+            os.rename(result['dwiFile'],correctedFileNameWithPath)
+            for output in outputs:
+                if output['path'] == result['dwiFile']:
+                    output['path'] = correctedFileNameWithPath
+            if newScanType != scanType:
+                self.__updateDWIScanTypeInXnat(job['session']['session_id'],seriesNumber,newScanType)
+            scanType = newScanType
+        if outputs:
+            status = 'converted'
+        else:
+            status = 'failed'
+        self.syncState.recordSeries(projectLabel,job['subjectLabel'],scanID,seriesNumber,
+                                    scanType,job['quality'],job['usable'],status,outputs)
+        if outputs:
+            self.syncState.recordSuccess(job['workKey'])
+            self.syncState.recordDuration('mrx:'+job['scanType'],job['downloadSeconds']+result['seconds'])
+            self.syncState.recordSize('mrx:'+job['scanType'],job['downloadBytes'])
+            self.__finishWork(job['workKey'],True)
+        else:
+            self.logger.error("Nothing was converted for {0},{1}.".format(scanID,seriesNumber))
+            self.__seriesFailed(job,'nothing was converted')
+
+    def __completeSeries(self,job,result=None,excInfo=None):
+        """Runs in the main thread once a series conversion has finished,
+        or raised the exception in excInfo."""
+        if excInfo is None:
+            try:
+                self.__finishSeries(job,result)
+            except Exception:
+                excInfo = sys.exc_info()
+        if excInfo is not None:
+            self.logger.error("Converting {0},{1} failed.".format(job['scanID'],job['seriesNumber']),
+                              exc_info=excInfo)
+            self.__seriesFailed(job,excInfo[1])
+        job['progress']['pending'] -= 1
+        self.__checkpointSession(job['progress'])
+
+    def __seriesFailed(self,job,error):
+        job['progress']['complete'] = False
+        self.__itemFailed(job['workKey'],error)
+        self.__finishWork(job['workKey'],False)
+
+    def __itemFailed(self,item,error):
+        """Count a failed attempt at item, a session or series key."""
+        if self.syncState.recordFailure(item,error):
+            self.logger.error("{0} failed {1} times and is quarantined: {2}".format(
+                item,self.syncState.maxAttempts,error))
+        else:
+            self.retryableFailures += 1
+
+    def __checkpointSession(self,progress):
+        """Checkpoint the session once all its series are through, unless
+        one of them failed or is left to another host."""
+        if progress['queueing'] or progress['pending'] or not progress['complete']:
+            return
+        if progress['listing'] is not None:
+            self.syncState.checkpoint(progress['listing'],progress['sessionID'])
+
+    def __claimWork(self,workKey):
+        """Whether this host may sync the work item workKey.  Always true
+        without a work queue."""
+        if self.workQueue is None:
+            return True
+        return self.workQueue.claim(workKey)
+
+    def __finishWork(self,workKey,succeeded):
+        if self.workQueue is not None:
+            self.workQueue.finish(workKey,succeeded)
+
+    def __releaseWork(self,workKey):
+        """Hand the work item back, unfinished, to whichever host gets to it."""
+        if self.workQueue is not None:
+            self.workQueue.release(workKey)
+
+    def __convertSeries(self,job,tempDir):
+        """Convert one downloaded series in tempDir into the job's ANONRAW
+        directory.  Runs in a scheduler worker, so it must not use the pyxnat
+        Interface."""
+        subjectLabel = job['subjectLabel']
+        scanID = job['scanID']
+        seriesNumber = job['seriesNumber']
+        scanType = job['scanType']
+        unusablePrepend = job['unusablePrepend']
+        newDir = job['newDir']
+        volume = None
+
+        # Check if scan is PD/T2, T1, or DWI
+        if re.search('PD',scanType):
+            self.logger.debug("scanType, {0}, is a 'PD'".format(scanType))
+            # Put T2 files in one tmp dir and PD files in the other
+            # Shortest TR time is the PD
+            dicomDir = tempDir
+            dicomFiles = [slice for slice in os.listdir(dicomDir)
+                          if os.path.isfile(os.path.join(dicomDir,slice))]
+
+            # Create the two temp directories inside the staged series, so
+            # they are in memory when it is and go away with it
+            tmpPDDir = tempfile.mkdtemp(prefix='PD-',dir=tempDir)
+            tmpT2Dir = tempfile.mkdtemp(prefix='T2-',dir=tempDir)
+            scanTypeSuffix = re.search("(\-\d\d)",scanType).group()
+
+            try:
+              echoNumbers = self.__classifyEchoes(job,dicomDir,
+                                                  [slice for slice in dicomFiles
+                                                   if not re.search(".xml$",slice)])
+              for slice,echoNumber in echoNumbers.items():
+                  if echoNumber is None:
+                      self.logger.warn("{0} does not appear to be a valid dicom file!".format(slice))
+                      continue
+                  if echoNumber == 1:
+                      os.symlink(os.path.join(dicomDir,slice),
+                                 os.path.join(tmpPDDir,slice))
+                  else:
+                      os.symlink(os.path.join(dicomDir,slice),
+                                 os.path.join(tmpT2Dir,slice))
+            except:
+                self.logger.warn("EXCEPTION CAUGHT READING DICOM FILES in %s" % (dicomDir))
+                self.logger.warn("Skipping {0},{1}".format(scanID,
+                                                           seriesNumber))
+                return
+
+            scanTypePD = "PD" + scanTypeSuffix
+            scanTypeT2 = "T2" + scanTypeSuffix
+            newPDFileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanTypePD+"_"+seriesNumber+".nii.gz"
+            newT2FileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanTypeT2+"_"+seriesNumber+".nii.gz"
+
+            # Convert PD dicom to nifti
+            try:
+                self.__convertDicomToNifti(tmpPDDir,os.path.join(newDir,newPDFileName))
+            except subprocess.CalledProcessError:
+                self.logger.error("Error converting "+scanID+","+scanTypePD+" to "+os.path.join(newDir,newPDFileName))
+                return
+            if not os.path.exists(os.path.join(newDir,newPDFileName)):
+                self.logger.error(os.path.join(newDir,newPDFileName)+" doesn't exist! Conversion failed.")
+                return
+
+            # Convert T2 dicom to nifti
+            try:
+                self.__convertDicomToNifti(tmpT2Dir,os.path.join(newDir,newT2FileName))
+            except subprocess.CalledProcessError:
+                self.logger.error("Error converting "+scanID+","+scanTypeT2+" to "+os.path.join(newDir,newT2FileName))
+                return
+            if not os.path.exists(os.path.join(newDir,newT2FileName)):
+                self.logger.error(os.path.join(newDir,newT2FileName)+" doesn't exist! Conversion failed.")
+                return
+
+            # Delete the temporary directories
+            shutil.rmtree(tmpPDDir)
+            shutil.rmtree(tmpT2Dir)
+        elif re.search('DWI',scanType):
+            newFileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanType+"_"+seriesNumber+".nrrd"
+            newFileNameWithPath=os.path.join(newDir,newFileName)
+
+            # Use DicomToNrrdConverter to convert the DWI to nifti
+            try:
+                numberVolumes = self.__convertDicomToNrrd(tempDir,
+                                        newFileNameWithPath,seriesNumber)
+            except subprocess.CalledProcessError:
+                self.logger.error("Error converting "+scanID+","+scanType+","+seriesNumber+" to "+newFileNameWithPath)
+                return
+            except ConversionError as e:
+                # Without the volume count the file can't be named, so convert it again next time
+                self.logger.error(str(e))
+                if os.path.exists(newFileNameWithPath):
+                    os.remove(newFileNameWithPath)
+                return
+            if not os.path.exists(newFileNameWithPath):
+                self.logger.error(newFileNameWithPath+" doesn't exist! Conversion failed.")
+                return
+            # The rename and xnat update happen in __finishSeries
+            return {'dwiFile': newFileNameWithPath,
+                    'numberVolumes': numberVolumes}
+        else:
+            newFileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanType+"_"+seriesNumber+".nii.gz"
+            newFileNameWithDir = os.path.join(newDir,newFileName)
+
+            # Use ConvertBetweenFileFormats to convert the Dicom to nifti,
+            # unless the native converter read the series for both outputs
+            volume = self.__readNativeVolume(tempDir)
+            try:
+                self.__convertDicomToNifti(tempDir,newFileNameWithDir,volume)
+            except subprocess.CalledProcessError:
+                self.logger.error("Error converting "+scanID+","+scanType+","+seriesNumber+" to "+newFileNameWithDir)
+                return
+            if not newFileNameWithDir:
+                self.logger.error(newFileNameWithDir+" doesn't exist! Conversion failed.")
+                return
+
+        if re.match("T1",scanType):
+            newMGZFileName=unusablePrepend+subjectLabel+"_"+scanID+"_"+scanType+"_"+seriesNumber+".mgz"
+            newMGZDir=newDir
+            tmpFiles=[i for i in tempDir if not re.search('xml',i) and
+                    not re.search('info',i)]
+            newMGZFileNameWithPath = os.path.join(newMGZDir,newMGZFileName)
+            try:
+                self.__convertDicomToMGZ(tempDir,newMGZFileNameWithPath,volume)
+            except subprocess.CalledProcessError:
+                errorMsg="Problem converting dicom "+scanID+","+scanType+","
+                errorMsg+=seriesNumber+" to "+newMGZFileNameWithPath+". "
+                errorMsg+="Trying to convert the .nii.gz file to .mgz"
+                self.logger.warn(errorMsg)
+            if not os.path.exists(newMGZFileNameWithPath):
+                try:
+                    self.__convertNiftiToMGZ(os.path.join(newMGZDir,newFileName),
+                                             newMGZFileNameWithPath,tempDir,job)
+                except (subprocess.CalledProcessError,ConversionError) as e:
+                    self.logger.error("Error converting "+newFileName+" to "+newMGZFileNameWithPath+": "+str(e))
+                    return
+            if not newMGZFileNameWithPath:
+                self.logger.error(newMGZFileNameWithPath+" doesn't exist! Conversion failed.")
+                return
 
-        return
 
 if __name__ == "__main__":
     # Create and parse input arguments
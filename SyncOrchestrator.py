@@ -0,0 +1,116 @@
+import sys
+import time
+import logging
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from TimeBudget import TimeBudget
+
+class SyncOrchestrator:
+    """Runs the rpacs to predict sync of several project pairs at once and
+    feeds the MRx sync as it goes.
+
+    Up to maxConcurrentProjects project pairs sync in worker threads.  Every
+    session they send to predict is queued, and the calling thread checks
+    every pollSeconds whether predict has archived the queued sessions,
+    syncing those it has to MRx straight away.  Only the calling thread
+    uses the MRx sync, so its pyxnat and scheduler rules still hold.  A
+    session predict hasn't archived after archiveWaitMinutes is left for
+    the MRx sync's own search to find.  Once the timeBudget runs out and
+    the pairs are done, sessions still waiting are left for the next run.
+    """
+    def __init__(self,rpacsSync,mrxSync,maxConcurrentProjects=2,pollSeconds=60,
+                 archiveWaitMinutes=60,timeBudget=None):
+        self.logger = logging.getLogger('SyncTasks.SyncOrchestrator')
+        self.rpacsSync = rpacsSync
+        self.mrxSync = mrxSync
+        self.maxConcurrentProjects = max(maxConcurrentProjects,1)
+        self.pollSeconds = pollSeconds
+        self.archiveWaitMinutes = archiveWaitMinutes
+        if timeBudget is None:
+            timeBudget = TimeBudget()
+        self.timeBudget = timeBudget
+
+    def run(self,projectPairs,plannedSessions=None):
+        """Sync every (rpacs project, predict project) pair.  Returns once
+        all of them are done and their sessions are synced to MRx or have
+        timed out.  If any pair failed, the first failure is raised then.
+        plannedSessions, if given, maps each pair to the sessions a plan
+        found for it, and only those are synced."""
+        uploaded = Queue.Queue()
+        workers = ThreadPool(self.maxConcurrentProjects)
+        results = []
+        for rpacsProject,predictProject in projectPairs:
+            planned = None
+            if plannedSessions is not None:
+                planned = plannedSessions.get((rpacsProject,predictProject),[])
+            results.append(workers.apply_async(self.__syncPair,(rpacsProject,predictProject,uploaded,planned)))
+        workers.close()
+
+        # (predict project, session label) -> when it was sent
+        waiting = {}
+        lastPoll = time.time()
+        try:
+            while True:
+                try:
+                    project,subjectLabel,sessionLabel = uploaded.get(timeout=1)
+                    waiting[(project,sessionLabel)] = time.time()
+                    continue
+                except Queue.Empty:
+                    pass
+                pairsDone = all([result.ready() for result in results])
+                if pairsDone and not waiting:
+                    break
+                if pairsDone and not self.timeBudget.allows(0):
+                    for project,sessionLabel in sorted(waiting.keys()):
+                        self.timeBudget.defer("{0},{1} to MRx, not archived yet".format(project,sessionLabel))
+                    break
+                if waiting and time.time()-lastPoll >= self.pollSeconds:
+                    lastPoll = time.time()
+                    self.__syncArchived(waiting)
+        finally:
+            workers.join()
+
+        failure = None
+        for (rpacsProject,predictProject),result in zip(projectPairs,results):
+            excInfo = result.get()
+            if excInfo is not None:
+                self.logger.critical("Syncing {0} to {1} failed".format(rpacsProject,predictProject),
+                                     exc_info=excInfo)
+                if failure is None:
+                    failure = excInfo
+        if failure is not None:
+            raise failure[0],failure[1],failure[2]
+
+    def __syncPair(self,rpacsProject,predictProject,uploaded,plannedSessions):
+        """Runs in a worker.  Returns None, or the sys.exc_info() of the
+        exception the sync raised, so it can be raised again with its
+        traceback."""
+        try:
+            self.rpacsSync.syncOneRpacsProjectToPredict(
+                rpacsProject,predictProject,
+                lambda project,subjectLabel,sessionLabel: uploaded.put((project,subjectLabel,sessionLabel)),
+                plannedSessions)
+        except Exception:
+            return sys.exc_info()
+        return None
+
+    def __syncArchived(self,waiting):
+        """Sync the waiting sessions predict has archived and forget those
+        that have waited too long."""
+        projects = {}
+        for project,sessionLabel in waiting.keys():
+            projects.setdefault(project,[]).append(sessionLabel)
+        for project,sessionLabels in projects.items():
+            sessions = self.mrxSync.findArchivedSessions(project,sessionLabels)
+            if sessions:
+                self.logger.info("Syncing {0} newly archived sessions of {1} to MRx".format(
+                    len(sessions),project))
+                self.mrxSync.syncSessions(sessions)
+            for session in sessions:
+                waiting.pop((project,session['label']),None)
+        oldest = time.time()-self.archiveWaitMinutes*60
+        for key,sentAt in waiting.items():
+            if sentAt < oldest:
+                self.logger.warn("{0},{1} still isn't archived, leaving it to the MRx sync.".format(*key))
+                del waiting[key]
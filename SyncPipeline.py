@@ -0,0 +1,68 @@
+import sys
+import logging
+import threading
+import Queue
+
+_DONE = object()
+
+def prefetch(items,fetch,depth,discard=None):
+    """Run fetch(item) for each item in a background thread, up to depth
+    items ahead of the caller, and yield (item, result, excInfo) in order.
+
+    excInfo is None when fetch succeeded, otherwise the sys.exc_info() of
+    the exception it raised and result is None.  At most depth fetched
+    results wait in the queue, plus the one the producer is holding while
+    the queue is full.  If the caller stops iterating early, results that
+    were fetched but never yielded are passed to discard.
+    """
+    logger = logging.getLogger('SyncTasks.SyncPipeline')
+    fetched = Queue.Queue(maxsize=max(depth,1))
+    stopped = threading.Event()
+
+    def put(entry):
+        # Wake up now and then so an abandoned pipeline doesn't leave the
+        # producer blocked forever on a full queue.
+        while not stopped.is_set():
+            try:
+                fetched.put(entry,timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if stopped.is_set():
+                    return
+                try:
+                    entry = (item,fetch(item),None)
+                except Exception:
+                    entry = (item,None,sys.exc_info())
+                if not put(entry):
+                    if entry[1] is not None and discard:
+                        discard(entry[1])
+                    return
+        finally:
+            put(_DONE)
+
+    producer = threading.Thread(target=produce,name='SyncPipelineProducer')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            entry = fetched.get()
+            if entry is _DONE:
+                break
+            yield entry
+    finally:
+        stopped.set()
+        producer.join()
+        while True:
+            try:
+                entry = fetched.get_nowait()
+            except Queue.Empty:
+                break
+            if entry is not _DONE and entry[1] is not None and discard:
+                logger.debug('Discarding prefetched result for {0}'.format(entry[0]))
+                discard(entry[1])
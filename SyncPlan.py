@@ -0,0 +1,98 @@
+import os
+import json
+import logging
+import datetime
+
+class SyncPlan:
+    """What a run would do, worked out by the syncs' plan methods, kept as
+    JSON so a later run can execute it.
+
+    rpacsPairs is the list SyncRPACStoPredict.planProjectPairs() returns
+    and mrxSessions the one from SyncNewPredictDataToMRx.planAllSessions().
+    Entries carry their estimated bytes and seconds from the sizes and
+    durations earlier runs recorded, or None where there is no history,
+    and totals() adds them up.  Sessions a planned rpacs copy sends to
+    predict can't be in the MRx part yet, and are converted as they are
+    archived when the plan is executed.
+    """
+    VERSION = 1
+
+    def __init__(self,rpacsPairs,mrxSessions,created=None):
+        self.logger = logging.getLogger('SyncTasks.SyncPlan')
+        self.rpacsPairs = rpacsPairs
+        self.mrxSessions = mrxSessions
+        if created is None:
+            created = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.created = created
+
+    @classmethod
+    def read(cls,path):
+        planFile = open(path)
+        try:
+            document = json.load(planFile)
+        finally:
+            planFile.close()
+        if document.get('version') != cls.VERSION:
+            raise ValueError("{0} is not a version {1} sync plan".format(path,cls.VERSION))
+        return cls(document['rpacs'],document['mrx'],document['created'])
+
+    def write(self,path):
+        """Write the plan to path, through a temporary file so a plan is
+        never left half written."""
+        document = {'version': self.VERSION,
+                    'created': self.created,
+                    'totals': self.totals(),
+                    'rpacs': self.rpacsPairs,
+                    'mrx': self.mrxSessions}
+        partPath = path+'.part'
+        planFile = open(partPath,'w')
+        try:
+            json.dump(document,planFile,indent=1,sort_keys=True)
+        finally:
+            planFile.close()
+        os.rename(partPath,path)
+        self.logger.info("Wrote the sync plan to {0}".format(path))
+
+    def projectPairs(self):
+        return [(pair['rpacsProject'],pair['predictProject']) for pair in self.rpacsPairs]
+
+    def plannedSessions(self):
+        """The planned rpacs sessions keyed by (rpacs project, predict
+        project), as SyncOrchestrator.run() takes them."""
+        return dict([((pair['rpacsProject'],pair['predictProject']),pair['sessions'])
+                     for pair in self.rpacsPairs])
+
+    def totals(self):
+        rpacsSessions = [session for pair in self.rpacsPairs for session in pair['sessions']]
+        mrxSeries = [series for entry in self.mrxSessions for series in entry['series']]
+        downloads = [series for series in mrxSeries if series['source'] == 'xnat']
+        return {'rpacsSessions': len(rpacsSessions),
+                'rpacsSubjectsCreated': len(set([(pair['predictProject'],session['subjectLabel'])
+                                                 for pair in self.rpacsPairs for session in pair['sessions']
+                                                 if session['createSubject']])),
+                'rpacsBytes': _sum(rpacsSessions,'bytes'),
+                'rpacsSeconds': _sum(rpacsSessions,'seconds'),
+                'rpacsUnestimated': len([session for session in rpacsSessions if session['seconds'] is None]),
+                'mrxSessions': len(self.mrxSessions),
+                'mrxSeries': len(mrxSeries),
+                'mrxCachedSeries': len(mrxSeries)-len(downloads),
+                'mrxDownloadBytes': _sum(downloads,'bytes'),
+                'mrxSeconds': _sum(mrxSeries,'seconds'),
+                'mrxUnestimated': len([series for series in mrxSeries if series['seconds'] is None])}
+
+    def report(self):
+        totals = self.totals()
+        lines = ["Sync plan made {0}:".format(self.created),
+                 "rpacs to predict: {rpacsSessions} sessions, {rpacsSubjectsCreated} new subjects, "
+                 "about {0:.1f} GB and {1:.0f} minutes".format(totals['rpacsBytes']/1024.0**3,
+                                                              totals['rpacsSeconds']/60.0,**totals),
+                 "predict to MRx: {mrxSeries} series of {mrxSessions} sessions, {mrxCachedSeries} "
+                 "from the DICOM cache, about {0:.1f} GB to download and {1:.0f} minutes".format(
+                     totals['mrxDownloadBytes']/1024.0**3,totals['mrxSeconds']/60.0,**totals)]
+        if totals['rpacsUnestimated'] or totals['mrxUnestimated']:
+            lines.append("No history yet to estimate {rpacsUnestimated} rpacs sessions and "
+                         "{mrxUnestimated} MRx series, which aren't counted.".format(**totals))
+        return '\n'.join(lines)
+
+def _sum(entries,key):
+    return sum([entry[key] for entry in entries if entry[key] is not None])
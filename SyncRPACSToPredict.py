@@ -1,16 +1,25 @@
 import sys
 import getpass
 import re
-import dicom
 import os
 import shutil
 import subprocess
 import shlex
 from pyxnat import Interface
-import argparse,tempfile,random
+import argparse,tempfile
 sys.path.append('/paulsen/PREDICT_ORIG_DATA/bin')
 import phdUtils
-import logging,glob,datetime
+import logging,glob,datetime,time,threading
+from XnatDownloader import XnatDownloader
+from XnatConnectionPool import XnatHttpError
+from XnatRestClient import XnatRestClient
+from SyncCache import SyncCache
+from SyncState import SyncState
+from StagingManager import StagingManager
+from TimeBudget import TimeBudget
+import DicomHeaders
+import DicomAnonymizer
+from DicomUploader import DicomUploader,UploadError
 
 class ProjectNameError(Exception):
     def __init__(self, value):
@@ -18,95 +27,387 @@ class ProjectNameError(Exception):
     def __str__(self):
         return repr(self.value)
 
+# Projects that may already hold a session uploaded by hand, checked in
+# addition to the target project before anything is copied.
+PREDICT_DUPLICATE_PROJECTS = ['fMRI_COMPAT','HDPILOT','PHD_000']
+
 class SyncRPACStoPredict:
     def __init__(self,rpacsXnat,rpacsCache,predictXnat,
                  predictDicomRemap,predictBaseAnon,
-                 predictDicomScp,insertedAfter):
+                 predictDicomScp,insertedAfter,downloader=None,
+                 studyParamsCache=None,syncState=None,changeDetection='window',
+                 fullReconcileDays=7,dicomCache=None,anonymizer=None,uploader=None,
+                 staging=None,rpacsRestClient=None,predictRestClient=None,
+                 workQueue=None,resumeHours=24,timeBudget=None):
         self.logger = logging.getLogger('SyncTasks.SyncRpacsToPredict')
         self.logger.debug('Creating an instance of syncRPACStoPredict')
         self.rpacsXnat = rpacsXnat
         self.predictXnat = predictXnat
-        self.rpacsProjectName = ''
-        self.predictProjectName = ''
-        self.predictXnatBaseConditions = []
         self.predictDicomRemap = predictDicomRemap
         self.predictBaseAnon = predictBaseAnon
         self.predictDicomScp = predictDicomScp
         self.rpacsCache = rpacsCache
         self.insertedAfter = insertedAfter
-
-    def syncOneRpacsProjectToPredict(self,rpacsProjectName,predictProjectName):
+        if downloader is None:
+            downloader = XnatDownloader()
+        self.downloader = downloader
+        # StudyInstanceUID, StudyDate and StudyTime keyed by rpacs session ID
+        if studyParamsCache is None:
+            studyParamsCache = SyncCache()
+        self.studyParamsCache = studyParamsCache
+        # 'window' looks at sessions inserted after insertedAfter, 'delta' at
+        # sessions inserted or modified since the last successful run.
+        if syncState is None:
+            syncState = SyncState()
+        self.syncState = syncState
+        self.changeDetection = changeDetection
+        self.fullReconcileDays = fullReconcileDays
+        # Keeps what was sent to predict for the MRx sync
+        self.dicomCache = dicomCache
+        # Anonymize in-process when given a DicomAnonymizer and the base
+        # script only uses statements it understands, otherwise DicomRemap
+        # anonymizes while sending.
+        self.anonymizer = anonymizer
+        self.baseAnonRules = None
+        if anonymizer is not None:
+            try:
+                self.baseAnonRules = DicomAnonymizer.parseDasFile(predictBaseAnon)
+            except DicomAnonymizer.DasSyntaxError as e:
+                self.logger.warning("Anonymizing with DicomRemap, {0} can't be parsed: {1}".format(
+                    predictBaseAnon,e))
+                self.anonymizer = None
+        # DicomRemap anonymizes as it sends, so only the python anonymizer
+        # leaves anonymized files behind to cache
+        if self.dicomCache is not None and self.anonymizer is None:
+            self.logger.warning("Not caching DICOM for the MRx sync, it needs the python anonymizer.")
+            self.dicomCache = None
+        # Sends each series to predict on its own
+        if uploader is None:
+            uploader = DicomUploader(predictDicomRemap,predictDicomScp)
+        if uploader.transport != 'scp' and self.anonymizer is None:
+            raise UploadError("Uploading to {0} needs the python anonymizer".format(uploader.target))
+        self.uploader = uploader
+        # Where sessions are downloaded and anonymized, within a byte budget
+        if staging is None:
+            staging = StagingManager()
+        self.staging = staging
+        # Session, scan and subject lookups go over REST, so many sessions
+        # can be looked up at once
+        if rpacsRestClient is None:
+            rpacsRestClient = XnatRestClient.forInterface(rpacsXnat,self.downloader.connectionPool)
+        if predictRestClient is None:
+            predictRestClient = XnatRestClient.forInterface(predictXnat,self.downloader.connectionPool)
+        self.rpacsRestClient = rpacsRestClient
+        self.predictRestClient = predictRestClient
+        # (subject label, date, time) of every session in the indexed
+        # predict projects, plus their StudyInstanceUIDs when xnat has them.
+        self.predictSessionIndex = set()
+        self.predictStudyUIDs = set()
+        self.indexedPredictProjects = set()
+        # rpacs sessions whose unsent series a thread is sending again
+        self.resending = set()
+        # Project pairs may sync in parallel threads.  indexLock guards the
+        # index above, scanIDLock the scan ID database.
+        self.indexLock = threading.Lock()
+        self.scanIDLock = threading.Lock()
+        # Shared with other hosts running the sync, so each session is only
+        # copied by one of them.  None when this host works alone.
+        self.workQueue = workQueue
+        # How old the checkpoints of an interrupted run may be to resume it
+        self.resumeHours = resumeHours
+        # With a deadline, newer sessions go first and no session is copied
+        # that wouldn't be done in time
+        if timeBudget is None:
+            timeBudget = TimeBudget()
+        self.timeBudget = timeBudget
+
+    def syncOneRpacsProjectToPredict(self,rpacsProjectName,predictProjectName,onUploaded=None,
+                                     plannedSessions=None):
+        """ Copy the sessions of rpacsProjectName missing from predict into
+            predictProjectName.  onUploaded, if given, is called with the
+            predict project, subject label and session label of every
+            session sent.  Several project pairs may sync at the same time
+            in different threads.  A session that fails is logged and
+            counted against its retries while the others carry on.  Returns
+            how many failed and will be retried.
+
+            With plannedSessions, the entries planProjectPairs() made for
+            this pair, only those sessions are looked at, without searching
+            rpacs, and the listing's delta mark and checkpoints are left
+            alone. """
         self.logger.info('Starting to sync '+rpacsProjectName+" to "+predictProjectName)
-        self.rpacsProjectName=rpacsProjectName
-        self.predictProjectName=predictProjectName
 
+        self.__checkPredictProjectName(predictProjectName)
+        self.__indexPredictSessions([predictProjectName]+PREDICT_DUPLICATE_PROJECTS)
+        markName = 'rpacs:'+rpacsProjectName+':'+predictProjectName
+        startedOn = datetime.date.today().strftime('%Y%m%d')
+        changedSince = None
+        if plannedSessions is not None:
+            markName = None
+            rpacsSessions = [entry['session'] for entry in plannedSessions]
+            lookups = [(entry['subjectLabel'],(entry['studyInstanceUID'],entry['studyDate'],entry['studyTime']))
+                       for entry in plannedSessions]
+        else:
+            rpacsSessions,changedSince = self.__listRpacsSessions(rpacsProjectName,markName)
+            if self.timeBudget.isLimited():
+                rpacsSessions = sorted(rpacsSessions,key=lambda rpacsSessionData: rpacsSessionData['date'],
+                                       reverse=True)
+            # Look up the subject labels and study parameters of the coming
+            # sessions on the REST client's worker threads
+            lookups = self.rpacsRestClient.imap(lambda rpacsSessionData: self.__lookupRpacsSession(rpacsProjectName,
+                                                                                                 rpacsSessionData),
+                                                rpacsSessions)
+        failures = 0
+        deferred = 0
+        for rpacsSessionData,(rpacsSubjectLabel,studyParams) in zip(rpacsSessions,lookups):
+            rpacsSessionID = rpacsSessionData['session_id']
+            itemKey = 'rpacs:'+rpacsSessionID
+            if self.syncState.isQuarantined(itemKey):
+                self.logger.warn("rpacs session {0} is quarantined, skipping.".format(rpacsSessionID))
+                continue
+            try:
+                status = self.__syncRpacsSession(rpacsProjectName,predictProjectName,rpacsSessionData,
+                                                   rpacsSubjectLabel,studyParams,onUploaded)
+            except Exception as e:
+                self.logger.error("Copying rpacs session {0} to predict failed.".format(rpacsSessionID),
+                                  exc_info=True)
+                if self.syncState.recordFailure(itemKey,e):
+                    self.logger.error("{0} failed {1} times and is quarantined: {2}".format(
+                        itemKey,self.syncState.maxAttempts,e))
+                else:
+                    failures += 1
+                continue
+            self.syncState.recordSuccess(itemKey)
+            if status == 'done' and markName is not None:
+                self.syncState.checkpoint(markName,rpacsSessionID)
+            elif status == 'deferred':
+                deferred += 1
+
+        if failures:
+            self.logger.warn("{0} sessions of {1} failed, they are retried next run.".format(
+                failures,rpacsProjectName))
+        elif deferred:
+            self.logger.info("{0} sessions of {1} were left for the next run.".format(
+                deferred,rpacsProjectName))
+        elif self.changeDetection == 'delta' and markName is not None:
+            self.syncState.markSynced(markName,startedOn,changedSince is None)
+        if markName is not None:
+            self.syncState.finishListing(markName)
+        return failures
+
+    def planProjectPairs(self,projectPairs):
+        """ Work out which sessions syncOneRpacsProjectToPredict() would
+            copy for every (rpacs project, predict project) pair, with the
+            same checks but without creating subjects or copying anything.
+            Study parameters are read from the rpacs headers only for
+            sessions that aren't in the study parameter cache yet.  Returns
+            a list with an entry per pair, holding the sessions to copy
+            with their estimated bytes and seconds, or None where there is
+            no history yet. """
+        plan = []
+        # Sessions planned for an earlier pair, which the later ones skip
+        plannedUIDs = set()
+        plannedIndex = set()
+        for rpacsProjectName,predictProjectName in projectPairs:
+            self.__checkPredictProjectName(predictProjectName)
+            self.__indexPredictSessions([predictProjectName]+PREDICT_DUPLICATE_PROJECTS)
+            markName = 'rpacs:'+rpacsProjectName+':'+predictProjectName
+            rpacsSessions,changedSince = self.__listRpacsSessions(rpacsProjectName,markName)
+            self.logger.info("Planning {0} rpacs sessions of {1}".format(len(rpacsSessions),rpacsProjectName))
+            lookups = self.rpacsRestClient.imap(lambda rpacsSessionData: self.__lookupRpacsSession(rpacsProjectName,
+                                                                                                 rpacsSessionData),
+                                                rpacsSessions)
+            subjectLabels = set(self.predictRestClient.projectSubjects(predictProjectName).values())
+            sessions = []
+            for rpacsSessionData,(rpacsSubjectLabel,studyParams) in zip(rpacsSessions,lookups):
+                rpacsSessionID = rpacsSessionData['session_id']
+                if self.syncState.isQuarantined('rpacs:'+rpacsSessionID):
+                    continue
+                if rpacsSubjectLabel is None:
+                    rpacsSubjectLabel = self.rpacsRestClient.subjectLabel(rpacsProjectName,
+                                                                          rpacsSessionData['subject_id'])
+                createSubject = rpacsSubjectLabel not in subjectLabels
+                if createSubject and not re.search('^\d\d\d\d$',rpacsSubjectLabel):
+                    continue
+                if studyParams is None:
+                    studyParams = self.__getRpacsStudyParams(rpacsSessionID)
+                studyInstanceUID,studyDate,studyTime = studyParams
+                # Series left unsent are sent although the session is in predict
+                unsent = self.syncState.getUnsent('rpacs:'+rpacsSessionID)
+                with self.indexLock:
+                    if (unsent is None and
+                        self.__isSessionInPredict(rpacsSubjectLabel,studyInstanceUID,studyDate,studyTime)):
+                        continue
+                if (studyInstanceUID in plannedUIDs or
+                    (rpacsSubjectLabel,studyDate,studyTime) in plannedIndex):
+                    continue
+                plannedUIDs.add(studyInstanceUID)
+                plannedIndex.add((rpacsSubjectLabel,studyDate,studyTime))
+                sessions.append({'session': rpacsSessionData,
+                                 'subjectLabel': rpacsSubjectLabel,
+                                 'studyInstanceUID': studyInstanceUID,
+                                 'studyDate': studyDate,
+                                 'studyTime': studyTime,
+                                 'createSubject': createSubject,
+                                 'resendScanIDs': unsent and unsent['scanIDs'] or None,
+                                 'bytes': self.syncState.estimateSize('rpacs'),
+                                 'seconds': self.syncState.estimateDuration('rpacs')})
+            plan.append({'rpacsProject': rpacsProjectName,
+                         'predictProject': predictProjectName,
+                         'sessions': sessions})
+        return plan
+
+    def __checkPredictProjectName(self,predictProjectName):
         if not (re.match('PHD',predictProjectName) or re.match('FMRI',predictProjectName)):
             self.logger.critical("Predict project name passed is invalid")
             raise ProjectNameError("Predict Project name not of the form 'PHD_*' or 'FMRI_*'")
-        self.rpacsProjectName = rpacsProjectName
-        self.predictProjectName = predictProjectName
-        self.predictXnatBaseConditions = [('xnat:mrSessionData/PROJECT','=',predictProjectName),'and']
-        rpacsSessions = self.__getRpacsSessions()
-        for rpacsSessionData in rpacsSessions:
-            self.__checkAndFreeDiskSpace()
-            rpacsDate = rpacsSessionData['date']
-            rpacsSubjID = rpacsSessionData['subject_id']
-            rpacsSubjectLabel = self.rpacsXnat.select.project(rpacsProjectName).subject(rpacsSubjID).attrs.get('xnat:subjectData/label')
-            predictSubject = self.predictXnat.select.project(predictProjectName).subject(rpacsSubjectLabel)
-            if not predictSubject.exists():
-                if re.search('^\d\d\d\d$',rpacsSubjectLabel):
-                    # Need to create subject for valid subject labels (\d4)
-                    self.logger.info(rpacsSubjectLabel + " does not exist in predict. Creating...")
-                    predictSubject.create()
-                else:
-                    self.logger.info(rpacsSubjectLabel+","+rpacsDate+" goes in HD_PILOT.")
-                    continue
-            rpacsSession = self.rpacsXnat.select.project(rpacsProjectName).subject(rpacsSubjID).experiment(rpacsSessionData['session_id'])
-            studyInstanceUID,studyDate,studyTime = self.__getRpacsStudyParams(rpacsSession)
-            predictSessions = self.__getPredictSessions(predictProjectName,rpacsSubjectLabel)
-            predictSessionsFMRICompat = self.__getPredictSessions('fMRI_COMPAT',rpacsSubjectLabel)
-            predictSessionsHDPilot = self.__getPredictSessions('HDPILOT',rpacsSubjectLabel)
-            predictSessionsPHD_000 = self.__getPredictSessions('PHD_000',rpacsSubjectLabel)
-            if (self.__isSessionInPredict(predictSessions,studyDate,studyTime) or
-                self.__isSessionInPredict(predictSessionsFMRICompat,studyDate,studyTime) or
-                self.__isSessionInPredict(predictSessionsPHD_000,studyDate,studyTime) or
-                self.__isSessionInPredict(predictSessionsHDPilot,studyDate,studyTime)
-               ):
+
+    def __listRpacsSessions(self,rpacsProjectName,markName):
+        """ The rpacs sessions of a listing still to look at, and the date
+            they were searched from, or None for all of them. """
+        changedSince = None
+        if self.changeDetection == 'delta':
+            changedSince = self.syncState.changedSince(markName,self.fullReconcileDays)
+        rpacsSessions = self.__getRpacsSessions(rpacsProjectName,changedSince)
+        # Sessions an interrupted run of this listing already finished
+        finished = self.syncState.resumeListing(markName,self.resumeHours)
+        if finished:
+            self.logger.info("Resuming {0}, skipping the {1} sessions the interrupted run finished.".format(
+                markName,len(finished)))
+            rpacsSessions = [rpacsSessionData for rpacsSessionData in rpacsSessions
+                             if rpacsSessionData['session_id'] not in finished]
+        return rpacsSessions,changedSince
+
+    def __syncRpacsSession(self,rpacsProjectName,predictProjectName,rpacsSessionData,
+                           rpacsSubjectLabel,studyParams,onUploaded):
+        """ Copy one rpacs session to predict unless it is there already.
+            Series an earlier run couldn't upload are sent again, whether or
+            not the session is in predict by now.  Returns 'done',
+            'deferred' if copying it wouldn't finish before the deadline, or
+            'elsewhere' if another host is copying it. """
+        rpacsDate = rpacsSessionData['date']
+        rpacsSessionID = rpacsSessionData['session_id']
+        unsent = self.syncState.getUnsent('rpacs:'+rpacsSessionID)
+        if unsent is not None:
+            return self.__resendSeries(rpacsSessionID,unsent,onUploaded)
+        if rpacsSubjectLabel is None:
+            rpacsSubjectLabel = self.rpacsRestClient.subjectLabel(rpacsProjectName,
+                                                                  rpacsSessionData['subject_id'])
+        if not self.predictRestClient.subjectExists(predictProjectName,rpacsSubjectLabel):
+            if re.search('^\d\d\d\d$',rpacsSubjectLabel):
+                # Need to create subject for valid subject labels (\d4)
+                self.logger.info(rpacsSubjectLabel + " does not exist in predict. Creating...")
+                self.predictRestClient.createSubject(predictProjectName,rpacsSubjectLabel)
+            else:
+                self.logger.info(rpacsSubjectLabel+","+rpacsDate+" goes in HD_PILOT.")
+                return 'done'
+        if studyParams is None:
+            studyParams = self.__getRpacsStudyParams(rpacsSessionID)
+        studyInstanceUID,studyDate,studyTime = studyParams
+        with self.indexLock:
+            if self.__isSessionInPredict(rpacsSubjectLabel,studyInstanceUID,studyDate,studyTime):
                 self.logger.info("{0},{1},{2} Exits in predict, skipping.".format(
                     rpacsSubjectLabel,rpacsDate,studyTime))
-                continue
-            self.logger.info(rpacsSubjectLabel+","+rpacsDate+","+studyTime+" doesn't exist in predict xnat.")
-            # Get the site from the project name
-            predictSite = self.__getPredictSite(predictProjectName)
-
-            # Need to generate a scanID
-            self.logger.info('Generating a new scan ID.')
+                return 'done'
+            # Leave it for the next run if it can't be copied in time
+            estimate = self.timeBudget.estimate('rpacs')
+            if not self.timeBudget.allows(estimate):
+                self.timeBudget.defer("{0},{1},{2} to {3}".format(rpacsSubjectLabel,rpacsDate,studyTime,
+                                                                  predictProjectName),estimate)
+                return 'deferred'
+            # Other rpacs projects must see this session as already
+            # copied, including those syncing at the same time.
+            self.predictSessionIndex.add((rpacsSubjectLabel,studyDate,studyTime))
+            self.predictStudyUIDs.add(studyInstanceUID)
+        self.logger.info(rpacsSubjectLabel+","+rpacsDate+","+studyTime+" doesn't exist in predict xnat.")
+        workKey = 'rpacs:'+studyInstanceUID
+        if self.workQueue is not None and not self.workQueue.claim(workKey):
+            self.logger.info("{0},{1} is being copied by another host, skipping.".format(
+                rpacsSubjectLabel,rpacsDate))
+            return 'elsewhere'
+        # Get the site from the project name
+        predictSite = self.__getPredictSite(predictProjectName)
+
+        # Need to generate a scanID
+        self.logger.info('Generating a new scan ID.')
+        with self.scanIDLock:
             newScanID = phdUtils.getOrCreateScanID(predictSite,rpacsSubjectLabel,rpacsDate,studyTime,studyInstanceUID,'msscully','false')
-            self.logger.info("    New scanID="+str(newScanID))
-
-            dicomDirs = self.__downloadScans(rpacsSession)
-            self.__uploadScanToPredict(dicomDirs,newScanID,predictProjectName,rpacsSubjectLabel)
+        self.logger.info("    New scanID="+str(newScanID))
+        return self.__copySession(rpacsSessionID,None,str(newScanID),predictProjectName,
+                                  rpacsSubjectLabel,studyInstanceUID,workKey,onUploaded)
+
+    def __resendSeries(self,rpacsSessionID,unsent,onUploaded):
+        """ Send the series of a session an earlier run couldn't upload,
+            under the scan ID the session was given then. """
+        description = "series {0} of {1},{2} to {3}".format(",".join(unsent['scanIDs']),
+                                                            unsent['subjectLabel'],unsent['sessionLabel'],
+                                                            unsent['predictProject'])
+        with self.indexLock:
+            if rpacsSessionID in self.resending:
+                return 'done'
+            estimate = self.timeBudget.estimate('rpacs')
+            if not self.timeBudget.allows(estimate):
+                self.timeBudget.defer(description,estimate)
+                return 'deferred'
+            self.resending.add(rpacsSessionID)
+        try:
+            workKey = 'rpacs:'+unsent['studyInstanceUID']
+            if self.workQueue is not None and not self.workQueue.claim(workKey):
+                self.logger.info("{0} is being sent by another host, skipping.".format(description))
+                return 'elsewhere'
+            self.logger.info("Sending {0} again.".format(description))
+            return self.__copySession(rpacsSessionID,unsent['scanIDs'],unsent['sessionLabel'],
+                                      unsent['predictProject'],unsent['subjectLabel'],
+                                      unsent['studyInstanceUID'],workKey,onUploaded)
+        finally:
+            with self.indexLock:
+                self.resending.discard(rpacsSessionID)
+
+    def __copySession(self,rpacsSessionID,scanIDs,newScanID,predictProjectName,rpacsSubjectLabel,
+                      studyInstanceUID,workKey,onUploaded):
+        """ Download the scans of an rpacs session, or just those in
+            scanIDs, and upload them to predict as session newScanID.  The
+            caller holds workKey.  Series that can't be uploaded are
+            recorded in syncState to be sent again next run. """
+        itemKey = 'rpacs:'+rpacsSessionID
+        startTime = time.time()
+        stagingDir = self.staging.allocate(rpacsSessionID)
+        sentDirs,failedDirs = [],[]
+        try:
+            scanIDs,dicomDirs,downloadBytes = self.__downloadScans(rpacsSessionID,stagingDir,scanIDs)
+            settledDir = self.staging.settle(stagingDir)
+            if settledDir != stagingDir:
+                dicomDirs = [os.path.join(settledDir,os.path.basename(dir)) for dir in dicomDirs]
+                stagingDir = settledDir
+            sentDirs,failedDirs = self.__uploadScanToPredict(dicomDirs,newScanID,predictProjectName,
+                                                             rpacsSubjectLabel,stagingDir)
+            # sentDirs are only anonymized copies when the anonymizer wrote them
+            if self.dicomCache is not None and self.anonymizer is not None:
+                for dir in [dir for dir in sentDirs if dir not in failedDirs]:
+                    self.dicomCache.ingest(dir,predictProjectName,rpacsSubjectLabel,
+                                           newScanID,move=True)
+        finally:
             # Remove the temporary directories
-            for dir in dicomDirs:
-                shutil.rmtree(dir)
-
-    def __checkAndFreeDiskSpace(self):
-        diskObj = os.statvfs(self.rpacsCache)
-        capacity = diskObj.f_bsize * diskObj.f_blocks
-        available = diskObj.f_bsize * diskObj.f_bavail
-        percentFree = available / capacity
-        # If not enough disk space, delete image files in cache older than 10 minutes.
-        if percentFree <= 0.15:
-            tempDicoms = glob.glob(self.rpacsCache+"/*.dcm")
-            timeThresh = datetime.datetime.now() - datetime.timedelta(minutes=30)
-            timeThresh = timeThresh.timetuple()
-            for image in tempDicoms:
-                imageWithPath = os.path.join(self.rpacsCache,image)
-                fileTimeSecs = os.path.getmtime(imageWithPath)
-                fileTime = localtime(fileTimeSecs)
-                if fileTime <= timeThresh:
-                    # File is old, delete it
-                    os.remove(imageWithPath)
+            self.staging.release(stagingDir)
+            if self.workQueue is not None:
+                self.workQueue.finish(workKey,bool(sentDirs) and not failedDirs)
+        if onUploaded is not None and len(failedDirs) < len(sentDirs):
+            onUploaded(predictProjectName,rpacsSubjectLabel,newScanID)
+        if failedDirs:
+            # sentDirs holds a directory per scan, in the order of scanIDs
+            self.syncState.recordUnsent(itemKey,
+                                        {'predictProject': predictProjectName,
+                                         'subjectLabel': rpacsSubjectLabel,
+                                         'sessionLabel': newScanID,
+                                         'studyInstanceUID': studyInstanceUID,
+                                         'scanIDs': [scanID for scanID,dir in zip(scanIDs,sentDirs)
+                                                     if dir in failedDirs]})
+            raise UploadError("{0} of {1} series of {2} could not be uploaded".format(
+                len(failedDirs),len(sentDirs),newScanID))
+        self.syncState.clearUnsent(itemKey)
+        self.syncState.recordDuration('rpacs',time.time()-startTime)
+        self.syncState.recordSize('rpacs',downloadBytes)
+        return 'done'
 
     def __getPredictSite(self,predictProjectName):
         predictSite = ''
@@ -119,114 +420,196 @@ class SyncRPACStoPredict:
             raise ProjectNameError("Predict Project name not of the form 'PHD_*' or 'FMRI_*'")
         return predictSite
 
-    def __uploadScanToPredict(self,dicomDirs,newScanID,predictProjectName,rpacsSubjectLabel):
-        " upload images to predict xnat"
+    def __uploadScanToPredict(self,dicomDirs,newScanID,predictProjectName,rpacsSubjectLabel,
+                              stagingDir):
+        """ upload images to predict xnat, each series on its own.  Returns
+            the directories holding the files as they were sent, and those
+            of the series that could not be sent. """
         self.logger.info("Starting upload of {0} to predict project {1}".format(
             newScanID, predictProjectName))
-        dicomRemap = self.predictDicomRemap
         baseAnon = self.predictBaseAnon
-        dicomScp = self.predictDicomScp
-        tempAnonDir = tempfile.mkdtemp()
-        anonScript = tempAnonDir+"/anon-"+predictProjectName+"_"+rpacsSubjectLabel+"_"+str(newScanID)+".das"
-        shutil.copy(baseAnon,anonScript)
-        anonOut = open(anonScript,'a')
-        anonOut.write("// TODO: fix this later\n")
-        anonOut.write("//(0008,103e) := $ { SERIES_DESCRIPTION }\n")
-        anonOut.write('\n')
-        anonOut.write("// Note: this part isn't suitable for DicomRemap, which doesn't\n")
-        anonOut.write("// yet handle user-assigned variables.\n")
-        anonOut.write("(0020,0010) := \"{0}\"\n".format('site-024'))
-        anonOut.write("(0008,0050) := \"{0}\"\n".format(predictProjectName))
-        anonOut.write("(0008,1030) := \"{0}\"\n".format(predictProjectName))
-        anonOut.write("(0010,0010) := \"{0}\"\n".format(rpacsSubjectLabel))
-        anonOut.write("(0010,0020) := \"{0}\"\n".format(newScanID))
+        sessionAnon = self.__sessionAnonLines(newScanID,predictProjectName,rpacsSubjectLabel)
+        anonScript = None
+        if self.anonymizer is not None:
+            rules = self.baseAnonRules + DicomAnonymizer.parseDasLines(sessionAnon)
+            sentDirs = []
+            for dicomDir in dicomDirs:
+                anonDir = tempfile.mkdtemp(dir=stagingDir)
+                self.anonymizer.anonymizeDir(dicomDir,anonDir,rules)
+                sentDirs.append(anonDir)
+            self.staging.measure(stagingDir)
+        else:
+            # Removed with the rest of the staging directory
+            tempAnonDir = tempfile.mkdtemp(dir=stagingDir)
+            anonScript = tempAnonDir+"/anon-"+predictProjectName+"_"+rpacsSubjectLabel+"_"+str(newScanID)+".das"
+            shutil.copy(baseAnon,anonScript)
+            anonOut = open(anonScript,'a')
+            anonOut.writelines(sessionAnon)
+            anonOut.close()
+            sentDirs = list(dicomDirs)
+
+        failedDirs = self.uploader.uploadSession(sentDirs,predictProjectName,rpacsSubjectLabel,
+                                                 str(newScanID),anonScript)
+        if failedDirs:
+            self.logger.critical("{0} of {1} series of {2} could not be uploaded to predict: {3}".format(
+                len(failedDirs),len(sentDirs),newScanID," ".join(failedDirs)))
+        return sentDirs,failedDirs
+
+    def __sessionAnonLines(self,newScanID,predictProjectName,rpacsSubjectLabel):
+        " the anonymization statements added to the base script for one session"
+        anonLines = []
+        anonLines.append("// TODO: fix this later\n")
+        anonLines.append("//(0008,103e) := $ { SERIES_DESCRIPTION }\n")
+        anonLines.append('\n')
+        anonLines.append("// Note: this part isn't suitable for DicomRemap, which doesn't\n")
+        anonLines.append("// yet handle user-assigned variables.\n")
+        anonLines.append("(0020,0010) := \"{0}\"\n".format('site-024'))
+        anonLines.append("(0008,0050) := \"{0}\"\n".format(predictProjectName))
+        anonLines.append("(0008,1030) := \"{0}\"\n".format(predictProjectName))
+        anonLines.append("(0010,0010) := \"{0}\"\n".format(rpacsSubjectLabel))
+        anonLines.append("(0010,0020) := \"{0}\"\n".format(newScanID))
         ##  http://www.xnat.org/DicomServer has notes regarding the exact formatting of this field
-        anonOut.write("(0010,4000) := \"Project: {0}; Subject: {1}; Session: {2}; AA:true\"\n".format(predictProjectName,rpacsSubjectLabel,newScanID))
-        anonOut.close()
-
-        ##  # All the directories to anonimize
-        dicomDirs = " ".join(dicomDirs)
-
-        remapCommand=dicomRemap+" -d "+anonScript+" -o "+dicomScp+" "+ dicomDirs
-        self.logger.debug(remapCommand)
-        command_list=[dicomRemap, '-d '+anonScript, '-o '+dicomScp, dicomDirs]
-
-        try:
-            tmpOutput = phdUtils.check_output(command_list,stderr=subprocess.STDOUT)
-            if re.search('Exception',tmpOutput):
-                self.logger.critical("An exception occurred while running the dicom remap command. Output follows.\n"+tmpOutput)
-            self.logger.debug(tmpOutput)
-        except Exception as e:
-            self.logger.critical("An Exception occurred when running the dicom remap command! " + e)
-            exit(1)
-
-    def __downloadScans(self,rpacsSession):
-        " download session from rpacs xnat"
-        self.logger.info('Downloading scans from rpacs, session {0}.'.format(rpacsSession))
-        tempScanDir = tempfile.mkdtemp()
+        anonLines.append("(0010,4000) := \"Project: {0}; Subject: {1}; Session: {2}; AA:true\"\n".format(predictProjectName,rpacsSubjectLabel,newScanID))
+        return anonLines
+
+    def __downloadScans(self,rpacsSessionID,tempScanDir,scanIDs=None):
+        """ download session from rpacs xnat into tempScanDir, or only the
+            scans in scanIDs.  Returns the scan IDs, a dir for each and the
+            size. """
+        self.logger.info('Downloading scans from rpacs, session {0}.'.format(rpacsSessionID))
         dicomDirs = []
-        rpacsScans = rpacsSession.scans()
-        for scan in rpacsScans:
+        scanDirs = {}
+        downloadIDs = []
+        for scan in self.rpacsRestClient.listScans(rpacsSessionID):
+            if scanIDs is not None and scan['ID'] not in scanIDs:
+                continue
+            downloadIDs.append(scan['ID'])
             tempDir = tempfile.mkdtemp(dir=tempScanDir)
             dicomDirs.append(tempDir)
-            resource = scan.resource('DICOM')
-            files = resource.files()
-            for file in files:
-              path = os.path.join(tempDir,file.id())
-              file.get_copy(path)
-              #os.symlink(os.path.join(self.rpacsCache,file.id()),path)
-              # This should really be implemented as a getter instead of accessing the private variable!
-              #os.symlink(os.path.join(self.rpacsXnat.cache._cache.cache,file.id()),path)
-        return dicomDirs
-
-    def __isSessionInPredict(self,predictSessions,studyDate,studyTime):
-        self.logger.debug('Does the session exist in predict?')
-        for session in predictSessions:
-            tempDate = session['date'].replace('-','')
-            tempTime = session['time'].replace(':','')
-            self.logger.debug('tempDate='+tempDate+', tempTime='+tempTime+', studyDate='+studyDate+', studyTime='+studyTime)
-            if tempDate == studyDate and tempTime == studyTime:
-                return True
-        return False
-
-    def __getRpacsStudyParams(self,rpacsSession):
-        rpacsFile = self.__getRandomRpacsDicomFile(rpacsSession)
-        tempDicomData = dicom.read_file(rpacsFile.get())
+            scanDirs[scan['ID']] = tempDir
+        byteCount = self.downloader.downloadSession(self.rpacsXnat,rpacsSessionID,scanDirs)
+        self.staging.charge(tempScanDir,byteCount)
+        return downloadIDs,dicomDirs,byteCount
+
+    def __isSessionInPredict(self,subjectLabel,studyInstanceUID,studyDate,studyTime):
+        self.logger.debug('Does the session exist in predict? subjectLabel='+subjectLabel+
+                          ', studyDate='+studyDate+', studyTime='+studyTime)
+        return (studyInstanceUID in self.predictStudyUIDs or
+                (subjectLabel,studyDate,studyTime) in self.predictSessionIndex)
+
+    def __lookupRpacsSession(self,rpacsProjectName,rpacsSessionData):
+        """ Runs on a REST client worker.  Returns the subject label and the
+            study parameters of an rpacs session, or None for either if it
+            couldn't be read, so the main thread tries again and reports the
+            error. """
+        try:
+            subjectLabel = self.rpacsRestClient.subjectLabel(rpacsProjectName,
+                                                             rpacsSessionData['subject_id'])
+        except Exception:
+            return None,None
+        try:
+            studyParams = self.__getRpacsStudyParams(rpacsSessionData['session_id'])
+        except Exception:
+            studyParams = None
+        return subjectLabel,studyParams
+
+    def __getRpacsStudyParams(self,sessionID):
+        studyParams = self.studyParamsCache.get(sessionID)
+        if studyParams is not None:
+            self.logger.debug('Using cached study parameters for {0}'.format(sessionID))
+            return studyParams
+        rpacsFileUri = self.__getRpacsDicomFileUri(sessionID)
+        # StudyInstanceUID (0020,000D) is the last of the three tags needed.
+        tempDicomData = DicomHeaders.probeRemoteHeader(self.rpacsRestClient.connectionPool,
+                                                       self.rpacsRestClient.serverUrl,
+                                                       rpacsFileUri,
+                                                       ['StudyInstanceUID','StudyDate','StudyTime'],
+                                                       0x0020000D)
         studyInstanceUID = tempDicomData.StudyInstanceUID
         studyDate = tempDicomData.StudyDate
         studyTime = tempDicomData.StudyTime
         rpacsTime = re.sub('\.\d+','',studyTime)
-        return studyInstanceUID,studyDate,rpacsTime
-
-    def __getRandomRpacsDicomFile(self,rpacsSession):
-        rpacsScans = rpacsSession.scans().get()
-        randomScan = str(random.randint(0,len(rpacsScans)-1))
-        rpacsScan = rpacsSession.scan(randomScan)
-        rpacsFiles = rpacsSession.scans().resource('DICOM').files()
-        rpacsFile = rpacsFiles.first()
-        return rpacsFile
-
-    def __getPredictSessions(self,predictProjectName,rpacsSubjectLabel):
-        self.logger.info("Fetching predict sessions in {0} for subject {1}".format(
-            predictProjectName,rpacsSubjectLabel))
-        predictXnatConditions = [('xnat:mrSessionData/PROJECT','=',predictProjectName),'and']
-        predictXnatConditions.extend([('xnat:subjectData/label','=',rpacsSubjectLabel),'and'])
-        predictSessions=self.predictXnat.select('xnat:mrSessionData').where(predictXnatConditions)
-        self.logger.debug('len(predictSessions)='+str(len(predictSessions)))
-        #predictSessions=self.predictXnat.select.project(predictProjectName).subject(rpacsSubjectLabel).experiments()
-        return predictSessions
-
-    def __getRpacsSessions(self):
-        " get all sessions in RPACS for rpacsProjectName"
+        studyParams = (studyInstanceUID,studyDate,rpacsTime)
+        self.studyParamsCache.set(sessionID,studyParams)
+        return studyParams
+
+    def __getRpacsDicomFileUri(self,sessionID):
+        """ Return the uri of the first DICOM file in the first scan that has one. """
+        for scan in self.rpacsRestClient.listScans(sessionID):
+            files = self.rpacsRestClient.listScanFiles(sessionID,scan['ID'])
+            if files:
+                return files[0]['URI']
+        raise XnatHttpError('No DICOM files found in rpacs session {0}'.format(sessionID))
+
+    def __indexPredictSessions(self,predictProjectNames):
+        """ Add every session in predictProjectNames that isn't indexed yet to
+            the predict session index.  Takes one session search however
+            many sessions the projects hold.  The subject label comes with
+            each session, so subjects shared into the projects from others
+            are found too. """
+        with self.indexLock:
+            newProjects = [name for name in predictProjectNames if name not in self.indexedPredictProjects]
+            if not newProjects:
+                return
+            self.logger.info("Indexing predict sessions in {0}".format(",".join(newProjects)))
+            sessionConditions = [('xnat:mrSessionData/PROJECT','=',name) for name in newProjects]
+            sessionConditions.append('OR')
+            predictSessions = self.predictRestClient.search('xnat:mrSessionData',
+                                                            ['xnat:mrSessionData/PROJECT',
+                                                             'xnat:mrSessionData/SUBJECT_ID',
+                                                             'xnat:mrSessionData/SUBJECT_LABEL',
+                                                             'xnat:mrSessionData/DATE',
+                                                             'xnat:mrSessionData/TIME',
+                                                             'xnat:mrSessionData/UID'],
+                                                            sessionConditions)
+            for session in predictSessions:
+                subjectLabel = session['subject_label']
+                if not subjectLabel:
+                    self.logger.warn("No subject label for {0} in the session search, looking it up.".format(
+                        session['subject_id']))
+                    try:
+                        subjectLabel = self.predictRestClient.subjectLabel(session['project'],
+                                                                           session['subject_id'])
+                    except XnatHttpError:
+                        self.logger.error("Subject {0} of {1} could not be looked up, its sessions may be "
+                                          "copied again.".format(session['subject_id'],session['project']),
+                                          exc_info=True)
+                        continue
+                self.predictSessionIndex.add((subjectLabel,
+                                              session['date'].replace('-',''),
+                                              session['time'].replace(':','')))
+                if session.get('uid'):
+                    self.predictStudyUIDs.add(session['uid'])
+            self.indexedPredictProjects.update(newProjects)
+            self.logger.debug('len(predictSessions)='+str(len(predictSessions)))
+
+    def __getRpacsSessions(self,rpacsProjectName,changedSince=None):
+        """ get the sessions in RPACS for rpacsProjectName inserted after
+            insertedAfter, or in delta mode inserted or modified, or with a
+            scan modified, since changedSince, or all of them when
+            changedSince is None. """
         self.logger.info('Fetching rpacs sessions')
-        xnatBaseConditions = [('xnat:mrSessionData/PROJECT','=',self.rpacsProjectName),'and',
-                             ('xnat:mrSessionData/INSERT_DATE','>=',self.insertedAfter),'and']
+        if self.changeDetection != 'delta':
+            xnatBaseConditions = [('xnat:mrSessionData/PROJECT','=',rpacsProjectName),'and',
+                                 ('xnat:mrSessionData/INSERT_DATE','>=',self.insertedAfter),'and']
+        elif changedSince is None:
+            self.logger.info('Reconciling every session in '+rpacsProjectName)
+            xnatBaseConditions = [('xnat:mrSessionData/PROJECT','=',rpacsProjectName),'and']
+        else:
+            xnatBaseConditions = [('xnat:mrSessionData/PROJECT','=',rpacsProjectName),
+                                 [('xnat:mrSessionData/INSERT_DATE','>=',changedSince),
+                                  ('xnat:mrSessionData/LAST_MODIFIED','>=',changedSince),'OR'],'AND']
         xnatConditions = list(xnatBaseConditions)
-        xnatSessions=self.rpacsXnat.select.project(self.rpacsProjectName).subjects().experiments().get()
-        sessions=self.rpacsXnat.select('xnat:mrSessionData',
-                                       ['xnat:mrSessionData/subject_id',
-                                        'xnat:mrSessionData/Date',
-                                        'xnat:mrSessionData/SESSION_ID']).where(xnatConditions)
+        sessionFields = ['xnat:mrSessionData/SUBJECT_ID',
+                         'xnat:mrSessionData/DATE',
+                         'xnat:mrSessionData/SESSION_ID']
+        sessions=self.rpacsRestClient.search('xnat:mrSessionData',sessionFields,xnatConditions)
+        if self.changeDetection == 'delta' and changedSince is not None:
+            # A scan added or edited later may not touch the session itself
+            listed = set([session['session_id'] for session in sessions])
+            sessions.extend([session for session in self.rpacsRestClient.sessionsWithChangedScans(
+                                 sessionFields,('xnat:mrSessionData/PROJECT','=',rpacsProjectName),changedSince)
+                             if session['session_id'] not in listed])
         return sessions
 
 
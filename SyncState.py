@@ -0,0 +1,318 @@
+import json
+import logging
+import sqlite3
+import datetime
+import threading
+
+# How many recent samples a duration or size average is taken over
+AVERAGE_SAMPLES = 20
+
+class SyncState:
+    """Local record of what the MRx sync has already done, kept in a SQLite
+    database so a run can tell which series are finished without asking
+    xnat or looking at the filesystem.
+
+    sessions holds the labels of each xnat session seen so far and whether
+    its field strength has been written back.  marks holds, per session
+    listing, the date up to which every change has been synced and when
+    the listing was last reconciled in full.  series holds, per project,
+    subject, session and series number, the scan type and quality the
+    series was converted with, the conversion status and the output files
+    with their sizes and md5 checksums.
+
+    failures counts the failed attempts at each work item, such as a series
+    or a session, until it succeeds.  After maxAttempts it is quarantined
+    and left alone until released.  unsent holds, per rpacs session, the
+    series that couldn't be uploaded to predict and where they go, so
+    they are sent again although the rest of the session arrived.
+    checkpoints holds the items each listing finished in a run that hasn't
+    finished yet, so an interrupted run can be resumed without looking at
+    them again.  durations and sizes
+    hold the running averages of how long each kind of work item took and
+    how many bytes it moved, for estimating what fits in the time left and
+    what a run will cost.  Safe to share between threads.
+    """
+    def __init__(self,path=':memory:',maxAttempts=3):
+        self.logger = logging.getLogger('SyncTasks.SyncState')
+        self.path = path
+        self.maxAttempts = maxAttempts
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path,check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    project TEXT,
+                    subject_label TEXT,
+                    session_label TEXT,
+                    field_strength_set INTEGER DEFAULT 0,
+                    updated TEXT);
+                CREATE TABLE IF NOT EXISTS series (
+                    project TEXT,
+                    subject_label TEXT,
+                    session_label TEXT,
+                    series_number TEXT,
+                    scan_type TEXT,
+                    quality TEXT,
+                    usable INTEGER,
+                    status TEXT,
+                    outputs TEXT,
+                    updated TEXT,
+                    PRIMARY KEY (project,subject_label,session_label,series_number));
+                CREATE TABLE IF NOT EXISTS marks (
+                    name TEXT PRIMARY KEY,
+                    synced_through TEXT,
+                    last_full TEXT);
+                CREATE TABLE IF NOT EXISTS failures (
+                    item TEXT PRIMARY KEY,
+                    attempts INTEGER,
+                    quarantined INTEGER,
+                    error TEXT,
+                    updated TEXT);
+                CREATE TABLE IF NOT EXISTS unsent (
+                    item TEXT PRIMARY KEY,
+                    details TEXT,
+                    updated TEXT);
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    name TEXT,
+                    item TEXT,
+                    updated TEXT,
+                    PRIMARY KEY (name,item));
+                CREATE TABLE IF NOT EXISTS durations (
+                    kind TEXT PRIMARY KEY,
+                    seconds REAL,
+                    samples INTEGER,
+                    updated TEXT);
+                CREATE TABLE IF NOT EXISTS sizes (
+                    kind TEXT PRIMARY KEY,
+                    bytes REAL,
+                    samples INTEGER,
+                    updated TEXT);
+                """)
+            self.connection.commit()
+
+    def getSession(self,sessionID):
+        """Return the recorded labels of an xnat session as a dict, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM sessions WHERE session_id=?",(sessionID,)).fetchone()
+        if row is None:
+            return None
+        return {'project': row['project'],
+                'subjectLabel': row['subject_label'],
+                'sessionLabel': row['session_label'],
+                'fieldStrengthSet': bool(row['field_strength_set'])}
+
+    def recordSession(self,sessionID,project,subjectLabel,sessionLabel,fieldStrengthSet):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?,?,?,?,?,?)",
+                (sessionID,project,subjectLabel,sessionLabel,int(fieldStrengthSet),_now()))
+            self.connection.commit()
+
+    def getSeries(self,project,subjectLabel,sessionLabel,seriesNumber):
+        """Return the recorded state of a series as a dict, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM series WHERE project=? AND subject_label=? AND "
+                "session_label=? AND series_number=?",
+                (project,subjectLabel,sessionLabel,seriesNumber)).fetchone()
+        if row is None:
+            return None
+        return {'scanType': row['scan_type'],
+                'quality': row['quality'],
+                'usable': bool(row['usable']),
+                'status': row['status'],
+                'outputs': json.loads(row['outputs'] or '[]'),
+                'updated': row['updated']}
+
+    def recordSeries(self,project,subjectLabel,sessionLabel,seriesNumber,
+                     scanType,quality,usable,status,outputs):
+        """Record a series.  outputs is a list of dicts with 'path', 'size'
+        and 'md5' keys."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO series VALUES (?,?,?,?,?,?,?,?,?,?)",
+                (project,subjectLabel,sessionLabel,seriesNumber,scanType,quality,
+                 int(usable),status,json.dumps(outputs),_now()))
+            self.connection.commit()
+
+    def changedSince(self,name,fullReconcileDays):
+        """Return the date, as YYYYMMDD, from which the listing called name
+        has to look for new or modified sessions.  Returns None when the
+        listing was never synced, or not fully reconciled in the last
+        fullReconcileDays days, and so has to look at every session."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM marks WHERE name=?",(name,)).fetchone()
+        if row is None or row['last_full'] is None:
+            return None
+        lastFull = datetime.datetime.strptime(row['last_full'],'%Y%m%d')
+        if datetime.datetime.now() - lastFull >= datetime.timedelta(fullReconcileDays):
+            return None
+        return row['synced_through']
+
+    def markSynced(self,name,startedOn,full):
+        """Record that every change the listing called name found up to
+        startedOn (YYYYMMDD, the day its search ran) has been synced.  Only
+        call this once the whole listing has synced without errors."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT last_full FROM marks WHERE name=?",(name,)).fetchone()
+            lastFull = startedOn
+            if not full and row is not None:
+                lastFull = row['last_full']
+            self.connection.execute(
+                "INSERT OR REPLACE INTO marks VALUES (?,?,?)",(name,startedOn,lastFull))
+            self.connection.commit()
+
+    def recordFailure(self,item,error):
+        """Count a failed attempt at item.  Returns True if that
+        quarantined it."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT attempts FROM failures WHERE item=?",(item,)).fetchone()
+            attempts = 1
+            if row is not None:
+                attempts = row['attempts']+1
+            quarantined = attempts >= self.maxAttempts
+            self.connection.execute(
+                "INSERT OR REPLACE INTO failures VALUES (?,?,?,?,?)",
+                (item,attempts,int(quarantined),str(error),_now()))
+            self.connection.commit()
+        return quarantined
+
+    def recordSuccess(self,item):
+        """Forget the failed attempts at item."""
+        with self.lock:
+            if self.connection.execute(
+                    "SELECT 1 FROM failures WHERE item=?",(item,)).fetchone() is None:
+                return
+            self.connection.execute("DELETE FROM failures WHERE item=?",(item,))
+            self.connection.commit()
+
+    def isQuarantined(self,item):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT quarantined FROM failures WHERE item=?",(item,)).fetchone()
+        return row is not None and bool(row['quarantined'])
+
+    def quarantined(self):
+        """Return the quarantined items as a list of dicts with 'item',
+        'attempts', 'error' and 'updated' keys."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM failures WHERE quarantined=1 ORDER BY item").fetchall()
+        return [{'item': row['item'],
+                 'attempts': row['attempts'],
+                 'error': row['error'],
+                 'updated': row['updated']} for row in rows]
+
+    def releaseQuarantine(self):
+        """Give every quarantined item maxAttempts more attempts.  Returns
+        how many there were."""
+        with self.lock:
+            count = self.connection.execute(
+                "DELETE FROM failures WHERE quarantined=1").rowcount
+            self.connection.commit()
+        return count
+
+    def recordUnsent(self,item,details):
+        """Record what of item is still to be sent, as a dict that can be
+        stored as JSON, in place of what was recorded before."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO unsent VALUES (?,?,?)",(item,json.dumps(details),_now()))
+            self.connection.commit()
+
+    def getUnsent(self,item):
+        """Return what recordUnsent() recorded for item, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT details FROM unsent WHERE item=?",(item,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row['details'])
+
+    def clearUnsent(self,item):
+        with self.lock:
+            if self.connection.execute(
+                    "SELECT 1 FROM unsent WHERE item=?",(item,)).fetchone() is None:
+                return
+            self.connection.execute("DELETE FROM unsent WHERE item=?",(item,))
+            self.connection.commit()
+
+    def resumeListing(self,name,maxAgeHours):
+        """Return the set of items the listing called name finished in an
+        earlier run that never finished, if that was less than maxAgeHours
+        ago.  Older checkpoints are dropped."""
+        oldest = (datetime.datetime.now()-datetime.timedelta(hours=maxAgeHours)).strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM checkpoints WHERE name=? AND updated<?",(name,oldest))
+            self.connection.commit()
+            rows = self.connection.execute(
+                "SELECT item FROM checkpoints WHERE name=?",(name,)).fetchall()
+        return set([row['item'] for row in rows])
+
+    def checkpoint(self,name,item):
+        """Record that the listing called name has finished item."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?,?,?)",(name,item,_now()))
+            self.connection.commit()
+
+    def finishListing(self,name):
+        """Drop the checkpoints of the listing called name once it has
+        gone through all its items."""
+        with self.lock:
+            self.connection.execute("DELETE FROM checkpoints WHERE name=?",(name,))
+            self.connection.commit()
+
+    def recordDuration(self,kind,seconds):
+        """Add seconds to the average duration of the kind of work item.
+        Only the last few dozen samples carry weight, so the average follows
+        changes in the hardware or the data."""
+        self.__recordAverage('durations','seconds',kind,seconds)
+
+    def estimateDuration(self,kind):
+        """Return the average seconds the kind of work item took, or None
+        if it was never recorded."""
+        return self.__average('durations','seconds',kind)
+
+    def recordSize(self,kind,byteCount):
+        """Add byteCount to the average size of the kind of work item."""
+        self.__recordAverage('sizes','bytes',kind,byteCount)
+
+    def estimateSize(self,kind):
+        """Return the average bytes of the kind of work item, or None if
+        it was never recorded."""
+        return self.__average('sizes','bytes',kind)
+
+    def __recordAverage(self,table,column,kind,value):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM {0} WHERE kind=?".format(table),(kind,)).fetchone()
+            samples = 1
+            if row is not None:
+                samples = row['samples']+1
+                value = row[column]+(value-row[column])/float(min(samples,AVERAGE_SAMPLES))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO {0} VALUES (?,?,?,?)".format(table),(kind,value,samples,_now()))
+            self.connection.commit()
+
+    def __average(self,table,column,kind):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT {0} FROM {1} WHERE kind=?".format(column,table),(kind,)).fetchone()
+        if row is None:
+            return None
+        return row[column]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def _now():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,101 @@
+import logging
+import unittest
+
+from MockXnatServer import MockXnatServer
+from XnatConnectionPool import XnatConnectionPool,XnatHttpError
+from XnatRestClient import XnatRestClient
+
+def _scans(count,files=2):
+    return [{'ID': str(number),'type': 'T1-15-SAG','quality': 'usable',
+             'fieldStrength': '3.0','frames': '176','files': files}
+            for number in range(1,count+1)]
+
+# Keep the client's fallback warnings out of the test output
+logging.getLogger('SyncTasks').addHandler(logging.NullHandler())
+
+class TestXnatRestClient(unittest.TestCase):
+    """Checks XnatRestClient against MockXnatServer.  Run with
+    python -m unittest TestXnatRestClient"""
+    def setUp(self):
+        self.server = MockXnatServer()
+        serverUrl = self.server.start()
+        self.connectionPool = XnatConnectionPool()
+        self.connectionPool.addServer(serverUrl,'user','password')
+        self.client = XnatRestClient(self.connectionPool,serverUrl,workers=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.connectionPool.close()
+        self.server.stop()
+
+    def testSearchKeepsOnlyRequestedFields(self):
+        self.server.addSession('E1','PHD_001','S1','visit1',_scans(1),DATE='2015-01-02')
+        self.server.addSession('E2','PHD_002','S2','visit1',_scans(1))
+        records = self.client.search('xnat:mrSessionData',
+                                     ['xnat:mrSessionData/SESSION_ID','xnat:mrSessionData/DATE'],
+                                     [('xnat:mrSessionData/PROJECT','=','PHD_001'),'AND'])
+        self.assertEqual(records,[{'session_id': 'E1','date': '2015-01-02'}])
+
+    def testScanTablesSearchesInChunks(self):
+        sessionIDs = ['E{0}'.format(number) for number in range(5)]
+        for sessionID in sessionIDs:
+            self.server.addSession(sessionID,'PHD_001','S1',sessionID,_scans(3))
+        scanTables = self.client.scanTables(sessionIDs,chunkSize=2)
+        self.assertEqual(self.server.requestCount('POST','/data/search'),3)
+        self.assertEqual(self.server.requestCount('GET','/data/experiments'),0)
+        self.assertEqual(sorted(scanTables.keys()),sessionIDs)
+        for sessionID in sessionIDs:
+            self.assertEqual(scanTables[sessionID],self.client.scanTable(sessionID))
+        self.assertEqual(scanTables['E0']['2'],{'type': 'T1-15-SAG','quality': 'usable',
+                                                'fieldStrength': '3.0','frames': '176'})
+
+    def testScanTablesFallsBackToScanListing(self):
+        self.server.addSession('E1','PHD_001','S1','visit1',_scans(2))
+        self.server.addSession('E2','PHD_001','S1','visit2',_scans(2),searchable=False)
+        scanTables = self.client.scanTables(['E1','E2'])
+        self.assertEqual(self.server.requestCount('GET','/data/experiments/E2/scans?'),1)
+        self.assertEqual(self.server.requestCount('GET','/data/experiments/E1/scans?'),0)
+        self.assertEqual(scanTables['E1']['1']['fieldStrength'],'3.0')
+        self.assertEqual(scanTables['E2'],{'1': {'type': 'T1-15-SAG','quality': 'usable',
+                                                 'fieldStrength': '','frames': ''},
+                                           '2': {'type': 'T1-15-SAG','quality': 'usable',
+                                                 'fieldStrength': '','frames': ''}})
+
+    def testScanTablesFileCounts(self):
+        scans = _scans(2,files=3)
+        scans[1]['files'] = 0
+        self.server.addSession('E1','PHD_001','S1','visit1',scans)
+        self.server.addSession('E2','PHD_001','S1','visit2',_scans(1),searchable=False)
+        scanTables = self.client.scanTables(['E1','E2'],fileCounts=True)
+        self.assertEqual(self.server.requestCount('GET','/data/experiments/E1/scans/ALL/'),1)
+        self.assertEqual(self.server.requestCount('GET','/data/experiments/E1/scans/1/'),0)
+        self.assertEqual(scanTables['E1']['1']['files'],3)
+        self.assertEqual(scanTables['E1']['2']['files'],0)
+        # Counted for the scan listing fallback too
+        self.assertEqual(scanTables['E2']['1']['files'],2)
+
+    def testSessionsWithChangedScansStaysInProject(self):
+        changed = _scans(2)
+        for scan in changed:
+            scan['lastModified'] = '2015-03-01 10:00:00'
+        self.server.addSession('E1','PHD_001','S1','visit1',changed)
+        self.server.addSession('E2','PHD_001','S1','visit2',_scans(2))
+        self.server.addSession('E3','OTHER','S3','visit1',changed)
+        sessions = self.client.sessionsWithChangedScans(
+            ['xnat:mrSessionData/SESSION_ID','xnat:mrSessionData/LABEL'],
+            ('xnat:mrSessionData/PROJECT','LIKE','%PHD%'),'2015-02-01')
+        self.assertEqual(sessions,[{'session_id': 'E1','label': 'visit1'}])
+
+    def testSubjectLabelRefreshesForNewSubjects(self):
+        self.server.addSubject('PHD_001','S1','subject1')
+        self.assertEqual(self.client.subjectLabel('PHD_001','S1'),'subject1')
+        self.assertEqual(self.client.subjectLabel('PHD_001','S1'),'subject1')
+        self.assertEqual(self.server.requestCount('GET','/data/projects/PHD_001/subjects'),1)
+        self.server.addSubject('PHD_001','S2','subject2')
+        self.assertEqual(self.client.subjectLabel('PHD_001','S2'),'subject2')
+        self.assertEqual(self.server.requestCount('GET','/data/projects/PHD_001/subjects'),2)
+        self.assertRaises(XnatHttpError,self.client.subjectLabel,'PHD_001','S3')
+        self.assertEqual(self.server.requestCount('GET','/data/projects/PHD_001/subjects'),3)
+
+if __name__ == '__main__':
+    unittest.main()
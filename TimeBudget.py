@@ -0,0 +1,101 @@
+import time
+import logging
+import datetime
+import threading
+
+class TimeBudget:
+    """When a run has to be done by, and what it left for the next run.
+
+    The syncs ask allows() before starting a session or series, with the
+    estimate() of how long it will take from the durations earlier runs
+    recorded in syncState.  Kinds of work that were never timed are
+    estimated at defaultSeconds.  Whatever doesn't fit is passed to defer()
+    and listed by report().  Without a deadline everything is allowed.
+    Safe to share between threads.
+    """
+    def __init__(self,deadline=None,syncState=None,defaultSeconds=600):
+        self.logger = logging.getLogger('SyncTasks.TimeBudget')
+        # Seconds since the epoch, or None
+        self.deadline = deadline
+        self.syncState = syncState
+        self.defaultSeconds = defaultSeconds
+        self.lock = threading.Lock()
+        # (item, estimated seconds) in the order they were deferred
+        self.deferred = []
+
+    @classmethod
+    def fromArguments(cls,deadline=None,budgetMinutes=None,syncState=None,now=None):
+        """A budget ending at deadline, a time of day as HH:MM, or a date and
+        time as YYYY-MM-DD HH:MM, or budgetMinutes from now, whichever comes
+        first.  A time of day that has already passed today means tomorrow."""
+        if now is None:
+            now = datetime.datetime.now()
+        ends = []
+        if deadline:
+            try:
+                end = datetime.datetime.strptime(deadline,'%Y-%m-%d %H:%M')
+            except ValueError:
+                end = datetime.datetime.combine(now.date(),
+                                                datetime.datetime.strptime(deadline,'%H:%M').time())
+                if end <= now:
+                    end += datetime.timedelta(days=1)
+            ends.append(end)
+        if budgetMinutes is not None:
+            ends.append(now+datetime.timedelta(minutes=budgetMinutes))
+        if not ends:
+            return cls(None,syncState)
+        end = min(ends)
+        return cls(time.mktime(end.timetuple()),syncState)
+
+    def isLimited(self):
+        return self.deadline is not None
+
+    def remaining(self):
+        """Seconds left, or None without a deadline."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline-time.time(),0)
+
+    def estimate(self,kind):
+        """Seconds an item of kind is expected to take."""
+        seconds = None
+        if self.syncState is not None:
+            seconds = self.syncState.estimateDuration(kind)
+        if seconds is None:
+            seconds = self.defaultSeconds
+        return seconds
+
+    def allows(self,seconds):
+        """Whether work expected to take seconds finishes before the deadline."""
+        return self.deadline is None or time.time()+seconds <= self.deadline
+
+    def defer(self,item,seconds=None):
+        """Note that item, expected to take seconds, or an unknown time if
+        None, was left for the next run."""
+        with self.lock:
+            self.deferred.append((item,seconds))
+        if seconds is None:
+            self.logger.info("Deferring {0}, past the deadline.".format(item))
+        else:
+            self.logger.info("Deferring {0}, it would take about {1:.0f}s of the {2:.0f}s left.".format(
+                item,seconds,self.remaining()))
+
+    def deferredCount(self):
+        with self.lock:
+            return len(self.deferred)
+
+    def report(self):
+        """A description of what was deferred, or '' if nothing was."""
+        with self.lock:
+            deferred = list(self.deferred)
+        if not deferred:
+            return ''
+        estimated = [seconds for item,seconds in deferred if seconds is not None]
+        lines = ["{0} items didn't fit before the deadline and were left for the next run, "
+                 "at least {1:.0f} minutes of work:".format(len(deferred),sum(estimated)/60)]
+        for item,seconds in deferred:
+            if seconds is None:
+                lines.append(item)
+            else:
+                lines.append("{0} (about {1:.0f}s)".format(item,seconds))
+        return '\n'.join(lines)
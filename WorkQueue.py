@@ -0,0 +1,148 @@
+import os
+import time
+import fcntl
+import socket
+import logging
+import sqlite3
+import datetime
+import threading
+
+class WorkQueue:
+    """Shares work between hosts running the sync at the same time, through
+    a SQLite database on storage they all mount.
+
+    Every host still finds the sessions and series to sync by itself, and
+    calls claim() with a key naming the item before working on it.  Only
+    one host gets the item.  It holds a lease on it, which a background
+    thread renews every leaseSeconds/3 until the host calls finish(), so
+    a host that dies loses its items to the others leaseSeconds later.
+    Finished items, failed or not, aren't handed out again for holdSeconds,
+    so the other hosts skip what was done earlier in the same run, but the
+    next run looks at everything again.
+
+    Each change is one transaction made under an fcntl lock on path.lock,
+    as SQLite's own locking isn't dependable on network file systems.
+    Safe to share between threads.
+    """
+    def __init__(self,path,owner=None,leaseSeconds=600,holdSeconds=43200):
+        self.logger = logging.getLogger('SyncTasks.WorkQueue')
+        self.path = path
+        if owner is None:
+            owner = "{0}:{1}".format(socket.gethostname(),os.getpid())
+        self.owner = owner
+        self.leaseSeconds = leaseSeconds
+        self.holdSeconds = holdSeconds
+        self.lock = threading.Lock()
+        self.lockFile = open(path+'.lock','a')
+        self.connection = sqlite3.connect(path,timeout=60,check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            with _Transaction(self.connection,self.lockFile):
+                self.connection.execute("""
+                    CREATE TABLE IF NOT EXISTS items (
+                        key TEXT PRIMARY KEY,
+                        status TEXT,
+                        owner TEXT,
+                        expires REAL,
+                        attempts INTEGER DEFAULT 0,
+                        updated TEXT)""")
+        # Keys this process holds leases on
+        self.held = set()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self.__renewLeases,name='WorkQueue heartbeat')
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+    def claim(self,key):
+        """Take the lease on the item key.  Returns False if another host
+        holds it, or it was finished less than holdSeconds ago."""
+        now = time.time()
+        with self.lock:
+            with _Transaction(self.connection,self.lockFile):
+                row = self.connection.execute("SELECT * FROM items WHERE key=?",(key,)).fetchone()
+                if row is not None and row['owner'] != self.owner and row['expires'] > now:
+                    return False
+                attempts = 1
+                if row is not None:
+                    attempts = row['attempts']+1
+                self.connection.execute("INSERT OR REPLACE INTO items VALUES (?,?,?,?,?,?)",
+                                        (key,'leased',self.owner,now+self.leaseSeconds,attempts,_now()))
+            self.held.add(key)
+        self.logger.debug('Claimed {0}'.format(key))
+        return True
+
+    def finish(self,key,succeeded=True):
+        """Give up the lease on key, recording the item as done or failed.
+        The other hosts leave it alone for holdSeconds."""
+        self.__setStatus(key,succeeded and 'done' or 'failed',time.time()+self.holdSeconds)
+
+    def release(self,key):
+        """Give up the lease on key without finishing it, so any host can
+        claim it straight away."""
+        self.__setStatus(key,'pending',0)
+
+    def close(self):
+        """Stop renewing leases and release the items still held."""
+        self.stopped.set()
+        self.heartbeat.join()
+        with self.lock:
+            held = list(self.held)
+        for key in held:
+            self.logger.warning('Releasing unfinished {0}'.format(key))
+            self.release(key)
+        with self.lock:
+            self.connection.close()
+            self.lockFile.close()
+
+    def __setStatus(self,key,status,expires):
+        with self.lock:
+            if key not in self.held:
+                return
+            self.held.discard(key)
+            with _Transaction(self.connection,self.lockFile):
+                self.connection.execute("UPDATE items SET status=?,expires=?,updated=? WHERE key=? AND owner=?",
+                                        (status,expires,_now(),key,self.owner))
+
+    def __renewLeases(self):
+        while not self.stopped.wait(self.leaseSeconds/3.0):
+            try:
+                with self.lock:
+                    if not self.held:
+                        continue
+                    with _Transaction(self.connection,self.lockFile):
+                        expires = time.time()+self.leaseSeconds
+                        for key in self.held:
+                            self.connection.execute("UPDATE items SET expires=? WHERE key=? AND owner=?",
+                                                    (expires,key,self.owner))
+            except (sqlite3.Error,IOError):
+                self.logger.warning('Could not renew the work queue leases',exc_info=True)
+
+class _Transaction:
+    """One transaction, made while holding an fcntl lock on lockFile.
+    Committed when the block ends normally, rolled back otherwise."""
+    def __init__(self,connection,lockFile):
+        self.connection = connection
+        self.lockFile = lockFile
+
+    def __enter__(self):
+        fcntl.lockf(self.lockFile,fcntl.LOCK_EX)
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+        except:
+            fcntl.lockf(self.lockFile,fcntl.LOCK_UN)
+            raise
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        try:
+            if excType is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            fcntl.lockf(self.lockFile,fcntl.LOCK_UN)
+        return False
+
+def _now():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,153 @@
+import base64
+import httplib
+import logging
+import socket
+import threading
+import urlparse
+import Queue
+
+class XnatHttpError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+class PooledResponse:
+    """A response read from a pooled connection.  The connection goes back
+    to the pool on close() if the body was read to the end, otherwise it is
+    dropped so a half-read response is never reused."""
+    def __init__(self,pool,host,connection,response):
+        self.pool = pool
+        self.host = host
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.closed = False
+
+    def getheader(self,name,default=None):
+        return self.response.getheader(name,default)
+
+    def read(self,amount=None):
+        return self.response.read(amount)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.pool._release(self.host,self.connection,reusable)
+
+class XnatConnectionPool:
+    """Keep-alive HTTP(S) connections to one or more xnat servers.
+
+    At most perHostLimit connections are open to any one host at a time.
+    Callers that want a connection while all of them are busy block until
+    one is released, so every thread sharing the pool also shares the
+    per-host limit.  Connections are safe to share between threads, unlike
+    the single httplib2 connection inside a pyxnat Interface.
+    """
+    def __init__(self,perHostLimit=4,timeout=300):
+        self.logger = logging.getLogger('SyncTasks.XnatConnectionPool')
+        self.perHostLimit = perHostLimit
+        self.timeout = timeout
+        self.servers = {}
+        self.idle = {}
+        self.slots = {}
+        self.cookies = {}
+        self.lock = threading.Lock()
+
+    def addServer(self,serverUrl,user,password):
+        """Register the credentials used for requests against serverUrl."""
+        serverUrl = serverUrl.rstrip('/')
+        parsed = urlparse.urlparse(serverUrl)
+        authHeader = 'Basic ' + base64.b64encode('{0}:{1}'.format(user,password))
+        with self.lock:
+            self.servers[serverUrl] = (parsed.scheme,parsed.netloc,
+                                       parsed.path.rstrip('/'),authHeader)
+            if parsed.netloc not in self.slots:
+                self.slots[parsed.netloc] = threading.BoundedSemaphore(self.perHostLimit)
+                self.idle[parsed.netloc] = Queue.LifoQueue()
+        return serverUrl
+
+    def addInterface(self,xnat):
+        """Register the server and credentials of a pyxnat Interface and
+        return the server url to use with request() and open()."""
+        # pyxnat has no public getters for these, so read the private variables.
+        return self.addServer(xnat._server,xnat._user,xnat._pwd)
+
+    def open(self,serverUrl,method,path,headers=None,body=None):
+        """Send a request and return a PooledResponse.  The caller must
+        close() the response to give the connection back to the pool."""
+        scheme,host,basePath,authHeader = self.servers[serverUrl.rstrip('/')]
+        requestHeaders = {'Authorization': authHeader}
+        with self.lock:
+            cookie = self.cookies.get(host)
+        if cookie:
+            requestHeaders['Cookie'] = cookie
+        if headers:
+            requestHeaders.update(headers)
+
+        self.slots[host].acquire()
+        try:
+            # A keep-alive connection the server has since closed fails on
+            # first use, so retry once on a fresh connection.
+            for attempt in range(2):
+                connection,reused = self.__getConnection(scheme,host)
+                try:
+                    connection.request(method,basePath+path,body,requestHeaders)
+                    response = connection.getresponse()
+                    break
+                except (httplib.HTTPException,socket.error):
+                    connection.close()
+                    if not reused or attempt == 1:
+                        raise
+                    self.logger.debug('Stale connection to {0}, reconnecting.'.format(host))
+        except:
+            self.slots[host].release()
+            raise
+
+        setCookie = response.getheader('set-cookie')
+        if setCookie and 'JSESSIONID' in setCookie:
+            with self.lock:
+                self.cookies[host] = setCookie.split(';')[0]
+        return PooledResponse(self,host,connection,response)
+
+    def request(self,serverUrl,method,path,headers=None,body=None):
+        """Send a request and return (status, body) once it is fully read.
+        Raises XnatHttpError for any non-2xx status."""
+        response = self.open(serverUrl,method,path,headers,body)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        if response.status < 200 or response.status >= 300:
+            raise XnatHttpError('{0} {1} returned {2} {3}'.format(method,path,
+                                                                  response.status,
+                                                                  response.reason))
+        return response.status,data
+
+    def __getConnection(self,scheme,host):
+        try:
+            return self.idle[host].get_nowait(),True
+        except Queue.Empty:
+            pass
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host,timeout=self.timeout),False
+        return httplib.HTTPConnection(host,timeout=self.timeout),False
+
+    def _release(self,host,connection,reusable):
+        if reusable:
+            self.idle[host].put(connection)
+        else:
+            connection.close()
+        self.slots[host].release()
+
+    def close(self):
+        """Close every idle connection."""
+        for idle in self.idle.values():
+            while True:
+                try:
+                    idle.get_nowait().close()
+                except Queue.Empty:
+                    break
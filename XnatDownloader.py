@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import shutil
+import httplib
+import tarfile
+import logging
+from multiprocessing.pool import ThreadPool
+
+from XnatConnectionPool import XnatConnectionPool,XnatHttpError
+
+DOWNLOAD_MODES = ('files','series','session')
+
+class XnatDownloader:
+    """Downloads the files of a scan resource with a bounded pool of worker
+    threads.  One instance is shared by both sync classes so the worker
+    count and the per-host connection limit hold for the whole run.
+
+    The mode decides how a scan is fetched:
+      files   - one request per file, spread over the worker threads.
+      series  - one tar.gz archive per scan, extracted as it streams in.
+      session - one tar.gz archive holding every scan of a session, used by
+                downloadSession(); single scans are fetched as in 'series'.
+    If an archive request fails the scan is fetched file by file instead.
+    """
+    def __init__(self,connectionPool=None,concurrency=8,mode='files'):
+        self.logger = logging.getLogger('SyncTasks.XnatDownloader')
+        if connectionPool is None:
+            connectionPool = XnatConnectionPool()
+        if mode not in DOWNLOAD_MODES:
+            raise ValueError("Download mode must be one of {0}, not '{1}'".format(
+                ', '.join(DOWNLOAD_MODES),mode))
+        self.connectionPool = connectionPool
+        self.concurrency = concurrency
+        self.mode = mode
+        self.workers = ThreadPool(concurrency)
+
+    def listScanFiles(self,serverUrl,sessionID,scanID,resourceLabel='DICOM'):
+        """Return the xnat file listing for one scan resource as a list of
+        dicts with 'Name', 'Size' and 'URI' keys."""
+        path = '/data/experiments/{0}/scans/{1}/resources/{2}/files?format=json'.format(
+            sessionID,scanID,resourceLabel)
+        status,data = self.connectionPool.request(serverUrl,'GET',path)
+        return json.loads(data)['ResultSet']['Result']
+
+    def downloadScan(self,xnat,sessionID,scanID,destDir,resourceLabel='DICOM'):
+        """Download every file of a scan resource into destDir and return the
+        number of bytes written."""
+        serverUrl = self.connectionPool.addInterface(xnat)
+        if self.mode != 'files':
+            path = '/data/experiments/{0}/scans/{1}/resources/{2}/files?format=tar.gz'.format(
+                sessionID,scanID,resourceLabel)
+            startTime = time.time()
+            try:
+                fileCounts,byteCounts = self.__extractArchive(serverUrl,path,{scanID: destDir})
+                self.__logThroughput(sessionID,scanID,fileCounts[scanID],byteCounts[scanID],
+                                     time.time()-startTime)
+                return byteCounts[scanID]
+            except (XnatHttpError,httplib.HTTPException,tarfile.TarError,EnvironmentError) as e:
+                self.logger.warn("Archive download of {0},{1} failed, fetching files one at a time. {2}".format(
+                    sessionID,scanID,e))
+                self.__emptyDir(destDir)
+        return self.__downloadScanFiles(serverUrl,sessionID,scanID,destDir,resourceLabel)
+
+    def downloadSession(self,xnat,sessionID,scanDirs,resourceLabel='DICOM'):
+        """Download the resource of every scan in scanDirs, a dict mapping
+        scan ID to destination directory, and return the total bytes written."""
+        if self.mode != 'session':
+            return sum([self.downloadScan(xnat,sessionID,scanID,destDir,resourceLabel)
+                        for scanID,destDir in scanDirs.items()])
+        serverUrl = self.connectionPool.addInterface(xnat)
+        path = '/data/experiments/{0}/scans/ALL/resources/{1}/files?format=tar.gz'.format(
+            sessionID,resourceLabel)
+        startTime = time.time()
+        try:
+            fileCounts,byteCounts = self.__extractArchive(serverUrl,path,scanDirs)
+        except (XnatHttpError,httplib.HTTPException,tarfile.TarError,EnvironmentError) as e:
+            self.logger.warn("Archive download of session {0} failed, fetching files one at a time. {1}".format(
+                sessionID,e))
+            for destDir in scanDirs.values():
+                self.__emptyDir(destDir)
+            return sum([self.__downloadScanFiles(serverUrl,sessionID,scanID,destDir,resourceLabel)
+                        for scanID,destDir in scanDirs.items()])
+        seconds = time.time()-startTime
+        for scanID in scanDirs:
+            self.__logThroughput(sessionID,scanID,fileCounts[scanID],byteCounts[scanID],seconds)
+        return sum(byteCounts.values())
+
+    def __downloadScanFiles(self,serverUrl,sessionID,scanID,destDir,resourceLabel):
+        files = self.listScanFiles(serverUrl,sessionID,scanID,resourceLabel)
+        startTime = time.time()
+        sizes = self.workers.map(lambda fileData: self.__downloadFile(serverUrl,fileData,destDir),
+                                 files)
+        totalBytes = sum(sizes)
+        self.__logThroughput(sessionID,scanID,len(files),totalBytes,time.time()-startTime)
+        return totalBytes
+
+    def __extractArchive(self,serverUrl,path,scanDirs):
+        """Stream a tar.gz archive from xnat and write each member into the
+        directory of the scan it belongs to as the bytes arrive, so the
+        archive itself never lands on disk.  Returns per-scan file and byte
+        counts."""
+        fileCounts = dict([(scanID,0) for scanID in scanDirs])
+        byteCounts = dict([(scanID,0) for scanID in scanDirs])
+        response = self.connectionPool.open(serverUrl,'GET',path)
+        try:
+            if response.status != 200:
+                raise XnatHttpError('GET {0} returned {1} {2}'.format(path,response.status,
+                                                                      response.reason))
+            archive = tarfile.open(fileobj=response,mode='r|gz')
+            for member in archive:
+                if not member.isfile():
+                    continue
+                scanID = self.__scanIDForMember(member.name,scanDirs)
+                if scanID is None:
+                    self.logger.debug("Skipping archive member {0}".format(member.name))
+                    continue
+                # Members are flattened to their base name, the same layout
+                # the per-file download produces.
+                outPath = os.path.join(scanDirs[scanID],os.path.basename(member.name))
+                memberFile = archive.extractfile(member)
+                outFile = open(outPath,'wb')
+                try:
+                    shutil.copyfileobj(memberFile,outFile,65536)
+                finally:
+                    outFile.close()
+                fileCounts[scanID] += 1
+                byteCounts[scanID] += member.size
+            archive.close()
+            # Read any trailing padding so the connection can be reused.
+            while response.read(65536):
+                pass
+        finally:
+            response.close()
+        if sum(fileCounts.values()) == 0:
+            raise XnatHttpError('GET {0} returned an archive without any files'.format(path))
+        return fileCounts,byteCounts
+
+    def __scanIDForMember(self,memberName,scanDirs):
+        """Find the scan an archive member belongs to.  Archives of a single
+        scan have only one candidate; session archives name the scan folder
+        '<scanID>' or '<scanID>-<scanType>' after a 'scans' component."""
+        if len(scanDirs) == 1:
+            return scanDirs.keys()[0]
+        parts = memberName.split('/')
+        if 'scans' not in parts[:-1]:
+            return None
+        folder = parts[parts.index('scans')+1]
+        matches = [scanID for scanID in scanDirs
+                   if folder == scanID or folder.startswith(scanID+'-')]
+        if not matches:
+            return None
+        return max(matches,key=len)
+
+    def __emptyDir(self,destDir):
+        for name in os.listdir(destDir):
+            path = os.path.join(destDir,name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def __downloadFile(self,serverUrl,fileData,destDir):
+        path = os.path.join(destDir,fileData['Name'])
+        response = self.connectionPool.open(serverUrl,'GET',fileData['URI'])
+        try:
+            if response.status != 200:
+                raise XnatHttpError('GET {0} returned {1} {2}'.format(fileData['URI'],
+                                                                      response.status,
+                                                                      response.reason))
+            size = 0
+            outFile = open(path,'wb')
+            try:
+                while True:
+                    chunk = response.read(65536)
+                    if not chunk:
+                        break
+                    outFile.write(chunk)
+                    size += len(chunk)
+            finally:
+                outFile.close()
+        finally:
+            response.close()
+        return size
+
+    def __logThroughput(self,sessionID,scanID,fileCount,totalBytes,seconds):
+        seconds = max(seconds,0.001)
+        self.logger.info("Downloaded {0},{1}: {2} files, {3} bytes in {4:.1f}s ({5:.0f} bytes/sec).".format(
+            sessionID,scanID,fileCount,totalBytes,seconds,totalBytes/seconds))
+
+    def close(self):
+        self.workers.close()
+        self.workers.join()
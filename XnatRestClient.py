@@ -0,0 +1,270 @@
+import re
+import json
+import urllib
+import logging
+import threading
+from xml.sax.saxutils import escape
+from multiprocessing.pool import ThreadPool
+
+from XnatConnectionPool import XnatConnectionPool,XnatHttpError
+
+class XnatRestClient:
+    """Talks to one xnat server over the REST api for the lookups and
+    updates the syncs make for every session: session searches, scan
+    metadata, scan and subject listings and attribute writes.
+
+    Requests go over a shared XnatConnectionPool, so they reuse keep-alive
+    connections and share its per-host connection limit.  Unlike a pyxnat
+    Interface the client is safe to use from any thread, and imap() runs
+    lookups for many sessions at once on its worker threads.  Search
+    results come back as compact records: plain dicts holding only the
+    requested fields, keyed by the lowercased field ID as pyxnat keys them.
+    """
+    def __init__(self,connectionPool,serverUrl,workers=8):
+        self.logger = logging.getLogger('SyncTasks.XnatRestClient')
+        self.connectionPool = connectionPool
+        self.serverUrl = serverUrl
+        self.workers = ThreadPool(max(workers,1))
+        self.lock = threading.Lock()
+        # subject ID -> label, per project
+        self.subjectLabelCache = {}
+
+    @classmethod
+    def forInterface(cls,xnat,connectionPool=None,workers=8):
+        """A client for the server and credentials of a pyxnat Interface."""
+        if connectionPool is None:
+            connectionPool = XnatConnectionPool()
+        return cls(connectionPool,connectionPool.addInterface(xnat),workers)
+
+    def imap(self,function,items):
+        """Like itertools.imap, but calls function on the worker threads,
+        several items at a time."""
+        return self.workers.imap(function,items)
+
+    def search(self,rootElement,fields,conditions):
+        """Run an xnat search and return its rows.  fields are search field
+        paths such as 'xnat:mrSessionData/SESSION_ID' and conditions take
+        the pyxnat where() form: (field, comparison, value) tuples, nested
+        lists for sub-clauses and an 'AND' or 'OR' setting how the entries
+        at that level combine."""
+        document = self.__searchDocument(rootElement,fields,conditions)
+        status,data = self.connectionPool.request(self.serverUrl,'POST','/data/search?format=json',
+                                                  {'Content-Type': 'text/xml'},document)
+        keys = [field.split('/')[-1].lower() for field in fields]
+        records = []
+        for row in json.loads(data)['ResultSet']['Result']:
+            row = dict([(key.lower(),value) for key,value in row.items()])
+            records.append(dict([(key,row.get(key,'')) for key in keys]))
+        return records
+
+    def scanTable(self,sessionID,fileCounts=False):
+        """Return the type, quality, field strength and frame count of every
+        scan in a session, keyed by series number.  Falls back to the scan
+        listing, which has no field strength or frame count, if the search
+        comes back empty.  With fileCounts, each scan also gets the number
+        of files in its DICOM resource as 'files', from one listing of the
+        session's files, or None if they couldn't be listed."""
+        scans = self.search('xnat:mrScanData',
+                            ['xnat:mrScanData/ID',
+                             'xnat:mrScanData/TYPE',
+                             'xnat:mrScanData/QUALITY',
+                             'xnat:mrScanData/FIELDSTRENGTH',
+                             'xnat:mrScanData/FRAMES'],
+                            [('xnat:mrScanData/IMAGE_SESSION_ID','=',sessionID),'AND'])
+        scanTable = {}
+        for scan in scans:
+            scanTable[scan['id']] = {'type': scan['type'],
+                                     'quality': scan['quality'],
+                                     'fieldStrength': scan['fieldstrength'],
+                                     'frames': scan['frames']}
+        if not scanTable:
+            self.logger.warn("Scan search for {0} returned nothing, using the scan listing.".format(sessionID))
+            for scan in self.listScans(sessionID):
+                scanTable[scan['ID']] = {'type': scan.get('type',''),
+                                         'quality': scan.get('quality',''),
+                                         'fieldStrength': '',
+                                         'frames': ''}
+        if fileCounts:
+            self.__addFileCounts(sessionID,scanTable,self.__fileCounts(sessionID))
+        return scanTable
+
+    def scanTables(self,sessionIDs,chunkSize=100,fileCounts=False):
+        """Return the scanTable() of each of sessionIDs, keyed by session ID,
+        with one search per chunkSize sessions.  With fileCounts, the file
+        listings of the sessions are fetched on the worker threads."""
+        scanTables = dict([(sessionID,{}) for sessionID in sessionIDs])
+        sessionIDs = list(sessionIDs)
+        for start in range(0,len(sessionIDs),chunkSize):
+            sessionConditions = [('xnat:mrScanData/IMAGE_SESSION_ID','=',sessionID)
+                                 for sessionID in sessionIDs[start:start+chunkSize]]
+            sessionConditions.append('OR')
+            scans = self.search('xnat:mrScanData',
+                                ['xnat:mrScanData/IMAGE_SESSION_ID',
+                                 'xnat:mrScanData/ID',
+                                 'xnat:mrScanData/TYPE',
+                                 'xnat:mrScanData/QUALITY',
+                                 'xnat:mrScanData/FIELDSTRENGTH',
+                                 'xnat:mrScanData/FRAMES'],
+                                [sessionConditions,'AND'])
+            for scan in scans:
+                if scan['image_session_id'] in scanTables:
+                    scanTables[scan['image_session_id']][scan['id']] = {'type': scan['type'],
+                                                                        'quality': scan['quality'],
+                                                                        'fieldStrength': scan['fieldstrength'],
+                                                                        'frames': scan['frames']}
+        # Sessions the search found nothing for get the scan listing
+        for sessionID,scanTable in scanTables.items():
+            if not scanTable:
+                scanTables[sessionID] = self.scanTable(sessionID)
+        if fileCounts:
+            for sessionID,counts in zip(sessionIDs,self.imap(self.__fileCounts,sessionIDs)):
+                self.__addFileCounts(sessionID,scanTables[sessionID],counts)
+        return scanTables
+
+    def sessionsWithChangedScans(self,fields,projectCondition,changedSince):
+        """Return the sessions meeting projectCondition, such as
+        ('xnat:mrSessionData/PROJECT','=',project), with a scan modified
+        since changedSince, one record of the xnat:mrSessionData fields per
+        session.  fields must include xnat:mrSessionData/SESSION_ID.
+        Editing a scan, such as its quality, doesn't always change the
+        session's own LAST_MODIFIED."""
+        scans = self.search('xnat:mrScanData',fields,
+                            [projectCondition,
+                             ('xnat:mrScanData/LAST_MODIFIED','>=',changedSince),'AND'])
+        # One row comes back per changed scan
+        sessions = {}
+        for scan in scans:
+            sessions.setdefault(scan['session_id'],scan)
+        return sessions.values()
+
+    def listScans(self,sessionID):
+        """Return the xnat scan listing of a session as a list of dicts with
+        'ID', 'type' and 'quality' keys."""
+        return self.__getResults('/data/experiments/{0}/scans?format=json'.format(
+            urllib.quote(sessionID)))
+
+    def listScanFiles(self,sessionID,scanID,resourceLabel='DICOM'):
+        """Return the xnat file listing for one scan resource as a list of
+        dicts with 'Name', 'Size' and 'URI' keys."""
+        return self.__getResults('/data/experiments/{0}/scans/{1}/resources/{2}/files?format=json'.format(
+            urllib.quote(sessionID),urllib.quote(scanID),urllib.quote(resourceLabel)))
+
+    def scanFileCounts(self,sessionID,resourceLabel='DICOM'):
+        """Return the number of files in the resourceLabel resource of every
+        scan in a session, keyed by scan ID, from one file listing."""
+        files = self.__getResults('/data/experiments/{0}/scans/ALL/resources/{1}/files?format=json'.format(
+            urllib.quote(sessionID),urllib.quote(resourceLabel)))
+        counts = {}
+        for scanFile in files:
+            match = re.search('/scans/([^/]+)/',scanFile['URI'])
+            if match:
+                scanID = urllib.unquote(match.group(1))
+                counts[scanID] = counts.get(scanID,0)+1
+        return counts
+
+    def subjectLabel(self,project,subjectID):
+        """Return the label of a subject.  The labels of every subject in
+        the project are fetched with one request and kept for the run."""
+        labels = self.projectSubjects(project)
+        if subjectID not in labels:
+            labels = self.projectSubjects(project,refresh=True)
+        if subjectID not in labels:
+            raise XnatHttpError('Subject {0} is not in project {1}'.format(subjectID,project))
+        return labels[subjectID]
+
+    def projectSubjects(self,project,refresh=False):
+        """Return the label of every subject in project keyed by subject ID,
+        as fetched earlier in the run unless refresh is set."""
+        with self.lock:
+            labels = self.subjectLabelCache.get(project)
+        if labels is None or refresh:
+            labels = {}
+            for subject in self.__getResults('/data/projects/{0}/subjects?format=json&columns=ID,label'.format(
+                    urllib.quote(project))):
+                labels[subject['ID']] = subject['label']
+            with self.lock:
+                self.subjectLabelCache[project] = labels
+        return labels
+
+    def subjectExists(self,project,subjectLabel):
+        response = self.connectionPool.open(self.serverUrl,'GET',
+                                            '/data/projects/{0}/subjects/{1}?format=json'.format(
+                                                urllib.quote(project),urllib.quote(subjectLabel)))
+        try:
+            response.read()
+        finally:
+            response.close()
+        if response.status == 404:
+            return False
+        if response.status < 200 or response.status >= 300:
+            raise XnatHttpError('GET subject {0} of {1} returned {2} {3}'.format(
+                subjectLabel,project,response.status,response.reason))
+        return True
+
+    def createSubject(self,project,subjectLabel):
+        self.connectionPool.request(self.serverUrl,'PUT','/data/projects/{0}/subjects/{1}'.format(
+            urllib.quote(project),urllib.quote(subjectLabel)))
+
+    def setAttributes(self,uri,xsiType,attributes):
+        """Set attributes, a list of (path, value) pairs, of the xnat object
+        at uri with one request, the way pyxnat's attrs.set() does."""
+        query = urllib.urlencode([('xsiType',xsiType)]+list(attributes))
+        self.connectionPool.request(self.serverUrl,'PUT',uri+'?'+query)
+
+    def close(self):
+        self.workers.close()
+        self.workers.join()
+
+    def __fileCounts(self,sessionID):
+        """scanFileCounts(), or None if the files can't be listed."""
+        try:
+            return self.scanFileCounts(sessionID)
+        except Exception as e:
+            self.logger.warn("Could not list the files of {0}: {1}".format(sessionID,e))
+            return None
+
+    def __addFileCounts(self,sessionID,scanTable,counts):
+        for scanID,scanRecord in scanTable.items():
+            if counts is None:
+                scanRecord['files'] = None
+            else:
+                scanRecord['files'] = counts.get(scanID,0)
+
+    def __getResults(self,path):
+        status,data = self.connectionPool.request(self.serverUrl,'GET',path)
+        return json.loads(data)['ResultSet']['Result']
+
+    def __searchDocument(self,rootElement,fields,conditions):
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<xdat:search ID="" allow-diff-columns="0" secure="false" '
+                 'brief-description="XnatSynchronization" '
+                 'xmlns:xdat="http://nrg.wustl.edu/security" '
+                 'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">',
+                 '<xdat:root_element_name>{0}</xdat:root_element_name>'.format(escape(rootElement))]
+        for sequence,field in enumerate(fields):
+            element,fieldID = field.split('/')
+            lines.append('<xdat:search_field><xdat:element_name>{0}</xdat:element_name>'
+                         '<xdat:field_ID>{1}</xdat:field_ID><xdat:sequence>{2}</xdat:sequence>'
+                         '<xdat:type>string</xdat:type><xdat:header>{3}</xdat:header>'
+                         '</xdat:search_field>'.format(escape(element),escape(fieldID.upper()),
+                                                       sequence,escape(fieldID.lower())))
+        lines.append(self.__whereClause('xdat:search_where',conditions))
+        lines.append('</xdat:search>')
+        return '\n'.join(lines)
+
+    def __whereClause(self,tag,conditions):
+        method = 'AND'
+        clauses = []
+        for condition in conditions:
+            if isinstance(condition,basestring):
+                method = condition.upper()
+            elif isinstance(condition,list):
+                clauses.append(self.__whereClause('xdat:child_set',condition))
+            else:
+                field,comparison,value = condition
+                clauses.append('<xdat:criteria override_value_formatting="0">'
+                               '<xdat:schema_field>{0}</xdat:schema_field>'
+                               '<xdat:comparison_type>{1}</xdat:comparison_type>'
+                               '<xdat:value>{2}</xdat:value></xdat:criteria>'.format(
+                                   escape(field),escape(comparison),escape(str(value))))
+        return '<{0} method="{1}">{2}</{0}>'.format(tag,method,''.join(clauses))